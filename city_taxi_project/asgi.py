@@ -13,4 +13,39 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "city_taxi_project.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def lifespan(receive, send):
+    # Django has no lifespan support; the onboarding bot's webhook mode
+    # starts and stops its background tasks here, once per uvicorn worker,
+    # and queued webhook updates get handled before the process exits
+    from django.conf import settings
+
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                if settings.ONBOARDING_WEBHOOK_URL:
+                    import onboarding_bot
+                    await onboarding_bot.start_webhook()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # handlers may still need the onboarding bot: drain them first
+            from city_taxi_project.urls import update_queue
+            await update_queue.close(settings.SHUTDOWN_DRAIN_SECONDS)
+            if settings.ONBOARDING_WEBHOOK_URL:
+                import onboarding_bot
+                await onboarding_bot.stop_webhook()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    else:
+        await django_application(scope, receive, send)
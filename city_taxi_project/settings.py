@@ -131,3 +131,100 @@ WEBHOOK_BASE_URL = "https://1f7c-213-230-82-34.ngrok-free.app"
 
 
 ADMIN_IDS = [1135712336]
+
+# Telethon client pool used by the posting loop
+TELETHON_POOL_SIZE = 500             # max connected clients kept around
+TELETHON_POOL_IDLE_TIMEOUT = 30 * 60 # seconds before an unused client is dropped
+
+# Group fan-out per Telethon account
+FANOUT_CONCURRENCY = 5   # parallel sends per account
+FANOUT_RATE = 1.0        # sustained sends per second per account
+FANOUT_BURST = 5
+
+# In-process cache of ActiveUser status
+ACTIVE_USER_CACHE_TTL = 60         # seconds
+ACTIVE_USER_CACHE_SIZE = 10_000
+
+# Per-driver webhook bots
+BOTPOOL_MAX_BOTS = 1000          # Bot instances (HTTP sessions) kept open
+TOKEN_REGISTRY_REFRESH = 300     # seconds between full token reloads
+
+# Webhook ingestion: answer Telegram first, run handlers in worker tasks
+WEBHOOK_ACK_FIRST = True
+WEBHOOK_WORKERS = 8
+WEBHOOK_QUEUE_SIZE = 1000        # total across workers; full → 503
+
+# Pending Telethon logins (waiting for code / 2FA)
+LOGIN_TTL = 10 * 60
+LOGIN_MAX_PENDING = 100
+
+# Threads serving bot DB reads concurrently (writes stay on one thread)
+DB_READ_WORKERS = 8
+
+# Posting worker processes (0 = post from the bot process itself)
+POSTING_WORKERS = 0
+
+# Prometheus metrics of the standalone onboarding bot (0 = no exporter);
+# the web app serves the same data at /metrics to scrapers that send
+# "Authorization: Bearer <METRICS_TOKEN>" ("" = /metrics is off)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+METRICS_TOKEN = ""
+
+# Updates slower than this are logged with a per-stage (db, sql, telegram,
+# telethon) breakdown
+SLOW_UPDATE_SECONDS = 1.0
+# Opt-in: append await stacks of slow updates here (collapsed/flamegraph format)
+UPDATE_PROFILE_FILE = None
+UPDATE_PROFILE_INTERVAL = 0.01   # sampling period, seconds
+
+# Delivery journal (one Delivery row per group send, written in batches)
+DELIVERY_FLUSH_SIZE = 500        # rows
+DELIVERY_FLUSH_INTERVAL = 5      # seconds
+DELIVERY_RETENTION_DAYS = 14
+
+# Parsed announcement texts kept per process (keyed by id + updated_at)
+CONTENT_CACHE_SIZE = 5000
+
+# Load-leveled scheduling: runs move to the least-loaded slot near their
+# nominal time; the average cadence of every announcement is unchanged
+SCHEDULER_SLOT_SECONDS = 5
+SCHEDULER_SHIFT_FRACTION = 0.1   # max shift as a fraction of the interval …
+SCHEDULER_MAX_SHIFT = 300        # … and in seconds
+SCHEDULER_START_SPREAD = 60      # first run of a new announcement within this
+POSTING_SEND_BUDGET = 30         # sends per second across all drivers (0 = no cap)
+
+# Telethon sessions live in Driver.session; changed ones are written back
+# in one batch this many seconds after the first change
+SESSION_FLUSH_INTERVAL = 5
+
+# Telethon connect ramp-up: after a restart clients connect at this pace
+# instead of all at once
+TELETHON_CONNECT_RATE = 5            # new connections per second, split across POSTING_WORKERS (0 = unlimited)
+TELETHON_CONNECT_CONCURRENCY = 10    # handshakes in flight per process (0 = unlimited)
+TELETHON_WARM_UP = True              # pre-connect the soonest-due drivers at boot
+
+# Graceful shutdown: cycles in flight keep posting this long, then save the
+# groups they have left for the next process
+SHUTDOWN_DRAIN_SECONDS = 20
+# after a restart, overdue announcements run within this window
+SCHEDULER_CATCHUP_SPREAD = 300
+
+# Onboarding bot updates: long polling unless a public webhook URL is set;
+# then every uvicorn worker of the ASGI app serves /onboarding/webhook/
+ONBOARDING_WEBHOOK_URL = ""          # e.g. "https://taxi.example.com/onboarding/webhook/"
+ONBOARDING_WEBHOOK_SECRET = ""       # required with a webhook URL; Telegram sends it as X-Telegram-Bot-Api-Secret-Token
+# FSM state: "memory" (one process) or "db" (shared by the webhook workers)
+ONBOARDING_FSM_STORAGE = "db" if ONBOARDING_WEBHOOK_URL else "memory"
+# the webhook worker holding this lock runs posting and expiry; the others
+# queue posting commands it picks up every CONTROL_POLL_INTERVAL seconds
+ONBOARDING_LEADER_LOCK = BASE_DIR / "onboarding.leader"
+CONTROL_POLL_INTERVAL = 1
+
+# Admin broadcasts (📣 Broadcast) to every active user, sent by the
+# onboarding bot below the Bot API's ~30 messages/s
+BROADCAST_RATE = 25                  # messages per second
+BROADCAST_CONCURRENCY = 8            # sends in flight
+BROADCAST_CHUNK = 200                # recipients read and checkpointed per batch
+BROADCAST_MAX_RETRIES = 3            # per recipient, on 429 and network errors
+BROADCAST_PROGRESS_INTERVAL = 10     # seconds between progress edits
@@ -1,47 +1,103 @@
 # city_taxi_project/urls.py
+import hmac
 import logging
+from django.conf    import settings
 from django.contrib import admin
 from django.urls    import path
 from django.http    import JsonResponse, HttpResponse
-from asgiref.sync   import sync_to_async
 from aiogram import types
 from aiogram.exceptions import TelegramBadRequest
-from taxiapp.models   import Driver
-from taxiapp.botpool  import get_dispatcher
+from taxiapp.botpool  import dp, get_bot
+from taxiapp.tokens   import registry
+from taxiapp.ingest   import UpdateQueue
+from taxiapp          import metrics
 
 log = logging.getLogger(__name__)
 
+# Webhook mode: the onboarding bot runs in this process too, on the same
+# loop, DB threads and caches as the driver bots
+onboarding = None
+if settings.ONBOARDING_WEBHOOK_URL:
+    import onboarding_bot as onboarding
+
+async def process_update(bot, update: types.Update):
+    dispatcher = onboarding.dp if onboarding is not None and bot is onboarding.bot else dp
+    try:
+        await dispatcher.feed_update(bot, update)
+    except TelegramBadRequest as e:
+        log.warning("Telegram API rejected the handler call: %s", e)
+    except Exception:
+        log.exception("Unexpected error in handler")
+
+# Acknowledge-first mode: the view only enqueues, workers run the handlers
+update_queue = UpdateQueue(
+    process_update,
+    workers=settings.WEBHOOK_WORKERS,
+    maxsize=settings.WEBHOOK_QUEUE_SIZE,
+)
+
+metrics.registry.callback("taxi_webhook_queue_depth", "Updates waiting for a worker.",
+                          lambda: update_queue.depth)
+metrics.registry.callback("taxi_webhook_rejected_total", "Updates refused with 503.",
+                          lambda: update_queue.rejected, kind="counter")
+metrics.registry.callback("taxi_webhook_queue_lag_seconds", "Largest enqueue-to-handler delay of the last 1-2 minutes.",
+                          lambda: update_queue.max_lag)
+
 async def tg_webhook(request, token: str):
     if request.method != "POST":
         return HttpResponse(status=405)
 
-    exists = await sync_to_async(
-        lambda: Driver.objects.filter(bot_token=token, active=True).exists(),
-        thread_sensitive=True,
-    )()
-    if not exists:
+    if not await registry.is_valid(token):
         return HttpResponse(status=404)
 
+    return await handle_update(request, get_bot(token, busy=update_queue.holds))
+
+tg_webhook.csrf_exempt = True
+
+async def onboarding_webhook(request):
+    if request.method != "POST":
+        return HttpResponse(status=405)
+
+    # admin checks trust from_user.id, so only Telegram may post here
+    secret = settings.ONBOARDING_WEBHOOK_SECRET
+    given = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not secret or not hmac.compare_digest(given.encode(), secret.encode()):
+        return HttpResponse(status=403)
+
+    return await handle_update(request, onboarding.bot)
+
+onboarding_webhook.csrf_exempt = True
+
+async def handle_update(request, bot):
     try:
         update = types.Update.model_validate_json(request.body.decode())
     except Exception:
         return HttpResponse(status=400)
 
-    dp  = get_dispatcher(token)
-    bot = dp["bot"]
-
-    try:
-        await dp.feed_update(bot, update)
-    except TelegramBadRequest as e:
-        log.warning("Telegram API rejected the handler call: %s", e)
-    except Exception:
-        log.exception("Unexpected error in handler")
+    if not settings.WEBHOOK_ACK_FIRST:
+        await process_update(bot, update)
+    elif not update_queue.put(bot, update):
+        # queue full – let Telegram redeliver later instead of piling up
+        log.warning("Update queue full (%s)", update_queue.stats())
+        return HttpResponse(status=503, headers={"Retry-After": "1"})
 
     return JsonResponse({"ok": True})
 
-tg_webhook.csrf_exempt = True
+async def metrics_view(request):
+    # the public web app only answers scrapers holding the token
+    token = settings.METRICS_TOKEN
+    if not token:
+        return HttpResponse(status=404)
+    given = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(given.encode(), f"Bearer {token}".encode()):
+        return HttpResponse(status=401, headers={"WWW-Authenticate": "Bearer"})
+    return HttpResponse(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("webhook/<str:token>/", tg_webhook, name="tg_webhook"),
+    path("metrics", metrics_view, name="metrics"),
 ]
+
+if onboarding is not None:
+    urlpatterns.append(path("onboarding/webhook/", onboarding_webhook, name="onboarding_webhook"))
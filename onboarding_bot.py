@@ -1,41 +1,59 @@
 #!/usr/bin/env python
+import asyncio
+import datetime
+import html
+import logging
 import os
+import time
+
 import django
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "city_taxi_project.settings")
 django.setup()
 
-import asyncio
-import logging
-import datetime
-from asgiref.sync import sync_to_async
-
-from aiogram import Bot, Dispatcher, Router, types
-from aiogram.filters import CommandStart, Command
+from aiogram import Bot, Dispatcher, types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from telethon import TelegramClient
 from telethon.errors import SessionPasswordNeededError
-from asgiref.sync import sync_to_async
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from django.utils import timezone
 
-import requests
-
 from django.conf import settings
-from taxiapp.models import Driver, Announcement, ActiveUser
+from django.core.exceptions import ImproperlyConfigured
+from taxiapp import repository
+from taxiapp.clientpool import SessionNotAuthorized
+from taxiapp.content import parse as parse_text
+from taxiapp.posting import LocalControl, boot, client_pool, content_cache, fanout, journal, peers, session_store
+from taxiapp.sharding import ShardCoordinator
+from taxiapp.usercache import user_cache
+from taxiapp.logins import LoginManager, LoginCleanupMiddleware, TooManyLogins
+from taxiapp.broadcast import Broadcaster
+from taxiapp.expiry import ExpiryEngine
+from taxiapp.fsmstorage import DbStorage
+from taxiapp.leader import LeaderLock, RelayedControl
+from taxiapp import metrics
+from taxiapp.timingmiddleware import ApiTimingMiddleware, HandlerTimingMiddleware, UpdateTimingMiddleware
+from taxiapp.routing import ButtonRouter
+from taxiapp.tracing import stage
+
+BOOT_STARTED = time.monotonic()     # boot milestones count from here, once imported
 
 # --- Logging setup ---
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
-# Directory for Telethon sessions
-SESSION_DIR = os.path.join(settings.BASE_DIR, "sessions")
-os.makedirs(SESSION_DIR, exist_ok=True)
+# Telethon clients of logins waiting for a code / password
+logins = LoginManager(ttl=settings.LOGIN_TTL, max_pending=settings.LOGIN_MAX_PENDING)
 
-# In-memory store for TelethonClient during login
-_clients: dict[int, TelegramClient] = {}
+# Posting runs here, or in POSTING_WORKERS processes sharded by driver
+posting = ShardCoordinator(settings.POSTING_WORKERS) if settings.POSTING_WORKERS else LocalControl()
+# Webhook mode: one uvicorn worker leads and posts, the others relay to it
+leader = LeaderLock(settings.ONBOARDING_LEADER_LOCK)
+if settings.ONBOARDING_WEBHOOK_URL:
+    posting = RelayedControl(posting, leader, poll_interval=settings.CONTROL_POLL_INTERVAL)
 
 # --- FSM States ---
 
@@ -57,6 +75,9 @@ class SetupStates(StatesGroup):
     text     = State()
     interval = State()
 
+class BroadcastStates(StatesGroup):
+    text = State()
+
 class AdminAddStates(StatesGroup):
     name      = State()
     phone     = State()
@@ -65,8 +86,15 @@ class AdminAddStates(StatesGroup):
 
 # --- Bot & Dispatcher ---
 bot = Bot(token=settings.ONBOARDING_BOT_TOKEN, parse_mode="HTML")
-dp = Dispatcher(storage=MemoryStorage())
-router = Router()
+bot.session.middleware(ApiTimingMiddleware())
+# FSM state in the database when several webhook workers share the conversations
+dp = Dispatcher(storage=DbStorage() if settings.ONBOARDING_FSM_STORAGE == "db" else MemoryStorage())
+dp.update.outer_middleware(UpdateTimingMiddleware("onboarding"))
+# button texts and commands: one dict lookup, then the state handlers
+router = ButtonRouter()
+router.message.middleware(LoginCleanupMiddleware(logins, LoginStates))
+router.message.middleware(HandlerTimingMiddleware("onboarding"))
+router.callback_query.middleware(HandlerTimingMiddleware("onboarding"))
 dp.include_router(router)
 
 # Keyboards
@@ -96,6 +124,7 @@ admin_menu = ReplyKeyboardMarkup(
         ],
         [
             KeyboardButton(text="🔍 Check Driver"),
+            KeyboardButton(text="📣 Broadcast"),
         ],
     ],
     resize_keyboard=True,
@@ -109,13 +138,10 @@ sign_up_kb = ReplyKeyboardMarkup(
 
 # Helper to check active user
 async def is_active_user(user_id: int) -> bool:
-    return await sync_to_async(
-        lambda: ActiveUser.objects.filter(tg_id=user_id, active=True).exists(),
-        thread_sensitive=True
-    )()
+    return await user_cache.is_active(user_id)
 
 # --- Handlers ---
-@router.message(CommandStart())
+@router.command("start")
 async def cmd_start(msg: types.Message, state: FSMContext):
     user_id = msg.from_user.id
 
@@ -128,13 +154,13 @@ async def cmd_start(msg: types.Message, state: FSMContext):
 
     await msg.answer("Welcome! Use the button below.", reply_markup=sign_up_kb)
 
-@router.message(lambda m: m.text == "📝 Sign Up")
+@router.button("📝 Sign Up")
 async def signup_button(msg: types.Message, state: FSMContext):
     await state.clear()
     await msg.answer("Great — first I need your *API ID* (numeric).")
     await state.set_state(OnboardStates.api_id)
 
-@router.message(OnboardStates.api_id)
+@router.state(OnboardStates.api_id)
 async def process_api_id(msg: types.Message, state: FSMContext):
     if not msg.text.isdigit():
         return await msg.answer("❌ API ID must be a number. Please try again.")
@@ -142,7 +168,7 @@ async def process_api_id(msg: types.Message, state: FSMContext):
     await msg.answer("✅ Got it! Now send your *API hash* (the secret string).")
     await state.set_state(OnboardStates.api_hash)
 
-@router.message(OnboardStates.api_hash)
+@router.state(OnboardStates.api_hash)
 async def process_api_hash(msg: types.Message, state: FSMContext):
     api_hash = msg.text.strip()
     data = await state.get_data()
@@ -150,18 +176,8 @@ async def process_api_hash(msg: types.Message, state: FSMContext):
     tg_id  = msg.from_user.id
 
     # try to create or update the Driver row
-    def _upsert_driver():
-        Driver.objects.update_or_create(
-            tg_id=tg_id,
-            defaults={
-                "api_id":   api_id,
-                "api_hash": api_hash,
-                "session":  "-",    # placeholder until /login
-                "active":   True,
-            },
-        )
     try:
-        await sync_to_async(_upsert_driver, thread_sensitive=True)()
+        await repository.upsert_driver(tg_id, api_id, api_hash)
     except Exception as e:
         # If something went wrong, offer the user a chance to delete & retry
         await msg.answer(
@@ -181,7 +197,7 @@ async def process_api_hash(msg: types.Message, state: FSMContext):
 
 
 # Onboarding for Driver (API credentials)
-@router.message(lambda m: m.text == "🔒 Login")
+@router.button("🔒 Login")
 async def cmd_login(msg: types.Message, state: FSMContext):
     if not await is_active_user(msg.from_user.id):
         return await msg.answer("❌ Not active.")
@@ -189,127 +205,191 @@ async def cmd_login(msg: types.Message, state: FSMContext):
     await msg.answer("📱 Send your phone number (with country code):")
     await state.set_state(LoginStates.phone)
 
-@router.message(LoginStates.phone)
+@router.state(LoginStates.phone)
 async def process_phone(msg: types.Message, state: FSMContext):
     phone = msg.text.strip()
-    driver = await sync_to_async(Driver.objects.get)(tg_id=msg.from_user.id)
-    session_file = os.path.join(SESSION_DIR, f"{msg.from_user.id}.session")
-    client = TelegramClient(session_file, driver.api_id, driver.api_hash)
-    await client.connect()
-    await client.send_code_request(phone)
-    _clients[msg.from_user.id] = client
-    await state.update_data(phone=phone)
+    driver = await repository.get_driver(msg.from_user.id)
+    if driver is None:
+        await state.clear()
+        return await msg.answer("ℹ️ Tap 📝 Sign Up first to store your API credentials.")
+    # drop the pooled posting client; it is reconnected with the new session
+    await posting.release(msg.from_user.id)
+    session = await session_store.fresh_session(msg.from_user.id)
+    client = TelegramClient(session, driver.api_id, driver.api_hash)
+    try:
+        await logins.put(msg.from_user.id, client)
+    except TooManyLogins:
+        await state.clear()
+        return await msg.answer("⏳ Too many logins in progress. Please try again in a few minutes.")
+    try:
+        with stage("telethon"):
+            await client.connect()
+            sent = await client.send_code_request(phone)
+    except Exception as e:
+        log.warning("Code request for %s failed: %s", msg.from_user.id, e)
+        await state.clear()
+        return await msg.answer("❌ Could not send the code. Check the number and tap 🔒 Login again.")
+    # with the auth key in the database any webhook worker can take the code
+    await session_store.flush()
+    await state.update_data(phone=phone, phone_code_hash=sent.phone_code_hash, login_at=time.time())
     await msg.answer("✉ Code sent. Enter it:")
     await state.set_state(LoginStates.code)
 
-@router.message(LoginStates.code)
+async def login_client(tg_id: int, data: dict):
+    client = logins.get(tg_id)
+    if client is not None or time.time() - data.get("login_at", 0) > settings.LOGIN_TTL:
+        return client
+    # the code was requested on another webhook worker (or before a
+    # restart): carry on with the session it stored
+    driver = await repository.get_driver(tg_id)
+    if driver is None:
+        return None
+    client = TelegramClient(await session_store.fresh_session(tg_id), driver.api_id, driver.api_hash)
+    try:
+        await logins.put(tg_id, client)
+    except TooManyLogins:
+        return None
+    with stage("telethon"):
+        await client.connect()
+    return client
+
+async def finish_login(tg_id: int):
+    # disconnecting saves the session; write it now so posting picks it up
+    await logins.finish(tg_id)
+    await session_store.flush()
+    await posting.release(tg_id)
+
+@router.state(LoginStates.code)
 async def process_code(msg: types.Message, state: FSMContext):
     data = await state.get_data()
-    client = _clients[msg.from_user.id]
+    client = await login_client(msg.from_user.id, data)
+    if client is None:
+        await state.clear()
+        return await msg.answer("⌛ Login expired. Tap 🔒 Login to start again.")
     try:
-        await client.sign_in(data["phone"], msg.text.strip())
+        with stage("telethon"):
+            await client.sign_in(data["phone"], msg.text.strip(),
+                                 phone_code_hash=data.get("phone_code_hash"))
     except SessionPasswordNeededError:
         await msg.answer("🔒 2FA enabled. Send your password:")
         return await state.set_state(LoginStates.password)
-    await client.disconnect()
+    await finish_login(msg.from_user.id)
     await msg.answer("✅ Logged in. Session saved.", reply_markup=main_menu(True))
     await state.clear()
 
-@router.message(LoginStates.password)
+@router.state(LoginStates.password)
 async def process_password(msg: types.Message, state: FSMContext):
-    client = _clients[msg.from_user.id]
-    await client.sign_in(password=msg.text.strip())
-    await client.disconnect()
+    client = await login_client(msg.from_user.id, await state.get_data())
+    if client is None:
+        await state.clear()
+        return await msg.answer("⌛ Login expired. Tap 🔒 Login to start again.")
+    with stage("telethon"):
+        await client.sign_in(password=msg.text.strip())
+    await finish_login(msg.from_user.id)
     await msg.answer("✅ 2FA passed. You are fully logged in.", reply_markup=main_menu(True))
     await state.clear()
 
-@router.message(lambda msg: msg.text == "⚙️ Setup")
+@router.button("⚙️ Setup")
 async def cmd_setup(msg: types.Message, state: FSMContext):
     await state.clear()
     await msg.answer("➡️ Send group usernames, comma‑separated:")
     await state.set_state(SetupStates.groups)
 
-@router.message(SetupStates.groups)
+@router.state(SetupStates.groups)
 async def process_groups(msg: types.Message, state: FSMContext):
     groups = [g.strip() for g in msg.text.split(",") if g.strip()]
     await state.update_data(groups=groups)
+
+    # resolve usernames once now so posting never has to
+    tg_id = msg.from_user.id
+    driver = await repository.get_driver(tg_id)
+    if driver is not None and await session_store.has_session(tg_id):
+        try:
+            with stage("telethon"):
+                async with client_pool.client(
+                    tg_id, tg_id, driver.api_id, driver.api_hash
+                ) as client:
+                    failed = await peers.resolve(client, tg_id, groups)
+            if failed:
+                await msg.answer(
+                    "⚠️ Could not resolve:\n" + "\n".join(f"• {g}: {err}" for g, err in failed.items())
+                )
+        except SessionNotAuthorized:
+            pass                        # not logged in yet – resolved on first post
+        except (ConnectionError, OSError) as e:
+            log.warning("Group resolution for %s failed: %s", tg_id, e)
+
     await msg.answer("✏️ Now send the broadcast text:")
     await state.set_state(SetupStates.text)
 
-@router.message(SetupStates.text)
+@router.state(SetupStates.text)
 async def process_text(msg: types.Message, state: FSMContext):
+    try:
+        parse_text(msg.text)
+    except ValueError:
+        return await msg.answer("❌ Could not read the formatting. Please send the text again:")
     await state.update_data(text=msg.text)
     await msg.answer("⏱ Finally, interval in minutes:")
     await state.set_state(SetupStates.interval)
 
-@router.message(SetupStates.interval)
+@router.state(SetupStates.interval)
 async def process_interval(msg: types.Message, state: FSMContext):
     if not msg.text.isdigit(): return await msg.answer("Interval must be numeric.")
+    if not await is_active_user(msg.from_user.id):
+        await state.clear()             # expired while setting up
+        return await msg.answer("❌ Not active.")
     data = await state.get_data()
     interval = int(msg.text)
     groups, text = data['groups'], data['text']
     tg_id = msg.from_user.id
-    def _create_ann():
-        Announcement.objects.filter(driver__tg_id=tg_id, active=True).update(active=False)
-        return Announcement.objects.create(
-            driver=Driver.objects.get(tg_id=tg_id),
-            groups=groups,
-            text=text,
-            interval_minutes=interval,
-            active=True
-        )
-    ann = await sync_to_async(_create_ann, thread_sensitive=True)()
+    ann, old_ids = await repository.replace_announcement(tg_id, groups, text, interval)
+    # parse once here; every send reuses it (workers parse on their first send)
+    content_cache.prime(ann.id, ann.updated_at, text)
+    for old_id in old_ids:
+        content_cache.forget(old_id)
+        await posting.stop(old_id, tg_id)
+    await posting.start(ann.id, tg_id)
     await msg.answer(f"✅ Will post every {interval} min to {len(groups)} groups.", reply_markup=main_menu(True))
-    asyncio.create_task(post_loop(ann.id))
     await state.clear()
 
-@router.message(lambda msg: msg.text and msg.text.lower() == "⏹ stop")
+@router.button("⏹ Stop", ignore_case=True)
 async def cmd_stop(msg: types.Message):
     tg_id = msg.from_user.id
-    def _stop():
-        return Announcement.objects.filter(driver__tg_id=tg_id, active=True).update(active=False)
-    cnt = await sync_to_async(_stop, thread_sensitive=True)()
+    ids = await repository.stop_announcements(tg_id)
+    for ann_id in ids:
+        await posting.stop(ann_id, tg_id)
 
     await msg.answer(
-        "🔴 Posting stopped." if cnt else "ℹ️ Nothing active to stop.",
-        reply_markup=main_menu(is_active_user(tg_id))
+        "🔴 Posting stopped." if ids else "ℹ️ Nothing active to stop.",
+        reply_markup=main_menu(False)
     )
 
-@router.message(lambda msg: msg.text and msg.text.lower() == "▶️ start")
+@router.button("▶️ Start", ignore_case=True)
 async def cmd_start_announce(msg: types.Message):
     tg_id = msg.from_user.id
+    if not await is_active_user(tg_id):
+        return await msg.answer("❌ Not active.")
 
-    # Reactivate the existing announcement
-    def _reactivate():
-        # find the most recent inactive announcement
-        return Announcement.objects.filter(
-            driver__tg_id=tg_id, active=False
-        ).update(active=True)
-
-    updated = await sync_to_async(_reactivate, thread_sensitive=True)()
-
-    if updated:
-        # grab its ID so we can restart the loop
-        def _get_ann_id():
-            return Announcement.objects.get(driver__tg_id=tg_id, active=True).id
-        ann_id = await sync_to_async(_get_ann_id, thread_sensitive=True)()
+    # Reactivate the most recent stopped announcement
+    ann_id = await repository.reactivate_latest(tg_id)
 
-        # restart the posting loop
-        asyncio.create_task(post_loop(ann_id))
+    if ann_id:
+        # hand it back to the scheduler
+        await posting.start(ann_id, tg_id)
 
         await msg.answer("▶️ Posting restarted.", reply_markup=main_menu(True))
     else:
         await msg.answer("ℹ️ No stopped announcement to start.", reply_markup=main_menu(False))
 
-@router.message(lambda msg: msg.text == "🗑 Delete")
+@router.button("🗑 Delete")
 async def cmd_delete(msg: types.Message):
     tg_id = msg.from_user.id
-    def _del(): return Driver.objects.filter(tg_id=tg_id).delete()
-    deleted, _ = await sync_to_async(_del, thread_sensitive=True)()
+    deleted = await repository.delete_driver(tg_id)
+    await posting.release(tg_id)
     await msg.answer("🗑 Driver deleted." if deleted else "ℹ️ No driver." , reply_markup=sign_up_kb)
 
 # --- Admin Handlers ---
-@router.message(lambda msg: msg.text == "➕ Add User")
+@router.button("➕ Add User")
 async def admin_add_user(msg: types.Message, state: FSMContext):
     if msg.from_user.id not in settings.ADMIN_IDS:
         return
@@ -317,85 +397,103 @@ async def admin_add_user(msg: types.Message, state: FSMContext):
     await msg.answer("👤 Enter new user’s name:")
     await state.set_state(AdminAddStates.name)
 
-@router.message(AdminAddStates.name)
+@router.state(AdminAddStates.name)
 async def admin_add_name(msg: types.Message, state: FSMContext):
     await state.update_data(name=msg.text.strip())
     await msg.answer("📱 Enter phone (e.g. +123456789):")
     await state.set_state(AdminAddStates.phone)
 
-@router.message(AdminAddStates.phone)
+@router.state(AdminAddStates.phone)
 async def admin_add_phone(msg: types.Message, state: FSMContext):
     await state.update_data(phone=msg.text.strip())
     await msg.answer("🔢 Enter Telegram ID (numeric):")
     await state.set_state(AdminAddStates.tg_id)
 
-@router.message(AdminAddStates.tg_id)
+@router.state(AdminAddStates.tg_id)
 async def admin_add_tg(msg: types.Message, state: FSMContext):
     await state.update_data(tg_id=int(msg.text.strip()))
     await msg.answer("⏳ Enter duration in days:")
     await state.set_state(AdminAddStates.duration)
 
-@router.message(AdminAddStates.duration)
+@router.state(AdminAddStates.duration)
 async def admin_add_duration(msg: types.Message, state: FSMContext):
     data = await state.get_data()
     days = int(msg.text.strip())
     now = timezone.now()
     expires = now + datetime.timedelta(days=days)
-    def _create():
-        ActiveUser.objects.update_or_create(
-            tg_id=data['tg_id'],
-            defaults={
-                'name': data['name'],
-                'phone': data['phone'],
-                'activated_at': now,
-                'expires_at': expires,
-                'active': True
-            }
-        )
-    await sync_to_async(_create, thread_sensitive=True)()
+    await repository.activate_user(data['tg_id'], data['name'], data['phone'], now, expires)
+    user_cache.set(data['tg_id'], True, expires)
+    expiry.notify(expires)
     await msg.answer(f"✅ User {data['name']} activated until {expires.date()}", reply_markup=admin_menu)
     await state.clear()
 
-@router.message(lambda msg: msg.text == "📋 List Users")
+USERS_PAGE_SIZE = 20
+USER_FILTER_LABELS = {"all": "All", "active": "Active", "expired": "Expired", "soon": "Expiring soon"}
+
+async def users_page_view(flt: str, after: int | None = None, before: int | None = None):
+    rows, has_prev, has_next = await repository.users_page(flt, after, before, USERS_PAGE_SIZE)
+    now = timezone.now()
+    lines = [
+        f"{u['name']} ({u['tg_id']}): "
+        f"{'Active' if u['active'] and u['expires_at'] > now else 'Inactive'} until {u['expires_at'].date()}"
+        for u in rows
+    ]
+    text = f"📋 Users — {USER_FILTER_LABELS[flt]}:\n" + ("\n".join(lines) or "—")
+    filters = [
+        InlineKeyboardButton(text=("• " if f == flt else "") + label, callback_data=f"users:{f}:n:0")
+        for f, label in USER_FILTER_LABELS.items()
+    ]
+    nav = []
+    if has_prev and rows:
+        nav.append(InlineKeyboardButton(text="◀️ Prev", callback_data=f"users:{flt}:p:{rows[0]['id']}"))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton(text="Next ▶️", callback_data=f"users:{flt}:n:{rows[-1]['id']}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[filters[:2], filters[2:]] + ([nav] if nav else []))
+    return text, kb
+
+@router.button("📋 List Users")
 async def admin_list(msg: types.Message):
     if msg.from_user.id not in settings.ADMIN_IDS:
         return
 
-    # wrap the ORM call in sync_to_async
-    @sync_to_async(thread_sensitive=True)
-    def _fetch_users():
-        return list(ActiveUser.objects.all())
+    text, kb = await users_page_view("all")
+    await msg.answer(text, reply_markup=kb)
 
-    users = await _fetch_users()
-    lines = [
-        f"{u.name} ({u.tg_id}): {'Active' if u.active else 'Inactive'} until {u.expires_at.date()}"
-        for u in users
-    ]
-    await msg.answer("📋 Users:\n" + "\n".join(lines), reply_markup=admin_menu)
+@router.callback("users")
+async def cb_users_page(cb: types.CallbackQuery):
+    if cb.from_user.id not in settings.ADMIN_IDS:
+        return await cb.answer("No access.", show_alert=True)
+    _, flt, direction, cursor = cb.data.split(":")
+    if flt not in USER_FILTER_LABELS:
+        return await cb.answer()
+    cursor = int(cursor)
+    if direction == "p":
+        text, kb = await users_page_view(flt, before=cursor)
+    else:
+        text, kb = await users_page_view(flt, after=cursor or None)
+    try:
+        await cb.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass                            # same page tapped again – nothing changed
+    await cb.answer()
 
-@router.message(lambda m: m.text == "🔍 Check Driver")
+@router.button("🔍 Check Driver")
 async def ask_for_driver_id(msg: types.Message, state: FSMContext):
     if msg.from_user.id not in settings.ADMIN_IDS:
         return await msg.answer("❌ Forbidden.")
     await state.set_state(AdminStates.search_id)
     await msg.answer("🔎 Please send the *Telegram ID* of the driver you want to inspect.", parse_mode="Markdown")
 
-@router.message(AdminStates.search_id)
+@router.state(AdminStates.search_id)
 async def process_search_id(msg: types.Message, state: FSMContext):
     text = msg.text.strip()
     if not text.isdigit():
         return await msg.answer("❌ ID must be a number. Try again.")
 
     tg_id = int(text)
-    # fetch driver in thread
-    @sync_to_async(thread_sensitive=True)
-    def _get_driver():
-        return ActiveUser.objects.get(tg_id=tg_id)
-
-    try:
-        d = await _get_driver()
-    except ActiveUser.DoesNotExist:
-        await msg.answer("⚠️ No such driver.", reply_markup=admin_menu())
+    d = await repository.get_user(tg_id=tg_id)
+    if d is None:
+        await msg.answer("⚠️ No such driver.", reply_markup=admin_menu)
         await state.clear()
         return
 
@@ -408,93 +506,314 @@ async def process_search_id(msg: types.Message, state: FSMContext):
     buttons = []
     if not d.active:
         pass
-    buttons.append([InlineKeyboardButton(text="⏩ Extend +30 days", callback_data=f"extend:{d.tg_id}")])
+    buttons.append([InlineKeyboardButton(text="⏩ Extend +30 days", callback_data=f"extend:{d.id}")])
+    buttons.append([InlineKeyboardButton(text="📜 Deliveries", callback_data=f"history:{d.tg_id}")])
 
     kb = InlineKeyboardMarkup(inline_keyboard=buttons, row_width=2)
 
     await msg.answer(detail, parse_mode="Markdown", reply_markup=kb)
     await state.clear()
-# Expiration check task
-def schedule_expiry_notifications():
-    scheduler = AsyncIOScheduler()
-    async def check_and_notify():
-        now = timezone.now()
-        expired = ActiveUser.objects.filter(active=True, expires_at__lte=now)
-        for u in expired:
-            kb = InlineKeyboardMarkup().row(
-                InlineKeyboardButton(text="Extend", callback_data=f"extend:{u.id}"),
-                InlineKeyboardButton(text="Deactivate", callback_data=f"deact:{u.id}")
-            )
-            text = f"⚠️ User {u.name} (ID {u.tg_id}) expired on {u.expires_at.date()}"
-            for admin in settings.ADMIN_IDS:
+# Delivery history from the journal
+STATUS_ICONS = {"sent": "✅", "failed": "❌", "flood": "⏳", "skipped": "⏭"}
+
+async def delivery_history(tg_id: int) -> str:
+    rows = await repository.recent_deliveries(tg_id, limit=20)
+    if not rows:
+        return "📜 No deliveries recorded yet."
+    lines = []
+    for r in rows:
+        detail = f"{r.latency_ms} ms" if r.status == "sent" else r.error
+        lines.append(
+            f"{STATUS_ICONS.get(r.status, '•')} {r.sent_at:%m-%d %H:%M} {html.escape(r.group)} — {detail}"
+        )
+    return f"📜 Last {len(rows)} deliveries (ID {tg_id}):\n" + "\n".join(lines)
+
+@router.command("history")
+async def cmd_history(msg: types.Message, command: CommandObject):
+    user_id = msg.from_user.id
+    target = user_id
+    if user_id in settings.ADMIN_IDS and command.args:
+        if not command.args.strip().isdigit():
+            return await msg.answer("Usage: /history [telegram id]")
+        target = int(command.args.strip())
+    elif not await is_active_user(user_id):
+        return await msg.answer("❌ Not active.")
+    await msg.answer(await delivery_history(target))
+
+@router.callback("history")
+async def cb_history(cb: types.CallbackQuery):
+    if cb.from_user.id not in settings.ADMIN_IDS:
+        return await cb.answer("Forbidden", show_alert=True)
+    await cb.answer()
+    await cb.message.answer(await delivery_history(int(cb.data.split(":", 1)[1])))
+
+
+# Expiration: deactivate on time, then one digest per admin
+DIGEST_PAGE_SIZE = 20
+
+def expiry_digest(users: list[dict]) -> list[tuple[str, InlineKeyboardMarkup]]:
+    pages = [users[i:i + DIGEST_PAGE_SIZE] for i in range(0, len(users), DIGEST_PAGE_SIZE)]
+    out = []
+    for n, page in enumerate(pages, 1):
+        lines = [f"• {u['name']} (ID {u['tg_id']}) — {u['expires_at'].date()}" for u in page]
+        text = f"⚠️ {len(users)} user(s) expired and were deactivated ({n}/{len(pages)}):\n" + "\n".join(lines)
+        buttons = [
+            InlineKeyboardButton(text=f"⏩ {u['name'][:20]}", callback_data=f"extend:{u['id']}")
+            for u in page
+        ]
+        kb = InlineKeyboardMarkup(inline_keyboard=[buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+        out.append((text, kb))
+    return out
+
+async def on_users_expired(users: list[dict], ann_ids: list[int]):
+    for ann_id in ann_ids:
+        await posting.stop(ann_id)
+    for u in users:
+        user_cache.set(u['tg_id'], False, u['expires_at'])
+    for text, kb in expiry_digest(users):
+        for admin in settings.ADMIN_IDS:
+            try:
                 await bot.send_message(admin, text, reply_markup=kb)
-    scheduler.add_job(check_and_notify, 'cron', day=1, hour=0, minute=0)
-    scheduler.start()
+            except Exception as e:
+                log.warning("Expiry digest to %s failed: %s", admin, e)
+
+# a follower webhook worker can't wake the leader's engine, so it re-reads often
+expiry = ExpiryEngine(on_users_expired, max_sleep=60 if settings.ONBOARDING_WEBHOOK_URL else 3600)
+
+# --- Broadcast ---
+def broadcast_stop_kb(broadcast_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="⏹ Stop broadcast", callback_data=f"bcast:stop:{broadcast_id}"),
+    ]])
+
+async def broadcast_progress(b: dict, final: bool):
+    icon = "📣" if not final else "✅" if b["status"] == "done" else "⏹"
+    text = (f"{icon} Broadcast #{b['id']}: {b['delivered'] + b['failed']}/{b['total']} "
+            f"({b['delivered']} delivered, {b['failed']} failed)")
+    if b["progress_message_id"] is not None:
+        try:
+            await bot.edit_message_text(
+                text, chat_id=b["admin_id"], message_id=b["progress_message_id"],
+                reply_markup=None if final else broadcast_stop_kb(b["id"]))
+        except TelegramBadRequest:
+            pass                        # message gone or unchanged
+    if final:
+        # a new message, so the summary notifies the admin
+        await bot.send_message(b["admin_id"], f"{text} — {b['status']}")
+
+# Sent by the process running expiry; a follower webhook worker's notify
+# doesn't reach it, hence the short re-read there
+broadcaster = Broadcaster(
+    lambda tg_id, text: bot.send_message(tg_id, text),
+    broadcast_progress,
+    rate=settings.BROADCAST_RATE,
+    concurrency=settings.BROADCAST_CONCURRENCY,
+    chunk_size=settings.BROADCAST_CHUNK,
+    max_retries=settings.BROADCAST_MAX_RETRIES,
+    progress_interval=settings.BROADCAST_PROGRESS_INTERVAL,
+    max_sleep=5 if settings.ONBOARDING_WEBHOOK_URL else 3600,
+)
 
-@router.callback_query(lambda c: c.data and c.data.startswith(('extend:','deact:')))
+@router.button("📣 Broadcast")
+async def admin_broadcast(msg: types.Message, state: FSMContext):
+    if msg.from_user.id not in settings.ADMIN_IDS:
+        return
+    await state.clear()
+    await msg.answer("📣 Send the message for every active user:")
+    await state.set_state(BroadcastStates.text)
+
+@router.state(BroadcastStates.text)
+async def admin_broadcast_text(msg: types.Message, state: FSMContext):
+    if not msg.text:
+        return await msg.answer("❌ Text only, please. Send the message again:")
+    total = await repository.count_recipients()
+    await state.update_data(text=msg.html_text)
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=f"✅ Send to {total} users", callback_data="bcast:go"),
+        InlineKeyboardButton(text="✖️ Cancel", callback_data="bcast:no"),
+    ]])
+    await msg.answer(msg.html_text, reply_markup=kb)
+    await state.set_state(None)
+
+@router.callback("bcast")
+async def cb_broadcast(cb: types.CallbackQuery, state: FSMContext):
+    if cb.from_user.id not in settings.ADMIN_IDS:
+        return await cb.answer("No access.", show_alert=True)
+    if cb.data.startswith("bcast:stop:"):
+        stopped = await repository.cancel_broadcast(int(cb.data.split(":")[2]))
+        return await cb.answer("⏹ Stopping…" if stopped else "Already finished.")
+    text = (await state.get_data()).get("text")
+    await state.clear()
+    await cb.message.edit_reply_markup(reply_markup=None)
+    if cb.data != "bcast:go" or text is None:
+        return await cb.answer("Broadcast cancelled.")
+    total = await repository.count_recipients()
+    progress = await cb.message.answer(f"📣 Broadcast queued for {total} users…")
+    b = await repository.create_broadcast(text, cb.from_user.id, total, progress.message_id)
+    await progress.edit_reply_markup(reply_markup=broadcast_stop_kb(b.id))
+    broadcaster.notify()
+    await cb.answer()
+
+@router.callback("extend", "deact")
 async def cb_manage_user(cb: types.CallbackQuery):
     if cb.from_user.id not in settings.ADMIN_IDS:
         return await cb.answer("No access.", show_alert=True)
     action, uid = cb.data.split(':')
-    u = await sync_to_async(ActiveUser.objects.get)(id=int(uid))
+    u = await repository.get_user(id=int(uid))
+    if u is None:
+        return await cb.answer("User not found.", show_alert=True)
     if action == 'extend':
-        u.expires_at += datetime.timedelta(days=30)
-        u.save()
+        # an already expired user gets 30 days from now and access back
+        u.expires_at = max(u.expires_at, timezone.now()) + datetime.timedelta(days=30)
+        u.active = True
+        await repository.update_user(u.id, expires_at=u.expires_at, active=True)
+        user_cache.set(u.tg_id, True, u.expires_at)
+        expiry.notify(u.expires_at)
         await cb.message.edit_text(f"✅ Extended {u.name} until {u.expires_at.date()}")
     else:
         u.active = False
-        u.save()
+        await repository.update_user(u.id, active=False)
+        user_cache.set(u.tg_id, False, u.expires_at)
         await cb.message.edit_text(f"❌ Deactivated {u.name}")
 
-
-
-def _get_data(ann_id: int):
-    ann = (Announcement.objects
-           .select_related("driver")
-           .get(id=ann_id))
-    driver = ann.driver
-    session_path = os.path.join(SESSION_DIR, f"{driver.tg_id}.session")
-    return {
-        "session_path": session_path,
-        "api_id":       driver.api_id,
-        "api_hash":     driver.api_hash,
-        "groups":       ann.groups,
-        "text":         ann.text,
-        "interval":     ann.interval_minutes,
-        "active":       ann.active,
-    }
-
-# Posting loop (unchanged)--> omitted for brevity
-async def post_loop(ann_id: int):
-    data = await sync_to_async(_get_data, thread_sensitive=True)(ann_id)
-    if not data["active"]:
+@router.command("stats")
+async def admin_stats(msg: types.Message):
+    if msg.from_user.id not in settings.ADMIN_IDS:
         return
-
-    os.makedirs(os.path.dirname(data["session_path"]), exist_ok=True)
-    client = TelegramClient(
-        data["session_path"],
-        data["api_id"],
-        data["api_hash"],
+    st = client_pool.stats()
+    uc = user_cache.stats()
+    lg = logins.stats()
+    jn = journal.stats()
+    ss = session_store.stats()
+    shards = posting.control if isinstance(posting, RelayedControl) else posting
+    workers = (
+        f"\n• Posting workers: {len(shards.ring.nodes)} live, {shards.respawns} respawns"
+        if isinstance(shards, ShardCoordinator) else ""
+    )
+    if isinstance(posting, RelayedControl):
+        # the numbers above are this worker's; the leader runs posting
+        workers += (f"\n• Webhook worker {os.getpid()}: "
+                    + (f"leader, {posting.relayed} commands relayed" if leader.held else "follower"))
+    await msg.answer(
+        "📊 Telethon pool\n"
+        f"• Clients: {st['size']} ({st['in_use']} busy)\n"
+        f"• Hits / misses: {st['hits']} / {st['misses']} ({st['hit_ratio']:.0%})\n"
+        f"• Reconnects: {st['reconnects']}\n"
+        f"• Evictions: {st['evictions']}\n"
+        f"• Throttled sends: {fanout.throttled_total} ({fanout.flood_waits} FloodWaits)\n"
+        f"• Active-user cache: {uc['size']} entries, {uc['hit_ratio']:.0%} hits\n"
+        f"• Pending logins: {lg['pending']} ({lg['expired']} expired, {lg['rejected']} rejected)"
+        f"\n• Journal: {jn['written']} written, {jn['buffered']} buffered, {jn['pruned']} pruned"
+        f"\n• Sessions: {ss['sessions']} loaded, {ss['written']} written, {ss['pending']} pending"
+        + workers
     )
-    await client.start()
 
-    for grp in data["groups"]:
-        try:
-            await client.send_message(grp, data["text"])
-        except Exception as e:
-            log.error("Telethon post to %s failed: %s", grp, e)
 
-    await client.disconnect()
-    await asyncio.sleep(data["interval"] * 60)
-    # schedule next iteration:
-    if data["active"]:
-        asyncio.create_task(post_loop(ann_id))
+
+metrics.registry.callback("taxi_logins_pending", "Telethon logins waiting for a code.",
+                          lambda: logins.stats()["pending"])
+metrics.registry.callback("taxi_user_cache_entries", "Cached ActiveUser statuses.",
+                          lambda: user_cache.stats()["size"])
+
 
 # --- Main ---
+_tasks: dict[str, asyncio.Task] = {}
+_exporter = None
+
+async def start_services():
+    # posting, expiry and the exporter run in one process only
+    global _exporter
+    # resume posting first; nothing in it waits on the bot
+    await posting.open()
+    if settings.METRICS_PORT:
+        _exporter = await metrics.serve(settings.METRICS_HOST, settings.METRICS_PORT)
+    _tasks["expiry"] = asyncio.create_task(expiry.run())
+    _tasks["broadcast"] = asyncio.create_task(broadcaster.run())
+    if isinstance(posting, RelayedControl):
+        _tasks["relay"] = asyncio.create_task(posting.run())
+
+async def stop_services():
+    global _exporter
+    if "broadcast" in _tasks:
+        await broadcaster.stop(_tasks.pop("broadcast"), settings.SHUTDOWN_DRAIN_SECONDS)
+    for name in ("expiry", "relay"):
+        if name in _tasks:
+            _tasks.pop(name).cancel()
+    await posting.close()
+    if _exporter is not None:
+        await _exporter.cleanup()
+        _exporter = None
+
+def start_worker_tasks():
+    _tasks["sweeper"] = asyncio.create_task(logins.run_sweeper())
+    _tasks["sessions"] = asyncio.create_task(session_store.run())
+
 async def main():
+    if settings.ONBOARDING_WEBHOOK_URL:
+        raise SystemExit("ONBOARDING_WEBHOOK_URL is set: updates go to the ASGI app "
+                         "(uvicorn city_taxi_project.asgi:application), not to polling")
+    boot.started = BOOT_STARTED
+    await start_services()
     await bot.delete_webhook(drop_pending_updates=True)
-    schedule_expiry_notifications()
-    await dp.start_polling(bot)
+    start_worker_tasks()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        _tasks.pop("sweeper").cancel()
+        await logins.close_all()
+        await stop_services()
+        _tasks.pop("sessions").cancel()
+        await session_store.close()
+
+# --- Webhook mode (ASGI lifespan of every uvicorn worker) ---
+async def lead():
+    # followers keep trying, so another worker takes over if the leader exits
+    while True:
+        while not leader.try_acquire():
+            await asyncio.sleep(5)
+        log.info("Webhook worker %d leads: posting and expiry run here", os.getpid())
+        try:
+            await start_services()
+            break
+        except Exception:
+            log.exception("Starting the leader's services failed; giving up the lead")
+        # undo what did start, then let any worker (this one included) retry
+        try:
+            await stop_services()
+        except Exception:
+            log.exception("Stopping the half-started services failed")
+        leader.release()
+        await asyncio.sleep(5)
+    try:
+        await bot.set_webhook(
+            settings.ONBOARDING_WEBHOOK_URL,
+            secret_token=settings.ONBOARDING_WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    except Exception:
+        log.exception("Setting the onboarding webhook failed; updates may not arrive")
+
+async def start_webhook():
+    if not settings.ONBOARDING_WEBHOOK_SECRET:
+        # without it anyone could post updates "from" an admin
+        raise ImproperlyConfigured("ONBOARDING_WEBHOOK_URL needs ONBOARDING_WEBHOOK_SECRET")
+    boot.started = BOOT_STARTED
+    start_worker_tasks()
+    _tasks["lead"] = asyncio.create_task(lead())
+
+async def stop_webhook():
+    lead_task = _tasks.pop("lead")
+    lead_task.cancel()
+    await asyncio.gather(lead_task, return_exceptions=True)
+    _tasks.pop("sweeper").cancel()
+    await logins.close_all()
+    if "expiry" in _tasks:
+        # the webhook stays set: the next leader serves it
+        await stop_services()
+    leader.release()
+    _tasks.pop("sessions").cancel()
+    await session_store.close()
+    await bot.session.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,3 +1,33 @@
+# taxiapp/admin.py
+from aiogram.exceptions import TelegramAPIError
+from aiogram.utils.token import TokenValidationError
+from asgiref.sync import async_to_sync
+from django import forms
 from django.contrib import admin
 
-# Register your models here.
+from taxiapp.botpool import install_webhook
+from taxiapp.models import DriverBot
+
+
+class DriverBotForm(forms.ModelForm):
+    class Meta:
+        model = DriverBot
+        fields = ("driver", "token", "active")
+
+    def clean_token(self):
+        # a new or changed token must work before it is stored
+        token = self.cleaned_data["token"]
+        if "token" in self.changed_data:
+            try:
+                async_to_sync(install_webhook)(token)
+            except (TokenValidationError, TelegramAPIError) as e:
+                raise forms.ValidationError(f"Telegram rejected the token: {e}")
+        return token
+
+
+@admin.register(DriverBot)
+class DriverBotAdmin(admin.ModelAdmin):
+    form = DriverBotForm
+    list_display = ("__str__", "driver", "active", "created")
+    list_filter = ("active",)
+    raw_id_fields = ("driver",)
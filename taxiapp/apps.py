@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class TaxiappConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "taxiapp"
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from taxiapp import tokens  # noqa: F401  (connects the registry signals)
+        from taxiapp.tracing import install_db_timing
+
+        connection_created.connect(install_db_timing, dispatch_uid="taxiapp.metrics")
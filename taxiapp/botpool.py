@@ -1,31 +1,103 @@
 # taxiapp/botpool.py
+import asyncio
 import logging
-from aiogram import Bot, Dispatcher, Router, types
-from aiogram.filters import CommandStart, Command
+from collections import OrderedDict
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.fsm.storage.memory import MemoryStorage
+from django.conf import settings
+from django.urls import reverse
+
+from taxiapp.routing import ButtonRouter
+from taxiapp.timingmiddleware import ApiTimingMiddleware, HandlerTimingMiddleware, UpdateTimingMiddleware
+from taxiapp.tokens import registry
 
 log = logging.getLogger(__name__)
-bots: dict[str, Dispatcher] = {}          # token → Dispatcher (cache)
 
-router = Router()
+# One Dispatcher serves every driver bot; FSM keys already include the bot id
+dp = Dispatcher(storage=MemoryStorage())
+bots: OrderedDict[str, Bot] = OrderedDict()   # token → Bot (LRU)
+_closing: set[asyncio.Task] = set()
+_loop: asyncio.AbstractEventLoop | None = None  # the loop serving the webhook
+
+dp.update.outer_middleware(UpdateTimingMiddleware("driver"))
 
-@router.message(CommandStart())
+router = ButtonRouter()
+router.message.middleware(HandlerTimingMiddleware("driver"))
+dp.include_router(router)
+
+@router.command("start")
 async def cmd_start(msg: types.Message):
     await msg.answer("👋 I’m your city‑to‑city taxi helper bot!")
 
-@router.message(Command("help"))
+@router.command("help")
 async def cmd_help(msg: types.Message):
     await msg.answer("Use /start to begin.\nSoon: /status, /pause …")
 
-def get_dispatcher(token: str) -> Dispatcher:
-    if token in bots:
-        return bots[token]
+def _close(token: str, bot: Bot):
+    # release the aiohttp session (sockets) of a bot we no longer serve;
+    # runs on the serving loop, which owns the session
+    task = _loop.create_task(bot.session.close())
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+    log.info("Bot closed for %s", token[:10])
+
+def get_bot(token: str, busy=None) -> Bot:
+    """
+    The pooled Bot for ``token``. Least recently used bots are closed past
+    BOTPOOL_MAX_BOTS, except those ``busy(bot)`` says still have work (their
+    session would be silently re-created and leak).
+    """
+    global _loop
+    _loop = asyncio.get_running_loop()
+    bot = bots.get(token)
+    if bot is not None:
+        bots.move_to_end(token)
+        return bot
 
     bot = Bot(token, parse_mode="HTML")
-    dp  = Dispatcher()
-    dp.include_router(router)
+    bot.session.middleware(ApiTimingMiddleware())
+    bots[token] = bot
+    while len(bots) > settings.BOTPOOL_MAX_BOTS:
+        victim = next((t for t, b in bots.items() if t != token and not (busy and busy(b))), None)
+        if victim is None:
+            break                       # all busy: run over the cap until they finish
+        _close(victim, bots.pop(victim))
+    log.info("Bot created for %s", token[:10])
+    return bot
+
+async def install_webhook(token: str) -> types.User:
+    """
+    Check a driver bot's token with getMe and point its webhook at
+    tg_webhook. Raises TokenValidationError for a malformed token and
+    TelegramAPIError when Telegram rejects it.
+    """
+    bot = Bot(token)
+    try:
+        me = await bot.get_me()
+        await bot.set_webhook(settings.WEBHOOK_BASE_URL + reverse("tg_webhook", args=[token]),
+                              allowed_updates=dp.resolve_used_update_types())
+        return me
+    finally:
+        await bot.session.close()
 
-    dp["bot"] = bot          # ← ADD THIS LINE (store bot reference)
+def drop_bot(token: str):
+    # called from registry loads in a worker thread and from model signals
+    # (admin, register_bot), which have no loop: hand it to the serving one
+    if _loop is None:
+        bots.pop(token, None)           # nothing served yet, no session opened
+        return
+    try:
+        on_loop = asyncio.get_running_loop() is _loop
+    except RuntimeError:
+        on_loop = False
+    if not on_loop:
+        if not _loop.is_closed():
+            _loop.call_soon_threadsafe(drop_bot, token)
+        return
+    bot = bots.pop(token, None)
+    if bot is not None:
+        _close(token, bot)
 
-    bots[token] = dp
-    log.info("Dispatcher created for %s", token[:10])
-    return dp
+# revoked tokens give their session back right away
+registry.subscribe(lambda token, valid: valid or drop_bot(token))
@@ -0,0 +1,157 @@
+# taxiapp/broadcast.py
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+    TelegramServerError,
+)
+from django.utils import timezone
+
+from taxiapp import repository
+from taxiapp.fanout import TokenBucket
+
+log = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """
+    Sends queued Broadcast rows, oldest first, to every active user.
+
+    Recipients are read in id order, ``chunk_size`` at a time; sends share
+    one ``rate``/s token bucket with ``concurrency`` in flight. A 429 holds
+    every send for its retry_after; it and network errors are retried with
+    exponential backoff up to ``max_retries`` times. The cursor and counters
+    are saved after each chunk, so a restarted process resumes the broadcast
+    where it stopped. ``on_progress(row, final)`` reports at most every
+    ``progress_interval`` seconds, and once at the end.
+    """
+
+    def __init__(self, send, on_progress, rate: float = 25, concurrency: int = 8,
+                 chunk_size: int = 200, max_retries: int = 3, backoff: float = 1,
+                 progress_interval: float = 10, max_sleep: float = 3600):
+        self._send = send                   # async (tg_id, text)
+        self._on_progress = on_progress     # async (broadcast row, final)
+        self._bucket = TokenBucket(rate, 1)     # no burst: the Bot API counts per second
+        self._slots = asyncio.Semaphore(concurrency)
+        self._chunk_size = chunk_size
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._progress_interval = progress_interval
+        self._max_sleep = max_sleep
+        self._hold_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self.sent = 0
+        self.throttled = 0
+        self.retries = 0
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def run(self):
+        # re-reads at least every max_sleep seconds to see other processes' broadcasts
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                row = await repository.next_broadcast()
+                if row is not None:
+                    await self.deliver(row)
+                    continue
+            except Exception:
+                log.exception("Broadcast failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._max_sleep)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self, task: asyncio.Task, timeout: float):
+        # sends in flight finish and are checkpointed; nothing new starts
+        self._stopping = True
+        self._wakeup.set()
+        done, _ = await asyncio.wait({task}, timeout=timeout)
+        if not done:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self._stopping = False          # so run() can be started again
+
+    async def deliver(self, row: dict) -> str:
+        log.info("Broadcast %s: sending after user id %s", row["id"], row["cursor"])
+        reported = time.monotonic()
+        while not self._stopping:
+            if await repository.broadcast_status(row["id"]) != "running":
+                row["status"] = "cancelled"
+                break
+            chunk = await repository.broadcast_recipients(row["cursor"], self._chunk_size)
+            if not chunk:
+                row["status"], row["finished_at"] = "done", timezone.now()
+                await repository.update_broadcast(row["id"], status="done",
+                                                  finished_at=row["finished_at"])
+                break
+            await self._send_chunk(row, chunk)
+            if time.monotonic() - reported >= self._progress_interval:
+                reported = time.monotonic()
+                await self._report(row, final=False)
+        if row["status"] != "running":
+            log.info("Broadcast %s %s: %d delivered, %d failed",
+                     row["id"], row["status"], row["delivered"], row["failed"])
+            await self._report(row, final=True)
+        return row["status"]
+
+    async def _send_chunk(self, row: dict, chunk: list[tuple[int, int]]):
+        results: dict[int, bool] = {}
+
+        async def one(user_id: int, tg_id: int):
+            async with self._slots:
+                outcome = await self._deliver_one(tg_id, row["text"])
+            if outcome is not None:
+                results[user_id] = outcome
+
+        try:
+            await asyncio.gather(*(one(*r) for r in chunk))
+        finally:
+            # the cursor only moves past recipients handled in order; when
+            # stopped mid-chunk the rest get the message after the restart
+            for user_id, _ in chunk:
+                if user_id not in results:
+                    break
+                row["cursor"] = user_id
+                row["delivered" if results[user_id] else "failed"] += 1
+            await repository.update_broadcast(
+                row["id"], cursor=row["cursor"], delivered=row["delivered"], failed=row["failed"])
+
+    async def _deliver_one(self, tg_id: int, text: str) -> bool | None:
+        """True if sent, False if it can't be, None if stopped before it was."""
+        for attempt in range(self._max_retries + 1):
+            hold = self._hold_until - time.monotonic()
+            if hold > 0:
+                await asyncio.sleep(hold)
+            if self._stopping:
+                return None
+            await self._bucket.acquire()
+            try:
+                await self._send(tg_id, text)
+                self.sent += 1
+                return True
+            except TelegramRetryAfter as e:
+                # flood limits are per bot: every send waits it out
+                self.throttled += 1
+                self._hold_until = max(self._hold_until, time.monotonic() + e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                log.warning("Broadcast to %s failed (attempt %d): %s", tg_id, attempt + 1, e)
+            except (TelegramForbiddenError, TelegramBadRequest):
+                return False            # blocked the bot, never started it, account gone …
+            if attempt < self._max_retries:
+                self.retries += 1
+                await asyncio.sleep(self._backoff * 2 ** attempt)
+        return False
+
+    async def _report(self, row: dict, final: bool):
+        try:
+            await self._on_progress(row, final)
+        except Exception as e:
+            log.warning("Broadcast %s progress report failed: %s", row["id"], e)
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "throttled": self.throttled, "retries": self.retries}
@@ -0,0 +1,201 @@
+# taxiapp/clientpool.py
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from taxiapp.fanout import TokenBucket
+
+log = logging.getLogger(__name__)
+
+
+class SessionNotAuthorized(Exception):
+    """The stored Telethon session has no logged-in account behind it."""
+
+
+class PoolDraining(Exception):
+    """No new connections are made while the pool drains."""
+
+
+class _Entry:
+    __slots__ = ("client", "last_used", "users")
+
+    def __init__(self, client):
+        self.client = client
+        self.last_used = time.monotonic()
+        self.users = 0
+
+
+class ClientPool:
+    """
+    Keeps one connected Telethon client per driver session and hands it out
+    again on the next posting cycle instead of doing a fresh handshake.
+
+    Idle clients are dropped after ``idle_timeout`` seconds and the least
+    recently used idle client is evicted once ``max_size`` is reached.
+    New connections are ramped up at ``connect_rate`` per second with at
+    most ``connect_concurrency`` handshakes in flight (0 = unlimited), so a
+    restart or a network blip doesn't reconnect every account at once.
+
+    After ``drain()`` connected clients are still handed out, but pending
+    and new handshakes raise PoolDraining until ``resume()``.
+    """
+
+    def __init__(self, factory, max_size: int = 200, idle_timeout: float = 1800,
+                 connect_rate: float = 0, connect_concurrency: int = 0):
+        self._factory = factory                 # (*args) → unconnected client
+        self.max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._connect_bucket = (TokenBucket(connect_rate, max(1, int(connect_rate)))
+                                if connect_rate else None)
+        self._connect_slots = asyncio.Semaphore(connect_concurrency) if connect_concurrency else None
+        self._entries: OrderedDict[object, _Entry] = OrderedDict()
+        self._locks: dict[object, asyncio.Lock] = {}
+        self._draining = asyncio.Event()
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        return entry.client if entry is not None else None
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @asynccontextmanager
+    async def client(self, key, *args):
+        entry = await self._acquire(key, *args)
+        broken = False
+        try:
+            yield entry.client
+        except (ConnectionError, OSError):
+            broken = True
+            raise
+        finally:
+            # whatever ended the use (cancellation, FloodWait, a DB error …)
+            # the client is handed back
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+            if broken:
+                # broken transport – drop it so the next cycle starts clean
+                await self.discard(key)
+
+    async def _acquire(self, key, *args) -> _Entry:
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                if not entry.client.is_connected():
+                    self.reconnects += 1
+                    log.info("Reconnecting Telethon client %s", key)
+                    async with self._connect_slot():
+                        await entry.client.connect()
+            else:
+                self.misses += 1
+                await self.evict_idle()
+                entry = _Entry(await self._connect(*args))
+                self._entries[key] = entry
+            entry.users += 1
+            entry.last_used = time.monotonic()
+            return entry
+
+    def drain(self):
+        self._draining.set()
+
+    def resume(self):
+        self._draining.clear()
+
+    @asynccontextmanager
+    async def _connect_slot(self):
+        if self._draining.is_set():
+            raise PoolDraining
+        if self._connect_bucket is not None and not await self._connect_bucket.acquire(self._draining):
+            raise PoolDraining
+        if self._connect_slots is None:
+            yield
+            return
+        if self._connect_slots.locked():
+            # wait for a handshake slot, unless the pool drains first
+            slot = asyncio.ensure_future(self._connect_slots.acquire())
+            stop = asyncio.ensure_future(self._draining.wait())
+            try:
+                await asyncio.wait({slot, stop}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                stop.cancel()
+                got = slot.done()
+                if not got:
+                    slot.cancel()
+                    # should the acquire still win the race, hand the slot back
+                    slot.add_done_callback(lambda t: t.cancelled() or self._connect_slots.release())
+            if not got:
+                raise PoolDraining
+        else:
+            await self._connect_slots.acquire()
+        try:
+            yield
+        finally:
+            self._connect_slots.release()
+
+    async def _connect(self, *args):
+        client = self._factory(*args)
+        async with self._connect_slot():
+            await client.connect()
+        if not await client.is_user_authorized():
+            await client.disconnect()
+            raise SessionNotAuthorized(args[0] if args else None)
+        return client
+
+    async def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            await self._close(key, entry)
+
+    async def evict_idle(self):
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if entry.users == 0 and now - entry.last_used > self._idle_timeout:
+                del self._entries[key]
+                await self._close(key, entry)
+        # LRU order: oldest first, skip clients that are mid-send
+        while len(self._entries) >= self.max_size:
+            victim = next((k for k, e in self._entries.items() if e.users == 0), None)
+            if victim is None:
+                break
+            await self._close(victim, self._entries.pop(victim))
+        for key in [k for k, l in self._locks.items() if k not in self._entries and not l.locked()]:
+            del self._locks[key]
+
+    async def _close(self, key, entry: _Entry):
+        self.evictions += 1
+        try:
+            await entry.client.disconnect()
+        except Exception as e:
+            log.warning("Disconnect of Telethon client %s failed: %s", key, e)
+
+    async def close_all(self):
+        while self._entries:
+            key, entry = self._entries.popitem(last=False)
+            await self._close(key, entry)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size":       len(self._entries),
+            "in_use":     sum(1 for e in self._entries.values() if e.users),
+            "hits":       self.hits,
+            "misses":     self.misses,
+            "hit_ratio":  self.hits / total if total else 0.0,
+            "reconnects": self.reconnects,
+            "evictions":  self.evictions,
+        }
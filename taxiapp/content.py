@@ -0,0 +1,68 @@
+# taxiapp/content.py
+import logging
+from collections import OrderedDict
+from typing import NamedTuple
+
+from telethon.extensions import markdown
+from telethon.tl import types
+
+log = logging.getLogger(__name__)
+
+# entities Telethon resolves against the account at send time; texts that
+# contain them are left to send_message's own parsing
+_NEEDS_CLIENT = (types.MessageEntityMentionName, types.InputMessageEntityMentionName)
+
+
+class ParsedText(NamedTuple):
+    text: str
+    entities: list | None       # None → let send_message parse ``text``
+
+
+def parse(text: str) -> ParsedText:
+    """Markdown → (text, entities) the way TelegramClient.send_message does it."""
+    message, entities = markdown.parse(text)
+    if text and not message and not entities:
+        raise ValueError("Failed to parse message")
+    entities = [e for e in entities if e.length]
+    for e in entities:
+        if isinstance(e, _NEEDS_CLIENT) or (
+            isinstance(e, types.MessageEntityTextUrl) and e.url.startswith(("@", "+", "tg://user"))
+        ):
+            return ParsedText(text, None)
+    return ParsedText(message, entities)
+
+
+class ContentCache:
+    """
+    Parsed announcement text keyed by (announcement id, updated_at), so the
+    markdown is parsed once per edit instead of once per group and cycle.
+    """
+
+    def __init__(self, max_size: int = 5000):
+        self._max_size = max_size
+        self._entries: OrderedDict[int, tuple[object, ParsedText]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, ann_id: int, updated_at, text: str) -> ParsedText:
+        entry = self._entries.get(ann_id)
+        if entry is not None and entry[0] == updated_at:
+            self.hits += 1
+            self._entries.move_to_end(ann_id)
+            return entry[1]
+        self.misses += 1
+        return self.prime(ann_id, updated_at, text)
+
+    def prime(self, ann_id: int, updated_at, text: str) -> ParsedText:
+        parsed = parse(text)
+        self._entries[ann_id] = (updated_at, parsed)
+        self._entries.move_to_end(ann_id)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+        return parsed
+
+    def forget(self, ann_id: int):
+        self._entries.pop(ann_id, None)
@@ -0,0 +1,61 @@
+# taxiapp/expiry.py
+import asyncio
+import logging
+
+from django.utils import timezone
+
+from taxiapp import repository
+
+log = logging.getLogger(__name__)
+
+
+class ExpiryEngine:
+    """
+    Sleeps until the earliest ``ActiveUser.expires_at`` (read from the
+    partial expires_at index), then deactivates every due user and their
+    announcements in one transaction and hands the batch to
+    ``on_expired(users, ann_ids)``.
+
+    ``notify`` wakes it early when an admin sets an earlier expiry; it also
+    re-reads at least every ``max_sleep`` seconds to see changes made by
+    other processes.
+    """
+
+    def __init__(self, on_expired, max_sleep: float = 3600):
+        self._on_expired = on_expired
+        self._max_sleep = max_sleep
+        self._next_due = None
+        self._wakeup = asyncio.Event()
+        self.expired_total = 0
+
+    def notify(self, expires_at):
+        if self._next_due is None or expires_at < self._next_due:
+            self._wakeup.set()
+
+    async def enforce(self) -> int:
+        users, ann_ids = await repository.expire_due(timezone.now())
+        if users:
+            self.expired_total += len(users)
+            log.info("Expired %d users, stopped %d announcements", len(users), len(ann_ids))
+            await self._on_expired(users, ann_ids)
+        return len(users)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                self._next_due = await repository.next_expiry()
+                if self._next_due is not None and self._next_due <= timezone.now():
+                    await self.enforce()
+                    continue
+            except Exception:
+                log.exception("Expiry check failed")
+                self._next_due = None
+
+            delay = self._max_sleep
+            if self._next_due is not None:
+                delay = min(delay, (self._next_due - timezone.now()).total_seconds())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(delay, 0.1))
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,92 @@
+# taxiapp/faketelegram.py
+#
+# Offline stand-in for the parts of TelegramClient the posting engine uses,
+# for benchmarks. Latency, errors and FloodWaits are injected at random.
+import asyncio
+import random
+import time
+import zlib
+
+from telethon.crypto import AuthKey
+from telethon.errors import ChatWriteForbiddenError, FloodWaitError
+from telethon.extensions import markdown
+from telethon.sessions import StringSession
+from telethon.tl.types import InputPeerChannel
+
+
+def fake_session(seed: int = 1) -> str:
+    """A well-formed StringSession for seeded benchmark drivers."""
+    session = StringSession()
+    session.set_dc(2, "149.154.167.51", 443)
+    session.auth_key = AuthKey(random.Random(seed).randbytes(256))
+    return session.save()
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.05, jitter: float = 0.5, error_rate: float = 0.0,
+                 flood_rate: float = 0.0, flood_seconds: int = 5, seed: int | None = None):
+        self.latency = latency              # mean seconds per request
+        self.jitter = jitter                # ± fraction of latency
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self._random = random.Random(seed)
+        self.connects = 0
+        self.sends = 0
+        self.errors = 0
+        self.floods = 0
+        self.latencies: list[float] = []
+
+    def client(self, session, api_id, api_hash) -> "FakeClient":
+        """Factory with TelegramClient's signature, for ClientPool."""
+        return FakeClient(self, session)
+
+    async def _delay(self):
+        await asyncio.sleep(self.latency * self._random.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+class FakeClient:
+    __slots__ = ("_tg", "session", "_connected")
+
+    def __init__(self, tg: FakeTelegram, session):
+        self._tg = tg
+        self.session = session
+        self._connected = False
+
+    async def connect(self):
+        await self._tg._delay()
+        self._tg.connects += 1
+        self._connected = True
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    async def is_user_authorized(self) -> bool:
+        return True
+
+    async def disconnect(self):
+        self._connected = False
+        self.session.close()                    # Telethon saves the session here
+
+    async def get_input_entity(self, name: str):
+        await self._tg._delay()
+        peer_id = zlib.crc32(name.encode())
+        return InputPeerChannel(peer_id, peer_id * 7919)
+
+    async def send_message(self, peer, text: str, **kwargs):
+        if not self._connected:
+            raise ConnectionError("not connected")
+        if kwargs.get("formatting_entities") is None:
+            markdown.parse(text)                # what TelegramClient does per call
+        tg = self._tg
+        t0 = time.monotonic()
+        await tg._delay()
+        roll = tg._random.random()
+        if roll < tg.flood_rate:
+            tg.floods += 1
+            raise FloodWaitError(request=None, capture=tg.flood_seconds)
+        if roll < tg.flood_rate + tg.error_rate:
+            tg.errors += 1
+            raise ChatWriteForbiddenError(request=None)
+        tg.sends += 1
+        tg.latencies.append(time.monotonic() - t0)
@@ -0,0 +1,188 @@
+# taxiapp/fanout.py
+import asyncio
+import contextlib
+import logging
+import time
+from dataclasses import dataclass, field
+
+from telethon.errors import FloodWaitError
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate                # tokens per second
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    async def acquire(self, stop: asyncio.Event | None = None) -> bool:
+        """Take a token; returns False without one if ``stop`` gets set first."""
+        async with self._lock:          # FIFO: waiters are served in order
+            if stop is not None and stop.is_set():
+                return False
+            self._refill()
+            if self._tokens < 1:
+                delay = (1 - self._tokens) / self.rate
+                if stop is None:
+                    await asyncio.sleep(delay)
+                else:
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(stop.wait(), delay)
+                    if stop.is_set():
+                        return False
+                self._refill()
+            self._tokens -= 1
+            return True
+
+
+class _Account:
+    __slots__ = ("bucket", "slots", "parked_until")
+
+    def __init__(self, concurrency: int, rate: float, burst: int):
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = asyncio.Semaphore(concurrency)
+        self.parked_until = 0.0
+
+
+@dataclass
+class CycleReport:
+    sent: int = 0
+    failed: int = 0
+    throttled: int = 0
+    elapsed: float = 0.0
+    latencies: list[float] = field(default_factory=list)
+    # per group: (group, status, latency or None, error class or "")
+    outcomes: list[tuple[str, str, float | None, str]] = field(default_factory=list)
+    # not attempted because the process is shutting down
+    deferred: list[str] = field(default_factory=list)
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class FanOut:
+    """
+    Sends one cycle of an announcement to all its groups concurrently.
+
+    Each account (Telethon session) gets its own semaphore and token bucket,
+    so one driver's groups go out in parallel without exceeding the per-user
+    rate. A FloodWaitError parks only that account; the affected sends wait
+    it out (up to ``max_wait``) while other accounts keep going. A positive
+    ``budget`` caps the sends per second across all accounts.
+
+    After ``drain()`` sends already handed to Telegram complete, but no new
+    ones start: the remaining groups end up in ``CycleReport.deferred``.
+    That lasts until ``resume()``; the posting engine calls it on open.
+    """
+
+    def __init__(self, concurrency: int = 5, rate: float = 1.0, burst: int = 5,
+                 budget: float = 0):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self._budget = TokenBucket(budget, max(1, int(budget))) if budget > 0 else None
+        self._accounts: dict[object, _Account] = {}
+        self._draining = asyncio.Event()
+        self.throttled_total = 0
+        self.flood_waits = 0
+
+    def _account(self, key) -> _Account:
+        acc = self._accounts.get(key)
+        if acc is None:
+            acc = self._accounts[key] = _Account(self.concurrency, self.rate, self.burst)
+        return acc
+
+    def parked_for(self, key) -> float:
+        acc = self._accounts.get(key)
+        return max(0.0, acc.parked_until - time.monotonic()) if acc else 0.0
+
+    def forget(self, key):
+        # the account's limits and FloodWait park go with it
+        self._accounts.pop(key, None)
+
+    def drain(self):
+        self._draining.set()
+
+    def resume(self):
+        self._draining.clear()
+
+    async def send_all(self, key, groups, send, max_wait: float = 300,
+                       report: CycleReport | None = None) -> CycleReport:
+        """
+        ``send(group)`` is awaited once per group; returns the cycle report,
+        which is filled in as sends finish if the caller passes one.
+        """
+        acc = self._account(key)
+        report = report if report is not None else CycleReport()
+        started = time.monotonic()
+        results = await asyncio.gather(
+            *(self._send_one(acc, key, grp, send, report, max_wait) for grp in groups),
+            return_exceptions=True,
+        )
+        report.elapsed = time.monotonic() - started
+        self.throttled_total += report.throttled
+        for res in results:
+            # a dead connection fails the whole cycle so the pool can reset it
+            if isinstance(res, (ConnectionError, OSError)):
+                raise res
+        return report
+
+    async def _send_one(self, acc: _Account, key, grp, send, report: CycleReport, max_wait: float):
+        async with acc.slots:
+            for attempt in (1, 2):
+                if self._draining.is_set():
+                    report.deferred.append(grp)
+                    return
+                parked = acc.parked_until - time.monotonic()
+                if parked > 0:
+                    report.throttled += 1
+                    if parked > max_wait:
+                        log.warning("Account %s parked for %.0fs, skipping %s", key, parked, grp)
+                        report.failed += 1
+                        report.outcomes.append((grp, "skipped", None, "FloodWaitError"))
+                        return
+                    # a shutdown cuts the wait short
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self._draining.wait(), parked)
+                # a drain also ends the rate limiter waits, so every queued
+                # send is deferred by the deadline instead of after its turn
+                if (self._draining.is_set()
+                        or not await acc.bucket.acquire(self._draining)
+                        or self._budget is not None and not await self._budget.acquire(self._draining)):
+                    report.deferred.append(grp)
+                    return
+                t0 = time.monotonic()
+                try:
+                    await send(grp)
+                except FloodWaitError as e:
+                    self.flood_waits += 1
+                    acc.parked_until = max(acc.parked_until, time.monotonic() + e.seconds)
+                    log.warning("FloodWait %ss for account %s on %s", e.seconds, key, grp)
+                    continue
+                except (ConnectionError, OSError) as e:
+                    report.failed += 1
+                    report.outcomes.append((grp, "failed", None, type(e).__name__))
+                    raise
+                except Exception as e:
+                    report.failed += 1
+                    report.outcomes.append((grp, "failed", None, type(e).__name__))
+                    log.error("Telethon post to %s failed: %s", grp, e)
+                    return
+                latency = time.monotonic() - t0
+                report.latencies.append(latency)
+                report.outcomes.append((grp, "sent", latency, ""))
+                report.sent += 1
+                return
+            report.failed += 1
+            report.outcomes.append((grp, "flood", None, "FloodWaitError"))
@@ -0,0 +1,35 @@
+# taxiapp/fsmstorage.py
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from taxiapp import repository
+
+
+def _key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or 0}:{key.destiny}"
+
+
+class DbStorage(BaseStorage):
+    """
+    aiogram FSM storage in the FsmState table, so a conversation can move
+    between webhook workers from one update to the next. Data must be JSON.
+    """
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await repository.fsm_set(_key(key), state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        row = await repository.fsm_record(_key(key))
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        await repository.fsm_set(_key(key), data=data)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        row = await repository.fsm_record(_key(key))
+        return dict(row[1]) if row else {}
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,136 @@
+# taxiapp/ingest.py
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+def chat_key(update) -> int:
+    # every update of one chat goes to the same worker so order is kept
+    event = update.event
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user is not None else update.update_id
+
+
+class UpdateQueue:
+    """
+    Bounded hand-off between the webhook view and ``workers`` async tasks.
+
+    The view calls ``put`` and answers Telegram straight away; ``handler``
+    runs later in a worker. Each worker owns a shard of chats, which keeps
+    per-chat ordering without a global lock. ``put`` returns False when the
+    shard is full, or the queue is closing, so the caller can push back.
+    ``max_lag`` is the largest queueing delay of the last one to two
+    ``lag_window`` seconds.
+    """
+
+    def __init__(self, handler, workers: int = 8, maxsize: int = 1000, lag_window: float = 60):
+        self._handler = handler         # async (bot, update)
+        self._workers = workers
+        self._shard_size = max(1, maxsize // workers)
+        self._queues: list[asyncio.Queue] = []
+        self._tasks: list[asyncio.Task] = []
+        self._loop = None
+        self._closing = False
+        self._held: dict[object, int] = {}              # bot → updates queued or running
+        self._lag_window = lag_window
+        self._window_start = time.monotonic()
+        self._window_max = 0.0
+        self._previous_max = 0.0
+        self.processed = 0
+        self.rejected = 0
+        self.last_lag = 0.0
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queues = [asyncio.Queue(self._shard_size) for _ in range(self._workers)]
+        self._tasks = [loop.create_task(self._work(q)) for q in self._queues]
+        log.info("Started %d update workers", self._workers)
+
+    def put(self, bot, update) -> bool:
+        if self._closing:
+            return False
+        self._ensure_started()
+        queue = self._queues[chat_key(update) % self._workers]
+        try:
+            queue.put_nowait((time.monotonic(), bot, update))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self._held[bot] = self._held.get(bot, 0) + 1
+        return True
+
+    def holds(self, bot) -> bool:
+        """True while updates for ``bot`` are queued or being handled."""
+        return bot in self._held
+
+    async def _work(self, queue: asyncio.Queue):
+        while True:
+            enqueued, bot, update = await queue.get()
+            lag = time.monotonic() - enqueued
+            self.last_lag = lag
+            self._roll(time.monotonic())
+            self._window_max = max(self._window_max, lag)
+            try:
+                await self._handler(bot, update)
+            except Exception:
+                log.exception("Update %s failed in worker", update.update_id)
+            finally:
+                self.processed += 1
+                if self._held[bot] > 1:
+                    self._held[bot] -= 1
+                else:
+                    del self._held[bot]
+                queue.task_done()
+
+    def _roll(self, now: float):
+        if now - self._window_start < self._lag_window:
+            return
+        # after a quiet spell longer than a window both are stale
+        fresh = now - self._window_start < 2 * self._lag_window
+        self._previous_max = self._window_max if fresh else 0.0
+        self._window_max = 0.0
+        self._window_start = now
+
+    @property
+    def max_lag(self) -> float:
+        self._roll(time.monotonic())
+        return max(self._previous_max, self._window_max)
+
+    @property
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        return {
+            "depth":     self.depth,
+            "capacity":  self._shard_size * self._workers,
+            "workers":   self._workers,
+            "processed": self.processed,
+            "rejected":  self.rejected,
+            "last_lag":  self.last_lag,
+            "max_lag":   self.max_lag,
+        }
+
+    async def close(self, timeout: float = 0):
+        # refuse new updates (Telegram redelivers them), give the queued
+        # ones ``timeout`` seconds, then stop the workers
+        self._closing = True
+        if self._queues and timeout > 0:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+            except asyncio.TimeoutError:
+                log.warning("Dropping %d queued updates after %.0fs", self.depth, timeout)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks, self._queues, self._loop = [], [], None
+        self._held.clear()
+        self._closing = False
@@ -0,0 +1,103 @@
+# taxiapp/journal.py
+import asyncio
+import datetime
+import logging
+
+from django.utils import timezone
+
+from taxiapp import repository
+from taxiapp.models import Delivery
+
+log = logging.getLogger(__name__)
+
+
+class DeliveryJournal:
+    """
+    Buffers per-group send outcomes in memory and writes them with one
+    bulk insert once ``flush_size`` rows are waiting or every
+    ``flush_interval`` seconds, whichever comes first. ``run`` also prunes
+    rows older than ``retention_days``. If the database is unavailable the
+    buffer is capped at ``max_buffer`` rows, dropping the oldest.
+    """
+
+    def __init__(self, flush_size: int = 500, flush_interval: float = 5,
+                 retention_days: int = 14, max_buffer: int = 50_000):
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._retention = datetime.timedelta(days=retention_days)
+        self._max_buffer = max_buffer
+        self._buffer: list[Delivery] = []
+        self._lock = asyncio.Lock()
+        self._kick = asyncio.Event()
+        self.written = 0
+        self.dropped = 0
+        self.pruned = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def record(self, ann_id: int, driver_id: int, report):
+        """Queue the outcomes of one FanOut cycle report."""
+        now = timezone.now()
+        self._buffer.extend(
+            Delivery(announcement_id=ann_id, driver_id=driver_id, group=group[:128],
+                     status=status, error=error[:64], sent_at=now,
+                     latency_ms=round(latency * 1000) if latency is not None else None)
+            for group, status, latency, error in report.outcomes
+        )
+        overflow = len(self._buffer) - self._max_buffer
+        if overflow > 0:
+            del self._buffer[:overflow]
+            self.dropped += overflow
+        if len(self._buffer) >= self._flush_size:
+            self._kick.set()
+
+    async def flush(self) -> int:
+        async with self._lock:
+            rows, self._buffer = self._buffer, []
+            if not rows:
+                return 0
+            try:
+                written = await repository.store_deliveries(rows)
+            except Exception:
+                log.exception("Delivery journal flush of %d rows failed", len(rows))
+                self._buffer[:0] = rows                 # retry on the next flush
+                return 0
+            self.written += written
+            return written
+
+    async def prune(self) -> int:
+        deleted = await repository.prune_deliveries(timezone.now() - self._retention)
+        self.pruned += deleted
+        if deleted:
+            log.info("Pruned %d journal rows", deleted)
+        return deleted
+
+    async def run(self, prune_every: float = 3600):
+        next_prune = 0.0
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._kick.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._kick.clear()
+            # a cancelled run must not lose the rows already handed to the DB thread
+            await asyncio.shield(self.flush())
+            if loop.time() >= next_prune:
+                next_prune = loop.time() + prune_every
+                try:
+                    await self.prune()
+                except Exception:
+                    log.exception("Delivery journal pruning failed")
+
+    async def close(self):
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._buffer),
+            "written":  self.written,
+            "dropped":  self.dropped,
+            "pruned":   self.pruned,
+        }
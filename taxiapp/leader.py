@@ -0,0 +1,110 @@
+# taxiapp/leader.py
+#
+# Several uvicorn workers can serve the onboarding bot's webhook, but
+# posting, expiry and the other background services must run once. The
+# worker holding an exclusive file lock leads and runs them; the others
+# queue their posting commands in ControlCommand for it.
+import asyncio
+import fcntl
+import logging
+import os
+
+from taxiapp import repository
+
+log = logging.getLogger(__name__)
+
+
+class LeaderLock:
+    """Non-blocking ``flock`` on ``path``; the OS drops it if the process dies."""
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)          # closing the file drops the lock
+            self._fd = None
+
+
+class RelayedControl:
+    """
+    Posting control of a webhook worker. The leader applies start/stop/
+    release to ``control`` (LocalControl or ShardCoordinator) right away;
+    every other worker queues them, and the leader picks them up every
+    ``poll_interval`` seconds.
+    """
+
+    def __init__(self, control, lock: LeaderLock, poll_interval: float = 1):
+        self.control = control
+        self._lock = lock
+        self._poll_interval = poll_interval
+        self._last = 0
+        self.relayed = 0
+
+    async def start(self, ann_id: int, driver_id: int):
+        await self._submit("start", ann=ann_id, driver=driver_id)
+
+    async def stop(self, ann_id: int, driver_id: int | None = None):
+        await self._submit("stop", ann=ann_id, driver=driver_id)
+
+    async def release(self, driver_id: int):
+        await self._submit("release", driver=driver_id)
+
+    async def _submit(self, op: str, **args):
+        if self._lock.held:
+            await self._apply(op, args)
+        else:
+            await repository.queue_command(op, args)
+
+    async def _apply(self, op: str, args: dict):
+        if op == "start":
+            await self.control.start(args["ann"], args["driver"])
+        elif op == "stop":
+            await self.control.stop(args["ann"], args["driver"])
+        elif op == "release":
+            await self.control.release(args["driver"])
+
+    async def open(self):
+        # the schedule is loaded from the database after this, so anything
+        # queued before is already in it
+        self._last = await repository.clear_commands()
+        await self.control.open()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            try:
+                commands = await repository.queued_commands(self._last)
+                for cmd_id, op, args in commands:
+                    self._last = cmd_id
+                    try:
+                        await self._apply(op, args)
+                    except Exception:
+                        log.exception("Relayed %s %s failed", op, args)
+                if commands:
+                    self.relayed += len(commands)
+                    await repository.delete_commands(self._last)
+            except Exception:
+                log.exception("Reading relayed posting commands failed")
+
+    async def close(self):
+        await self.control.close()
@@ -0,0 +1,107 @@
+# taxiapp/logins.py
+import asyncio
+import logging
+import time
+
+from aiogram import BaseMiddleware
+
+log = logging.getLogger(__name__)
+
+
+class TooManyLogins(Exception):
+    """``max_pending`` logins are already waiting for a code."""
+
+
+class LoginManager:
+    """
+    Holds the connected Telethon clients of logins waiting for a code or a
+    2FA password. Every entry expires after ``ttl`` seconds; expired,
+    replaced and discarded clients are always disconnected.
+    """
+
+    def __init__(self, ttl: float = 600, max_pending: int = 100):
+        self._ttl = ttl
+        self._max_pending = max_pending
+        self._pending: dict[int, tuple[object, float]] = {}   # tg_id → (client, deadline)
+        self.started = 0
+        self.completed = 0
+        self.expired = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, tg_id):
+        return tg_id in self._pending
+
+    async def put(self, tg_id: int, client):
+        await self.discard(tg_id)
+        await self.sweep()
+        if len(self._pending) >= self._max_pending:
+            self.rejected += 1
+            raise TooManyLogins()
+        self._pending[tg_id] = (client, time.monotonic() + self._ttl)
+        self.started += 1
+
+    def get(self, tg_id: int):
+        entry = self._pending.get(tg_id)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    async def finish(self, tg_id: int):
+        if tg_id in self._pending:
+            self.completed += 1
+        await self.discard(tg_id)
+
+    async def discard(self, tg_id: int):
+        entry = self._pending.pop(tg_id, None)
+        if entry is not None:
+            await self._disconnect(tg_id, entry[0])
+
+    async def sweep(self):
+        now = time.monotonic()
+        for tg_id, (client, deadline) in list(self._pending.items()):
+            if deadline < now:
+                del self._pending[tg_id]
+                self.expired += 1
+                await self._disconnect(tg_id, client)
+
+    async def run_sweeper(self, interval: float = 60):
+        while True:
+            await asyncio.sleep(interval)
+            await self.sweep()
+
+    async def _disconnect(self, tg_id: int, client):
+        try:
+            await client.disconnect()
+        except Exception as e:
+            log.warning("Disconnect of login client %s failed: %s", tg_id, e)
+
+    async def close_all(self):
+        for tg_id in list(self._pending):
+            await self.discard(tg_id)
+
+    def stats(self) -> dict:
+        return {
+            "pending":   len(self._pending),
+            "started":   self.started,
+            "completed": self.completed,
+            "expired":   self.expired,
+            "rejected":  self.rejected,
+        }
+
+
+class LoginCleanupMiddleware(BaseMiddleware):
+    # drop the pending client as soon as the user leaves the login states
+    def __init__(self, manager: LoginManager, states):
+        self._manager = manager
+        self._states = states
+
+    async def __call__(self, handler, event, data):
+        result = await handler(event, data)
+        user, state = data.get("event_from_user"), data.get("state")
+        if user is not None and state is not None and user.id in self._manager:
+            if await state.get_state() not in self._states:
+                await self._manager.discard(user.id)
+        return result
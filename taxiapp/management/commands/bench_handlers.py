@@ -0,0 +1,84 @@
+# taxiapp/management/commands/bench_handlers.py
+import asyncio
+import datetime
+import random
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from taxiapp import repository
+from taxiapp.models import ActiveUser, Driver
+
+
+# the lookups a /start + Login round does, old style: every call on one thread
+async def _legacy_handler(tg_id: int, slow: bool):
+    await sync_to_async(
+        lambda: ActiveUser.objects.filter(tg_id=tg_id, active=True).exists(),
+        thread_sensitive=True,
+    )()
+    await sync_to_async(lambda: Driver.objects.filter(tg_id=tg_id).first(), thread_sensitive=True)()
+    if slow:
+        await sync_to_async(lambda: list(ActiveUser.objects.all()), thread_sensitive=True)()
+
+
+async def _repository_handler(tg_id: int, slow: bool):
+    await repository.user_status(tg_id)
+    await repository.get_driver(tg_id)
+    if slow:
+        await repository.read(lambda: list(ActiveUser.objects.all()))()
+
+
+class Command(BaseCommand):
+    help = "Compare bot handler DB throughput: per-call sync_to_async vs taxiapp.repository."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20_000)
+        parser.add_argument("--handlers", type=int, default=5_000)
+        parser.add_argument("--concurrency", type=int, default=50)
+        parser.add_argument("--slow-every", type=int, default=100,
+                            help="every Nth handler also runs a full-table read (0 = never)")
+
+    def handle(self, *args, **opts):
+        # never touch the real database
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self._seed(opts["users"])
+            for name, handler in (("legacy", _legacy_handler), ("repository", _repository_handler)):
+                rate, p50, p99 = asyncio.run(self._run(handler, opts))
+                self.stdout.write(
+                    f"{name:>10}: {rate:8.0f} handlers/s   p50 {p50 * 1000:6.2f} ms   p99 {p99 * 1000:7.2f} ms"
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _seed(self, n: int):
+        now = timezone.now()
+        ActiveUser.objects.bulk_create(
+            ActiveUser(name=f"user{i}", phone=str(i), tg_id=i, activated_at=now,
+                       expires_at=now + datetime.timedelta(days=30), active=i % 5 != 0)
+            for i in range(n)
+        )
+        Driver.objects.bulk_create(
+            Driver(tg_id=i, api_id=i, api_hash="x" * 32, session="-") for i in range(0, n, 2)
+        )
+
+    async def _run(self, handler, opts):
+        users, total = opts["users"], opts["handlers"]
+        slow_every = opts["slow_every"]
+        sem = asyncio.Semaphore(opts["concurrency"])
+        latencies = []
+
+        async def one(i):
+            async with sem:
+                t0 = time.perf_counter()
+                await handler(random.randrange(users), bool(slow_every) and i % slow_every == 0)
+                latencies.append(time.perf_counter() - t0)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        return total / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
@@ -0,0 +1,288 @@
+# taxiapp/management/commands/bench_posting.py
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from taxiapp import posting, repository
+from taxiapp.clientpool import ClientPool
+from taxiapp.faketelegram import FakeTelegram, fake_session
+from taxiapp.fanout import FanOut
+from taxiapp.journal import DeliveryJournal
+from taxiapp.models import Announcement, Driver, ResolvedPeer
+from taxiapp.peercache import PeerCache, normalize
+from taxiapp.posting import BootReport
+from taxiapp.scheduler import AnnouncementScheduler
+from taxiapp.sessions import SessionStore
+
+
+def _rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _open_fds() -> int | None:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def _pct(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def seed(drivers: int, groups: int, peers: bool) -> list[int]:
+    Driver.objects.bulk_create(
+        (Driver(tg_id=i, api_id=i, api_hash="x" * 32, session=fake_session(i))
+         for i in range(1, drivers + 1)),
+        batch_size=5000,
+    )
+    names = [f"@bench_group_{g}" for g in range(groups)]
+    Announcement.objects.bulk_create(
+        (Announcement(driver_id=i, groups=names, text="bench", interval_minutes=1)
+         for i in range(1, drivers + 1)),
+        batch_size=5000,
+    )
+    if peers:
+        ResolvedPeer.objects.bulk_create(
+            (ResolvedPeer(driver_id=i, username=normalize(n), peer_type="channel",
+                          peer_id=g, access_hash=g * 7919)
+             for i in range(1, drivers + 1) for g, n in enumerate(names)),
+            batch_size=5000,
+        )
+    return list(Announcement.objects.values_list("id", flat=True))
+
+
+class Command(BaseCommand):
+    help = "Load-test the posting engine offline against a fake Telegram and write JSON results."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--drivers", type=int, default=2000)
+        parser.add_argument("--groups", type=int, default=20, help="groups per announcement")
+        parser.add_argument("--interval", type=float, default=30, help="seconds between cycles")
+        parser.add_argument("--duration", type=float, default=120, help="seconds to run")
+        parser.add_argument("--latency", type=float, default=0.05, help="mean fake request latency, s")
+        parser.add_argument("--jitter", type=float, default=0.5)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+        parser.add_argument("--flood-rate", type=float, default=0.0)
+        parser.add_argument("--flood-seconds", type=int, default=5)
+        parser.add_argument("--pool-size", type=int, default=settings.TELETHON_POOL_SIZE)
+        parser.add_argument("--concurrency", type=int, default=settings.FANOUT_CONCURRENCY)
+        parser.add_argument("--rate", type=float, default=settings.FANOUT_RATE)
+        parser.add_argument("--burst", type=int, default=settings.FANOUT_BURST)
+        parser.add_argument("--budget", type=float, default=settings.POSTING_SEND_BUDGET,
+                            help="global sends per second (0 = no cap)")
+        parser.add_argument("--burst-start", action="store_true",
+                            help="make every announcement due at the same moment")
+        parser.add_argument("--no-leveling", action="store_true")
+        parser.add_argument("--connect-rate", type=float, default=settings.TELETHON_CONNECT_RATE,
+                            help="new Telethon connections per second (0 = unlimited)")
+        parser.add_argument("--connect-concurrency", type=int, default=settings.TELETHON_CONNECT_CONCURRENCY)
+        parser.add_argument("--warm-up", action="store_true",
+                            help="pre-connect the soonest-due drivers, as the bot does at boot")
+        parser.add_argument("--restart-at", type=float, default=0,
+                            help="drain and restart the engine after this many seconds")
+        parser.add_argument("--drain", type=float, default=settings.SHUTDOWN_DRAIN_SECONDS,
+                            help="seconds in-flight cycles may keep sending on restart")
+        parser.add_argument("--cold-peers", action="store_true",
+                            help="start with no resolved peers, as after a fresh Setup")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--output", help="also write the results as JSON to this file")
+        parser.add_argument("--baseline", help="earlier results file to compare against")
+
+    def handle(self, *args, **opts):
+        if opts["verbosity"] < 2:
+            logging.getLogger("taxiapp").setLevel(logging.CRITICAL)
+        # never touch the real database; a file, not shared-cache memory, so
+        # concurrent reads and peer writes behave as they do in production
+        if connection.vendor == "sqlite":
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(
+                tempfile.gettempdir(), f"bench_posting_{os.getpid()}.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            ann_ids = seed(opts["drivers"], opts["groups"], not opts["cold_peers"])
+            metrics = asyncio.run(self._run(ann_ids, opts))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        config = {k: opts[k] for k in (
+            "drivers", "groups", "interval", "duration", "latency", "jitter", "error_rate",
+            "flood_rate", "flood_seconds", "pool_size", "concurrency", "rate", "burst",
+            "budget", "burst_start", "no_leveling", "connect_rate", "connect_concurrency",
+            "warm_up", "restart_at", "drain", "cold_peers", "seed",
+        )}
+        results = {
+            "benchmark": "posting",
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "config": config,
+            "metrics": metrics,
+        }
+        for key, value in metrics.items():
+            self.stdout.write(f"{key:>28}: {value}")
+        if opts["output"]:
+            with open(opts["output"], "w") as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"results written to {opts['output']}")
+        if opts["baseline"]:
+            self._compare(opts["baseline"], metrics)
+
+    async def _run(self, ann_ids: list[int], opts) -> dict:
+        fake = FakeTelegram(latency=opts["latency"], jitter=opts["jitter"],
+                            error_rate=opts["error_rate"], flood_rate=opts["flood_rate"],
+                            flood_seconds=opts["flood_seconds"], seed=opts["seed"])
+        interval = opts["interval"]
+        drift: dict[int, list[float]] = {}
+
+        async def runner(ann_id: int):
+            await posting.post_once(ann_id)
+            return interval / 60, opts["groups"]
+
+        async def engine():
+            # post_once looks these up at call time, so the real cycle runs on fakes
+            posting.boot = BootReport()
+            posting.client_pool = ClientPool(
+                lambda tg_id, *args: fake.client(posting.session_store.session(tg_id), *args),
+                max_size=opts["pool_size"], connect_rate=opts["connect_rate"],
+                connect_concurrency=opts["connect_concurrency"])
+            posting.session_store = SessionStore()
+            await posting.session_store.load()
+            posting.fanout = FanOut(opts["concurrency"], opts["rate"], opts["burst"], opts["budget"])
+            posting.peers = PeerCache()
+            posting.scheduler = AnnouncementScheduler(
+                runner,
+                slot_seconds=min(settings.SCHEDULER_SLOT_SECONDS, interval / 10),
+                start_spread=interval,
+                catchup_spread=interval,
+                leveling=not opts["no_leveling"],
+                lag_observer=lambda ann_id, lag: drift.setdefault(ann_id, []).append(lag),
+                seed=opts["seed"],
+            )
+            return posting.scheduler
+
+        posting.journal = DeliveryJournal(settings.DELIVERY_FLUSH_SIZE, settings.DELIVERY_FLUSH_INTERVAL)
+        scheduler = await engine()
+        rss_before, fds_before = _rss(), _open_fds()
+        rnd = random.Random(opts["seed"])
+        start = time.time()
+        for ann_id in ann_ids:
+            if opts["burst_start"]:
+                # everyone started at once; the scheduler decides how to spread them
+                await scheduler.schedule(ann_id)
+            else:
+                await scheduler.schedule(ann_id, start + rnd.uniform(0, interval))
+
+        posting.boot.mark("restored")
+
+        tasks = {"run": asyncio.create_task(scheduler.run())}
+        journal_task = asyncio.create_task(posting.journal.run())
+        warm_task = asyncio.create_task(posting.warm_up()) if opts["warm_up"] else None
+        restart: dict = {}
+
+        async def restart_after(delay: float):
+            # drain this "process", then start a fresh engine from the database
+            await asyncio.sleep(delay)
+            t0 = time.monotonic()
+            restart["cut_runs"] = await posting.drain(opts["drain"])
+            restart["drain_s"] = round(time.monotonic() - t0, 2)
+            restart["cut_short_cycles"] = sum(r[5] for r in await repository.active_schedule())
+            tasks["run"].cancel()
+            await posting.scheduler.close()
+            await posting.client_pool.close_all()
+            await posting.journal.flush()
+            await (await engine()).load()
+            tasks["run"] = asyncio.create_task(posting.scheduler.run())
+            await posting.scheduler.caught_up.wait()
+            restart["to_steady_s"] = round(time.monotonic() - t0, 2)
+
+        if opts["restart_at"]:
+            tasks["restart"] = asyncio.create_task(restart_after(opts["restart_at"]))
+        peak_sessions = peak_rss = peak_fds = 0
+        per_second, last_sends = [], 0
+        connects_per_second, last_connects = [], 0
+        started = time.monotonic()
+        while (elapsed := time.monotonic() - started) < opts["duration"]:
+            await asyncio.sleep(min(1.0, opts["duration"] - elapsed))
+            per_second.append(fake.sends - last_sends)
+            last_sends = fake.sends
+            connects_per_second.append(fake.connects - last_connects)
+            last_connects = fake.connects
+            peak_sessions = max(peak_sessions, len(posting.client_pool))
+            peak_rss = max(peak_rss, _rss())
+            peak_fds = max(peak_fds, _open_fds() or 0)
+        if warm_task is not None:
+            warm_task.cancel()
+        for task in tasks.values():
+            task.cancel()
+        await posting.scheduler.close()
+        journal_task.cancel()
+        await posting.journal.close()
+        elapsed = time.monotonic() - started
+        pool_stats = posting.client_pool.stats()
+        await posting.client_pool.close_all()
+
+        runs = [d for ds in drift.values() for d in ds]
+        worst = [max(ds) for ds in drift.values()]
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "posts": fake.sends,
+            "posts_per_sec": round(fake.sends / elapsed, 1),
+            "cycles": len(runs),
+            "errors": fake.errors,
+            "flood_waits": posting.fanout.flood_waits,
+            "throttled": posting.fanout.throttled_total,
+            "send_p50_ms": round(_pct(fake.latencies, 0.5) * 1000, 2),
+            "send_p99_ms": round(_pct(fake.latencies, 0.99) * 1000, 2),
+            "load_peak_per_sec": max(per_second, default=0),
+            "load_peak_to_mean": round(max(per_second, default=0) / (sum(per_second) / len(per_second)), 2)
+                                 if sum(per_second) else 0.0,
+            "drift_p50_ms": round(_pct(runs, 0.5) * 1000, 2),
+            "drift_p99_ms": round(_pct(runs, 0.99) * 1000, 2),
+            "drift_max_ms": round(max(runs, default=0) * 1000, 2),
+            "announcement_worst_drift_p50_ms": round(_pct(worst, 0.5) * 1000, 2),
+            "announcement_worst_drift_p99_ms": round(_pct(worst, 0.99) * 1000, 2),
+            "announcements_never_run": len(ann_ids) - len(drift),
+            # None: not reached within --duration
+            **{f"time_to_{m}_s": round(posting.boot.milestones[m], 2) if m in posting.boot.milestones else None
+               for m in ("first_post", "warm")},
+            "connects": fake.connects,
+            "connects_peak_per_sec": max(connects_per_second, default=0),
+            # None: the restart didn't get that far within --duration
+            **({**{f"restart_{k}": restart.get(k)
+                   for k in ("cut_runs", "drain_s", "cut_short_cycles", "to_steady_s")},
+                "restart_finished": "to_steady_s" in restart} if opts["restart_at"] else {}),
+            "peak_sessions": peak_sessions,
+            "pool_hit_ratio": round(pool_stats["hit_ratio"], 3),
+            "pool_evictions": pool_stats["evictions"],
+            "journal_rows": posting.journal.written,
+            "rss_bytes_per_session": (peak_rss - rss_before) // peak_sessions if peak_sessions else 0,
+            "open_fds_start": fds_before,
+            "open_fds_peak": peak_fds,
+        }
+
+    def _compare(self, path: str, metrics: dict):
+        with open(path) as f:
+            baseline = json.load(f)["metrics"]
+        self.stdout.write(f"\ncompared to {path}:")
+        for key, value in metrics.items():
+            old = baseline.get(key)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                continue
+            change = f"{(value - old) / old * 100:+7.1f}%" if old else "      -"
+            self.stdout.write(f"{key:>28}: {old:>12} → {value:<12} {change}")
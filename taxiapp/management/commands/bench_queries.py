@@ -0,0 +1,68 @@
+# taxiapp/management/commands/bench_queries.py
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from taxiapp.models import ActiveUser, Announcement, Driver
+
+
+def seed(drivers: int, per_driver: int = 3, users: int = 0):
+    now = timezone.now()
+    Driver.objects.bulk_create(
+        (Driver(tg_id=i, api_id=i, api_hash="x" * 32, session="-") for i in range(drivers)),
+        batch_size=5000,
+    )
+    Announcement.objects.bulk_create(
+        (Announcement(driver_id=i % drivers, groups=["@g"], text="t", interval_minutes=10,
+                      active=i % per_driver == 0)
+         for i in range(drivers * per_driver)),
+        batch_size=5000,
+    )
+    ActiveUser.objects.bulk_create(
+        (ActiveUser(name=f"u{i}", phone=str(i), tg_id=i, activated_at=now,
+                    expires_at=now + datetime.timedelta(days=i % 60 - 30), active=i % 4 != 0)
+         for i in range(users)),
+        batch_size=5000,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+
+
+# The queries the bot runs on every Setup / Stop / Start, scheduler load and
+# expiry sweep. Each must be answered from an index, never a table scan.
+def hot_queries(tg_id: int = 7):
+    now = timezone.now()
+    return {
+        "driver_active_announcement": Announcement.objects.filter(driver__tg_id=tg_id, active=True),
+        "scheduler_load": Announcement.objects.filter(active=True).values_list("id", "next_run_at"),
+        "expired_users": ActiveUser.objects.filter(active=True, expires_at__lte=now),
+        "user_status": ActiveUser.objects.filter(tg_id=tg_id).values_list("active", "expires_at"),
+    }
+
+
+class Command(BaseCommand):
+    help = "Seed large tables in a throwaway database and time the hot-path queries."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--drivers", type=int, default=100_000)
+        parser.add_argument("--users", type=int, default=200_000)
+        parser.add_argument("--repeat", type=int, default=50)
+
+    def handle(self, *args, **opts):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            t0 = time.perf_counter()
+            seed(opts["drivers"], users=opts["users"])
+            self.stdout.write(f"seeded in {time.perf_counter() - t0:.1f}s")
+            for name, qs in hot_queries(tg_id=opts["drivers"] // 2).items():
+                t0 = time.perf_counter()
+                for _ in range(opts["repeat"]):
+                    list(qs.all())
+                per_query = (time.perf_counter() - t0) / opts["repeat"]
+                plan = qs.explain().replace("\n", " | ")
+                self.stdout.write(f"{name:>28}: {per_query * 1000:8.2f} ms   {plan}")
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,90 @@
+# taxiapp/management/commands/bench_routing.py
+import asyncio
+import datetime
+import random
+import time
+
+from aiogram import Bot, Dispatcher, Router, types
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from django.core.management.base import BaseCommand
+
+from taxiapp.routing import ButtonRouter
+
+TOKEN = "123456:" + "A" * 35                # never sent anywhere
+
+
+async def _noop(message: types.Message):
+    pass
+
+
+def _legacy(texts: list[str], states: list[State]) -> Router:
+    # the old style: one lambda filter per button, tried in order, then
+    # one State filter per state (aiogram runs both in its executor)
+    router = Router()
+    for text in texts:
+        router.message(lambda m, text=text: m.text == text)(_noop)
+    for state in states:
+        router.message(state)(_noop)
+    return router
+
+
+def _table(texts: list[str], states: list[State]) -> Router:
+    router = ButtonRouter()
+    router.button(*texts)(_noop)
+    router.state(*states)(_noop)
+    return router
+
+
+def _update(update_id: int, user_id: int, text: str) -> types.Update:
+    user = types.User(id=user_id, is_bot=False, first_name="u")
+    return types.Update(update_id=update_id, message=types.Message(
+        message_id=update_id, date=datetime.datetime.now(), text=text,
+        chat=types.Chat(id=user_id, type="private"), from_user=user))
+
+
+class Command(BaseCommand):
+    help = "Compare aiogram routing: a lambda filter per button vs the ButtonRouter table."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--buttons", type=int, default=300)
+        parser.add_argument("--states", type=int, default=20)
+        parser.add_argument("--updates", type=int, default=2_000)
+        parser.add_argument("--state-share", type=float, default=0.3,
+                            help="fraction of updates that are replies in an FSM state")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **opts):
+        rng = random.Random(opts["seed"])
+        texts = [f"🔘 Button {i}" for i in range(opts["buttons"])]
+        group = type("BenchStates", (StatesGroup,), {f"s{i}": State() for i in range(opts["states"])})
+        states = list(group.__states__)
+        # one user per state sits in it; button presses come from users in no state
+        updates = []
+        for i in range(opts["updates"]):
+            if rng.random() < opts["state_share"]:
+                updates.append(("state", _update(i, 1 + rng.randrange(len(states)), "free text")))
+            else:
+                updates.append(("button", _update(i, 10_000 + i, rng.choice(texts))))
+
+        for name, build in (("lambda filters", _legacy), ("button table", _table)):
+            per_kind = asyncio.run(self._run(build(texts, states), states, updates))
+            self.stdout.write(f"{name:>15}: " + "   ".join(
+                f"{kind} {sum(t) / len(t) * 1e6:7.1f} µs/update" for kind, t in sorted(per_kind.items())))
+
+    async def _run(self, router: Router, states: list[State], updates) -> dict[str, list[float]]:
+        bot = Bot(TOKEN)
+        dp = Dispatcher(storage=MemoryStorage())
+        dp.include_router(router)
+        for i, state in enumerate(states):
+            await dp.storage.set_state(StorageKey(bot.id, 1 + i, 1 + i), state)
+        timings: dict[str, list[float]] = {"button": [], "state": []}
+        try:
+            for kind, update in updates:
+                t0 = time.perf_counter()
+                await dp.feed_update(bot, update)
+                timings[kind].append(time.perf_counter() - t0)
+        finally:
+            await bot.session.close()
+        return {kind: t for kind, t in timings.items() if t}
@@ -0,0 +1,69 @@
+# taxiapp/management/commands/import_sessions.py
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from telethon.sessions import SQLiteSession
+
+from taxiapp.models import Driver
+from taxiapp.sessions import DbSession, has_auth
+
+
+def read_session_file(path: Path, tg_id: int) -> str:
+    """A Telethon ``<tg_id>.session`` SQLite file → Driver.session data."""
+    old = SQLiteSession(str(path))
+    try:
+        session = DbSession(None, tg_id)
+        session.set_dc(old.dc_id, old.server_address, old.port)
+        session.auth_key = old.auth_key
+        cursor = old._cursor()
+        try:
+            session._entities = set(cursor.execute(
+                "select id, hash, username, phone, name from entities").fetchall())
+        finally:
+            cursor.close()
+        return session.dump()
+    finally:
+        old.close()
+
+
+class Command(BaseCommand):
+    help = "Copy per-driver Telethon .session files into Driver.session."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dir", default=os.path.join(settings.BASE_DIR, "sessions"))
+        parser.add_argument("--overwrite", action="store_true",
+                            help="replace sessions already stored in the database")
+        parser.add_argument("--delete", action="store_true",
+                            help="remove each file (and its journal) once imported")
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **opts):
+        files = {int(p.stem): p for p in Path(opts["dir"]).glob("*.session") if p.stem.isdigit()}
+        stored = dict(Driver.objects.filter(tg_id__in=files).values_list("tg_id", "session"))
+        imported = {}
+        for tg_id, path in sorted(files.items()):
+            if tg_id not in stored:
+                self.stdout.write(f"{path.name}: no such driver, skipped")
+            elif has_auth(stored[tg_id]) and not opts["overwrite"]:
+                self.stdout.write(f"{path.name}: already in the database, skipped")
+            elif not has_auth(data := read_session_file(path, tg_id)):
+                self.stdout.write(f"{path.name}: no auth key, skipped")
+            else:
+                imported[tg_id] = data
+                self.stdout.write(f"{path.name}: imported")
+
+        if opts["dry_run"] or not imported:
+            self.stdout.write(f"{len(imported)} of {len(files)} sessions would be imported"
+                              if opts["dry_run"] else "Nothing to import.")
+            return
+        with transaction.atomic():
+            for tg_id, data in imported.items():
+                Driver.objects.filter(tg_id=tg_id).update(session=data)
+        if opts["delete"]:
+            for tg_id in imported:
+                for path in (files[tg_id], files[tg_id].with_name(f"{tg_id}.session-journal")):
+                    path.unlink(missing_ok=True)
+        self.stdout.write(self.style.SUCCESS(f"Imported {len(imported)} of {len(files)} sessions."))
@@ -0,0 +1,118 @@
+# taxiapp/management/commands/posting_worker.py
+import asyncio
+import json
+import logging
+import os
+import signal
+import stat
+import sys
+
+from django.core.management.base import BaseCommand
+
+log = logging.getLogger(__name__)
+
+
+async def _stdin_reader() -> asyncio.StreamReader:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    mode = os.fstat(sys.stdin.fileno()).st_mode
+    if stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode):
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    else:
+        # a file or tty when run by hand: feed it from a thread instead
+        def pump():
+            for line in sys.stdin.buffer:
+                loop.call_soon_threadsafe(reader.feed_data, line)
+            loop.call_soon_threadsafe(reader.feed_eof)
+
+        loop.run_in_executor(None, pump)
+    return reader
+
+
+async def serve(worker_id: int):
+    from django.conf import settings
+
+    from taxiapp import metrics
+    from taxiapp.posting import (
+        boot, client_pool, drain, journal, mark_steady, peers, release_driver, scheduler,
+        session_store, warm_up,
+    )
+    from taxiapp.sharding import HashRing
+
+    exporter = None
+    if settings.METRICS_PORT:
+        # the bot's exporter is on METRICS_PORT, workers take the ports after it
+        exporter = await metrics.serve(settings.METRICS_HOST, settings.METRICS_PORT + 1 + worker_id)
+    owns = lambda driver_id: False         # nothing until the first ring
+    run_task = asyncio.create_task(scheduler.run())
+    journal_task = asyncio.create_task(journal.run())
+    session_task = asyncio.create_task(session_store.run())
+    warm_task = None
+    steady_task = asyncio.create_task(mark_steady())
+    reader = await _stdin_reader()
+    # SIGTERM from a service manager or Ctrl+C on the process group drains
+    # like a closed stdin
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(sig, reader.feed_eof)
+    try:
+        while line := await reader.readline():
+            msg = json.loads(line)
+            op = msg["op"]
+            if op == "ring":
+                # first phase: hand over the drivers that moved to another
+                # shard. Their runs in flight finish and persist the next
+                # run, their clients close and the sessions are written back
+                # before the coordinator lets the new owner load them
+                ring = HashRing(msg["nodes"])
+                owns = lambda driver_id, ring=ring: ring.owner(driver_id) == worker_id
+                if warm_task is not None:
+                    warm_task.cancel()          # it may be connecting drivers we lose
+                await scheduler.hand_over(owns, settings.SHUTDOWN_DRAIN_SECONDS)
+                for driver_id in {*client_pool, *session_store, *peers}:
+                    if not owns(driver_id):
+                        await release_driver(driver_id, keep_session=True)
+                await session_store.flush()
+                sys.stdout.write(json.dumps({"op": "released", "version": msg["version"]}) + "\n")
+                sys.stdout.flush()
+            elif op == "load":
+                # second phase: every worker has let go, pick up our shard
+                await session_store.load(owns=owns)
+                await scheduler.load(owns=owns)
+                boot.mark("restored")
+                if settings.TELETHON_WARM_UP:
+                    # a new ring moves drivers here; already connected ones are skipped
+                    warm_task = asyncio.create_task(warm_up(owns))
+            elif op == "start":
+                if msg["ann"] not in scheduler:
+                    await scheduler.schedule(msg["ann"])
+            elif op == "stop":
+                scheduler.cancel(msg["ann"])
+            elif op == "release":
+                await release_driver(msg["driver"])
+    finally:
+        # stdin closed: the coordinator is gone or asked us to stop
+        if warm_task is not None:
+            warm_task.cancel()
+        steady_task.cancel()
+        await drain(settings.SHUTDOWN_DRAIN_SECONDS)
+        run_task.cancel()
+        await scheduler.close()
+        journal_task.cancel()
+        await journal.close()
+        await client_pool.close_all()
+        # after the pool: disconnecting clients save their sessions
+        session_task.cancel()
+        await session_store.close()
+        if exporter is not None:
+            await exporter.cleanup()
+
+
+class Command(BaseCommand):
+    help = "Run one posting shard; started and fed commands by the onboarding bot."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--worker-id", type=int, required=True)
+
+    def handle(self, *args, **opts):
+        logging.basicConfig(level=logging.INFO, format=f"[worker {opts['worker_id']}] %(message)s")
+        asyncio.run(serve(opts["worker_id"]))
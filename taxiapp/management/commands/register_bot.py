@@ -0,0 +1,28 @@
+# taxiapp/management/commands/register_bot.py
+import asyncio
+
+from aiogram.exceptions import TelegramAPIError
+from aiogram.utils.token import TokenValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from taxiapp.botpool import install_webhook
+from taxiapp.models import Driver, DriverBot
+
+
+class Command(BaseCommand):
+    help = "Register a driver's own bot: check the token, set its webhook and store it."
+
+    def add_arguments(self, parser):
+        parser.add_argument("driver", type=int, help="the driver's Telegram id")
+        parser.add_argument("token", help="the bot token from @BotFather")
+
+    def handle(self, *args, **opts):
+        if not Driver.objects.filter(tg_id=opts["driver"]).exists():
+            raise CommandError(f"No driver {opts['driver']}")
+        try:
+            me = asyncio.run(install_webhook(opts["token"]))
+        except (TokenValidationError, TelegramAPIError) as e:
+            raise CommandError(f"Token rejected: {e}")
+        DriverBot.objects.update_or_create(
+            token=opts["token"], defaults={"driver_id": opts["driver"], "active": True})
+        self.stdout.write(self.style.SUCCESS(f"@{me.username} now serves driver {opts['driver']}."))
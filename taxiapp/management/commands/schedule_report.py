@@ -0,0 +1,99 @@
+# taxiapp/management/commands/schedule_report.py
+import heapq
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from taxiapp.models import Announcement
+from taxiapp.scheduler import AnnouncementScheduler
+
+
+def _rows(opts) -> list[tuple[int, float | None, int, int, bool]]:
+    """(id, next run, interval minutes, sends per run, cut short)"""
+    now = time.time()
+    if opts["synthetic"]:
+        rnd = random.Random(opts["seed"])
+        # popular intervals, all of them overdue at once (a restart after downtime)
+        return [(i, now - rnd.uniform(0, 120), rnd.choice((10, 15, 30)), rnd.randint(5, 30), False)
+                for i in range(opts["synthetic"])]
+    rows = (Announcement.objects.filter(active=True)
+            .values_list("id", "next_run_at", "interval_minutes", "groups", "pending_groups"))
+    return [(i, nxt.timestamp() if nxt else None, interval, len(pending or groups), pending is not None)
+            for i, nxt, interval, groups, pending in rows]
+
+
+def simulate(rows, horizon: float, slot: float, leveled: bool, seed: int = 1) -> list[float]:
+    """
+    Sends per slot over the next ``horizon`` seconds. Runs are placed by an
+    AnnouncementScheduler with the SCHEDULER_* settings, as after a restart:
+    restored like ``load`` does, then each next run placed when one ends.
+    """
+    now = time.time()
+    scheduler = AnnouncementScheduler(
+        None,
+        slot_seconds=slot,
+        shift_fraction=settings.SCHEDULER_SHIFT_FRACTION,
+        max_shift=settings.SCHEDULER_MAX_SHIFT,
+        start_spread=settings.SCHEDULER_START_SPREAD,
+        catchup_spread=settings.SCHEDULER_CATCHUP_SPREAD,
+        leveling=leveled,
+        seed=seed,
+    )
+    runs = []                                       # (run_at, ann_id, interval, sends)
+    for ann_id, next_run, interval, sends, cut_short in rows:
+        run_at = scheduler.place_restored(ann_id, next_run, interval, sends, cut_short, now)
+        heapq.heappush(runs, (run_at, ann_id, interval, sends))
+    load = [0.0] * (int(horizon // slot) + 1)
+    while runs and runs[0][0] < now + horizon:
+        ts, ann_id, interval, sends = heapq.heappop(runs)
+        scheduler.calendar.release(ann_id)          # as when the run starts
+        load[int((ts - now) // slot)] += sends
+        heapq.heappush(runs, (scheduler.place_next(ann_id, interval, ts), ann_id, interval, sends))
+    return load
+
+
+def _stats(load: list[float], slot: float) -> str:
+    per_sec = sorted(v / slot for v in load)
+    mean = sum(per_sec) / len(per_sec)
+    p95 = per_sec[int(0.95 * (len(per_sec) - 1))]
+    return (f"mean {mean:7.1f}/s   p95 {p95:7.1f}/s   peak {per_sec[-1]:7.1f}/s   "
+            f"peak/mean {per_sec[-1] / mean if mean else 0:5.1f}   idle slots {per_sec.count(0.0)}")
+
+
+class Command(BaseCommand):
+    help = "Show the expected send-load curve of the active schedule, raw vs load-leveled."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hours", type=float, default=1)
+        parser.add_argument("--slot", type=float, default=settings.SCHEDULER_SLOT_SECONDS)
+        parser.add_argument("--bucket", type=float, default=60, help="seconds per printed row")
+        parser.add_argument("--synthetic", type=int, default=0,
+                            help="use N generated announcements instead of the database")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **opts):
+        rows = _rows(opts)
+        if not rows:
+            self.stdout.write("No active announcements.")
+            return
+        horizon, slot = opts["hours"] * 3600, opts["slot"]
+        raw = simulate(rows, horizon, slot, leveled=False, seed=opts["seed"])
+        leveled = simulate(rows, horizon, slot, leveled=True, seed=opts["seed"])
+
+        self.stdout.write(f"{len(rows)} announcements, {slot:g}s slots, next {opts['hours']:g}h")
+        self.stdout.write(f"raw:     {_stats(raw, slot)}")
+        self.stdout.write(f"leveled: {_stats(leveled, slot)}\n")
+
+        # smoothed curve: peak slot (sends/s) within each printed bucket
+        per_row = max(1, int(opts["bucket"] // slot))
+        rows_raw = [max(raw[i:i + per_row]) / slot for i in range(0, len(raw), per_row)]
+        rows_lev = [max(leveled[i:i + per_row]) / slot for i in range(0, len(leveled), per_row)]
+        top = max(rows_raw + rows_lev) or 1
+        width = 30
+        self.stdout.write(f"{'t+':>7}  {'raw peak sends/s':<{width + 8}}  leveled peak sends/s")
+        for n, (a, b) in enumerate(zip(rows_raw, rows_lev)):
+            bar_a = "█" * round(a / top * width)
+            bar_b = "█" * round(b / top * width)
+            self.stdout.write(f"{n * per_row * slot / 60:6.0f}m  {bar_a:<{width}} {a:6.1f}  {bar_b:<{width}} {b:6.1f}")
@@ -0,0 +1,187 @@
+# taxiapp/metrics.py
+#
+# In-process metrics in the Prometheus text format. Served by the /metrics
+# view of the Django app (only with METRICS_TOKEN set) and by ``serve()``
+# in the standalone onboarding bot.
+import bisect
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: dict[tuple, object] = {}
+        self._lock = threading.Lock()     # ORM timings come from DB threads
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[n]) for n in self.labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_labels(self.labels, key)} {_num(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Callback(_Metric):
+    """Read at scrape time: ``fn()`` returns a number or {label values: number}."""
+
+    def __init__(self, name: str, help: str, fn, kind: str = "gauge", labels=()):
+        super().__init__(name, help, labels)
+        self.kind = kind
+        self._fn = fn
+
+    def render(self) -> list[str]:
+        try:
+            values = self._fn()
+        except Exception:
+            log.exception("Metric %s failed", self.name)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        with self._lock:
+            self._values = {k if isinstance(k, tuple) else (k,): v for k, v in values.items()}
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, (list(c), s)) for k, (c, s) in self._values.items()]
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = _labels(self.labels, key, f'le="{_num(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total!r}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        # re-registering (module reload, second bot) replaces the old one
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, fn, kind="gauge", labels=()) -> Callback:
+        return self.register(Callback(name, help, fn, kind, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    "taxi_handler_seconds", "Time spent in aiogram handlers.", ("bot", "handler"))
+handler_errors = registry.counter(
+    "taxi_handler_errors_total", "aiogram handlers that raised.", ("bot", "handler"))
+db_query_seconds = registry.histogram(
+    "taxi_db_query_seconds", "ORM query execution time.", ("alias",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+posting_lag_seconds = registry.histogram(
+    "taxi_posting_lag_seconds", "Delay between an announcement's due time and its start.",
+    buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600))
+posting_lag_ratio = registry.histogram(
+    "taxi_posting_lag_ratio", "Posting lag as a fraction of interval_minutes.",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2))
+update_seconds = registry.histogram(
+    "taxi_update_seconds", "Wall time per update, by matched handler and FSM state.",
+    ("bot", "handler", "state"))
+update_stage_seconds = registry.counter(
+    "taxi_update_stage_seconds_total", "Update time spent per stage (db, sql, telegram, telethon).",
+    ("bot", "stage"))
+
+
+async def serve(host: str, port: int):
+    """Standalone exporter for processes without the Django web app."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=registry.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("Metrics on http://%s:%d/metrics", host, port)
+    return runner
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 11:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("taxiapp", "0005_alter_driver_tg_id"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="announcement",
+            name="next_run_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2 on 2026-10-17 11:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("taxiapp", "0006_announcement_next_run_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ResolvedPeer",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("username", models.CharField(max_length=64)),
+                ("peer_type", models.CharField(max_length=8)),
+                ("peer_id", models.BigIntegerField()),
+                ("access_hash", models.BigIntegerField(blank=True, null=True)),
+                ("resolved_at", models.DateTimeField(auto_now=True)),
+                (
+                    "driver",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="peers",
+                        to="taxiapp.driver",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("driver", "username")},
+            },
+        ),
+    ]
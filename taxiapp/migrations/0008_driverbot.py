@@ -0,0 +1,38 @@
+# Generated by Django 4.2 on 2026-10-17 11:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("taxiapp", "0007_resolvedpeer"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DriverBot",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("token", models.CharField(max_length=64, unique=True)),
+                ("active", models.BooleanField(default=True)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "driver",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="bots",
+                        to="taxiapp.driver",
+                    ),
+                ),
+            ],
+        ),
+    ]
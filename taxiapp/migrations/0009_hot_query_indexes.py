@@ -0,0 +1,34 @@
+# Generated by Django 4.2 on 2026-10-17 12:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("taxiapp", "0008_driverbot"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="activeuser",
+            index=models.Index(
+                condition=models.Q(("active", True)),
+                fields=["expires_at"],
+                name="user_active_expires_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="announcement",
+            index=models.Index(
+                fields=["driver", "active"], name="ann_driver_active_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="announcement",
+            index=models.Index(
+                condition=models.Q(("active", True)),
+                fields=["next_run_at"],
+                name="ann_active_next_run_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("taxiapp", "0010_delivery"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="announcement",
+            name="pending_groups",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2 on 2026-10-17 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("taxiapp", "0011_announcement_pending_groups"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ControlCommand",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("op", models.CharField(max_length=16)),
+                ("args", models.JSONField(default=dict)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="FsmState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=128, unique=True)),
+                ("state", models.CharField(blank=True, max_length=128, null=True)),
+                ("data", models.JSONField(blank=True, default=dict)),
+            ],
+        ),
+    ]
@@ -4,12 +4,29 @@ class Driver(models.Model):
     tg_id     = models.BigIntegerField(primary_key=True, unique=True)    # Telegram user ID
     api_id    = models.PositiveIntegerField()
     api_hash  = models.CharField(max_length=64)
-    session   = models.TextField()                          # Pyrogram string
+    session   = models.TextField()                          # Telethon session, see taxiapp/sessions.py
     active    = models.BooleanField(default=True)
     created   = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return f"{self.tg_id} | {self.bot_token[:6]}"
+        return f"{self.tg_id} | {self.api_id}"
+
+
+
+
+class DriverBot(models.Model):
+    # Per-driver bot served through the tg_webhook endpoint
+    driver = models.ForeignKey(
+        Driver,
+        on_delete=models.CASCADE,
+        related_name="bots"
+    )
+    token = models.CharField(max_length=64, unique=True)
+    active = models.BooleanField(default=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Bot {self.token[:10]} for Driver {self.driver_id}"
 
 
 
@@ -25,15 +42,82 @@ class Announcement(models.Model):
     text = models.TextField()
     interval_minutes = models.PositiveIntegerField()
     active = models.BooleanField(default=True)
+    next_run_at = models.DateTimeField(null=True, blank=True)     # set by the scheduler
+    # groups a cycle cut short by a shutdown still has to post to
+    pending_groups = models.JSONField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # a driver's active announcement (Setup / Stop / Start)
+            models.Index(fields=["driver", "active"], name="ann_driver_active_idx"),
+            # scheduler bulk load of active rows
+            models.Index(fields=["next_run_at"], condition=models.Q(active=True),
+                         name="ann_active_next_run_idx"),
+        ]
+
     def __str__(self):
         return f"Announcement {self.id} for Driver {self.driver.tg_id}"
 
 
 
 
+class ResolvedPeer(models.Model):
+    # Cached username → input peer, so sends skip ResolveUsername
+    driver = models.ForeignKey(
+        Driver,
+        on_delete=models.CASCADE,
+        related_name="peers"
+    )
+    username = models.CharField(max_length=64)                  # normalized, no "@"
+    peer_type = models.CharField(max_length=8)                  # channel | chat | user
+    peer_id = models.BigIntegerField()
+    access_hash = models.BigIntegerField(null=True, blank=True)
+    resolved_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("driver", "username")
+
+    def __str__(self):
+        return f"@{self.username} → {self.peer_type}:{self.peer_id}"
+
+
+
+
+class Delivery(models.Model):
+    # One send of an announcement to one group, written in batches by DeliveryJournal
+    announcement = models.ForeignKey(
+        Announcement,
+        on_delete=models.CASCADE,
+        related_name="deliveries"
+    )
+    # denormalized so a driver's history is one index range
+    driver = models.ForeignKey(
+        Driver,
+        on_delete=models.CASCADE,
+        related_name="deliveries",
+        db_index=False,
+    )
+    group = models.CharField(max_length=128)
+    status = models.CharField(max_length=8)                     # sent | failed | flood | skipped
+    latency_ms = models.PositiveIntegerField(null=True, blank=True)
+    error = models.CharField(max_length=64, blank=True)         # exception class
+    sent_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["driver", "-sent_at"], name="delivery_driver_sent_idx"),
+            # retention pruning
+            models.Index(fields=["sent_at"], name="delivery_sent_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.status} {self.group} ({self.announcement_id})"
+
+
+
+
 class ActiveUser(models.Model):
     name = models.CharField(max_length=100)
     phone = models.CharField(max_length=30)
@@ -41,5 +125,56 @@ class ActiveUser(models.Model):
     activated_at = models.DateTimeField()
     expires_at = models.DateTimeField()
     active = models.BooleanField(default=True)
+
+    class Meta:
+        indexes = [
+            # expiry sweep: active=True AND expires_at <= now
+            models.Index(fields=["expires_at"], condition=models.Q(active=True),
+                         name="user_active_expires_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.tg_id})"
+
+
+
+class FsmState(models.Model):
+    # aiogram FSM state of one chat, shared by every webhook worker (DbStorage)
+    key = models.CharField(max_length=128, unique=True)         # bot:chat:user:thread:destiny
+    state = models.CharField(max_length=128, null=True, blank=True)
+    data = models.JSONField(default=dict, blank=True)
+
+    def __str__(self):
+        return f"{self.key} → {self.state}"
+
+
+
+
+class ControlCommand(models.Model):
+    # Posting command queued by a webhook worker for the leader to apply
+    op = models.CharField(max_length=16)                        # start | stop | release
+    args = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.op} {self.args}"
+
+
+
+
+class Broadcast(models.Model):
+    # Admin message to every active user; ``cursor`` is the last ActiveUser.id
+    # handled, so an interrupted broadcast resumes after it
+    text = models.TextField()                                   # HTML
+    admin_id = models.BigIntegerField()
+    progress_message_id = models.BigIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=10, default="running") # running | done | cancelled
+    total = models.PositiveIntegerField(default=0)              # recipients when queued
+    cursor = models.BigIntegerField(default=0)
+    delivered = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
     def __str__(self):
-        return f"{self.name} ({self.tg_id})"
\ No newline at end of file
+        return f"Broadcast {self.id} ({self.status})"
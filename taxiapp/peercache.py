@@ -0,0 +1,134 @@
+# taxiapp/peercache.py
+import logging
+
+from telethon.errors import (
+    ChannelInvalidError,
+    ChatIdInvalidError,
+    FloodWaitError,
+    PeerIdInvalidError,
+)
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+
+from taxiapp import repository
+from taxiapp.models import ResolvedPeer
+
+log = logging.getLogger(__name__)
+
+# errors that mean the stored peer is stale and the username must be re-resolved
+INVALID_PEER_ERRORS = (ChannelInvalidError, ChatIdInvalidError, PeerIdInvalidError)
+
+
+def is_invalid_peer(e: Exception) -> bool:
+    # Telethon reports a peer it has no entity for with a bare ValueError;
+    # any other ValueError (message too long, bad entities …) is not ours
+    return isinstance(e, INVALID_PEER_ERRORS) or (
+        isinstance(e, ValueError) and str(e).startswith("Could not find the input entity"))
+
+
+def normalize(group: str) -> str:
+    g = group.strip()
+    for prefix in ("https://t.me/", "http://t.me/", "t.me/", "@"):
+        if g.lower().startswith(prefix):
+            g = g[len(prefix):]
+    return g.lower()
+
+
+def _to_input_peer(row: ResolvedPeer):
+    if row.peer_type == "channel":
+        return InputPeerChannel(row.peer_id, row.access_hash)
+    if row.peer_type == "chat":
+        return InputPeerChat(row.peer_id)
+    return InputPeerUser(row.peer_id, row.access_hash)
+
+
+def _to_row(driver_id: int, username: str, peer) -> ResolvedPeer:
+    if isinstance(peer, InputPeerChannel):
+        kind, pid, ahash = "channel", peer.channel_id, peer.access_hash
+    elif isinstance(peer, InputPeerChat):
+        kind, pid, ahash = "chat", peer.chat_id, None
+    elif isinstance(peer, InputPeerUser):
+        kind, pid, ahash = "user", peer.user_id, peer.access_hash
+    else:
+        raise ValueError(f"unsupported peer {peer!r}")
+    return ResolvedPeer(driver_id=driver_id, username=username,
+                        peer_type=kind, peer_id=pid, access_hash=ahash)
+
+
+class PeerCache:
+    """
+    (driver, group username) → InputPeer, kept in memory and in ResolvedPeer.
+
+    Filled during Setup; a send only resolves a username again when it is
+    missing or when Telegram rejects the stored peer.
+    """
+
+    def __init__(self):
+        self._peers: dict[int, dict[str, object]] = {}
+        self.resolves = 0
+
+    async def _load(self, driver_id: int) -> dict[str, object]:
+        peers = self._peers.get(driver_id)
+        if peers is None:
+            rows = await repository.driver_peers(driver_id)
+            peers = self._peers[driver_id] = {r.username: _to_input_peer(r) for r in rows}
+        return peers
+
+    def __iter__(self):
+        return iter(self._peers)
+
+    def forget(self, driver_id: int):
+        self._peers.pop(driver_id, None)
+
+    async def _store(self, driver_id: int, resolved: dict[str, object]):
+        rows = [_to_row(driver_id, name, peer) for name, peer in resolved.items()]
+        await repository.store_peers(rows)
+
+    async def resolve(self, client, driver_id: int, groups) -> dict[str, str]:
+        """Resolve the given groups once; returns {group: error} for failures."""
+        peers = await self._load(driver_id)
+        resolved, failed = {}, {}
+        for group in groups:
+            name = normalize(group)
+            if name in peers:
+                continue
+            try:
+                self.resolves += 1
+                resolved[name] = await client.get_input_entity(name)
+            except FloodWaitError as e:
+                # leave the rest for lazy resolution on first send
+                log.warning("FloodWait %ss while resolving groups for %s", e.seconds, driver_id)
+                failed[group] = "flood wait"
+                break
+            except Exception as e:
+                failed[group] = str(e)
+        if resolved:
+            await self._store(driver_id, resolved)
+            peers.update(resolved)
+        return failed
+
+    async def _resolve_one(self, client, driver_id: int, group: str):
+        # lazy path: errors (FloodWait included) go straight to the caller
+        name = normalize(group)
+        self.resolves += 1
+        peer = await client.get_input_entity(name)
+        await self._store(driver_id, {name: peer})
+        (await self._load(driver_id))[name] = peer
+        return peer
+
+    async def get(self, client, driver_id: int, group: str):
+        peers = await self._load(driver_id)
+        peer = peers.get(normalize(group))
+        if peer is None:
+            peer = await self._resolve_one(client, driver_id, group)
+        return peer
+
+    async def call(self, client, driver_id: int, group: str, fn):
+        """Await ``fn(peer)``; on an invalid-peer error re-resolve once and retry."""
+        peer = await self.get(client, driver_id, group)
+        try:
+            return await fn(peer)
+        except (*INVALID_PEER_ERRORS, ValueError) as e:
+            if not is_invalid_peer(e):
+                raise
+            log.info("Peer for %s is stale (%s), re-resolving", group, e)
+            return await fn(await self._resolve_one(client, driver_id, group))
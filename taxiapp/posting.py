@@ -0,0 +1,278 @@
+# taxiapp/posting.py
+#
+# The announcement posting engine. The onboarding bot runs it in-process;
+# with POSTING_WORKERS > 0 every posting_worker process runs its own copy
+# for the drivers of its shard.
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from telethon import TelegramClient
+
+from taxiapp import repository
+from taxiapp.clientpool import ClientPool, PoolDraining, SessionNotAuthorized
+from taxiapp.content import ContentCache
+from taxiapp.fanout import CycleReport, FanOut
+from taxiapp.journal import DeliveryJournal
+from taxiapp.metrics import registry as metrics
+from taxiapp.peercache import PeerCache
+from taxiapp.scheduler import AnnouncementScheduler
+from taxiapp.sessions import SessionStore
+
+log = logging.getLogger(__name__)
+
+# Telethon sessions, stored in Driver.session and loaded in bulk at startup
+session_store = SessionStore(flush_interval=settings.SESSION_FLUSH_INTERVAL)
+
+
+def new_client(tg_id: int, api_id: int, api_hash: str) -> TelegramClient:
+    return TelegramClient(session_store.session(tg_id), api_id, api_hash)
+
+
+# Connected posting clients, one per driver, reused across cycles
+client_pool = ClientPool(
+    new_client,
+    max_size=settings.TELETHON_POOL_SIZE,
+    idle_timeout=settings.TELETHON_POOL_IDLE_TIMEOUT,
+    # like the send budget, the connect ramp-up is shared by the posting processes
+    connect_rate=settings.TELETHON_CONNECT_RATE / max(1, settings.POSTING_WORKERS),
+    connect_concurrency=settings.TELETHON_CONNECT_CONCURRENCY,
+)
+
+# Concurrent per-account group sends with rate limiting and FloodWait parking
+fanout = FanOut(
+    concurrency=settings.FANOUT_CONCURRENCY,
+    rate=settings.FANOUT_RATE,
+    burst=settings.FANOUT_BURST,
+    # the global budget is split between the posting processes
+    budget=settings.POSTING_SEND_BUDGET / max(1, settings.POSTING_WORKERS),
+)
+
+# Resolved group peers per driver, persisted in ResolvedPeer
+peers = PeerCache()
+
+# Announcement text parsed once per edit, shared by every send
+content_cache = ContentCache(max_size=settings.CONTENT_CACHE_SIZE)
+
+# Per-group send outcomes, written to Delivery in batches
+journal = DeliveryJournal(
+    flush_size=settings.DELIVERY_FLUSH_SIZE,
+    flush_interval=settings.DELIVERY_FLUSH_INTERVAL,
+    retention_days=settings.DELIVERY_RETENTION_DAYS,
+)
+
+
+class BootReport:
+    """Startup milestones in seconds since ``started``, each logged once."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.milestones: dict[str, float] = {}
+
+    def mark(self, name: str):
+        if name not in self.milestones:
+            self.milestones[name] = time.monotonic() - self.started
+            log.info("Boot: %s after %.2fs", name.replace("_", " "), self.milestones[name])
+
+
+boot = BootReport()
+
+
+# One posting cycle; returns (interval, sends) for the scheduler
+async def post_once(ann_id: int) -> tuple[int, int] | None:
+    data = await repository.announcement_data(ann_id)
+    if data is None or not data["active"]:
+        return None
+
+    content = content_cache.get(ann_id, data["updated_at"], data["text"])
+    if content.entities is None:
+        send = lambda client, peer: client.send_message(peer, data["text"])
+    else:
+        send = lambda client, peer: client.send_message(
+            peer, content.text, formatting_entities=content.entities)
+
+    # a cycle cut short by the last shutdown resumes with the groups it had left
+    resumed = data["pending_groups"] is not None
+    groups = data["pending_groups"] if resumed else data["groups"]
+    report = CycleReport()
+    try:
+        if not await session_store.has_session(data["tg_id"]):
+            raise SessionNotAuthorized(data["tg_id"])   # don't connect just to find out
+        async with client_pool.client(
+            data["tg_id"], data["tg_id"], data["api_id"], data["api_hash"]
+        ) as client:
+            await fanout.send_all(
+                data["tg_id"],
+                groups,
+                lambda grp: peers.call(
+                    client, data["tg_id"], grp,
+                    lambda peer: send(client, peer),
+                ),
+                max_wait=data["interval"] * 60,
+                report=report,
+            )
+        if report.sent:
+            boot.mark("first_post")
+        log.info(
+            "Announcement %s: %d/%d sent in %.1fs (p50 %.0f ms, p99 %.0f ms, %d throttled, %d deferred)",
+            ann_id, report.sent, len(groups), report.elapsed,
+            report.percentile(0.5) * 1000, report.percentile(0.99) * 1000, report.throttled,
+            len(report.deferred),
+        )
+    except PoolDraining:
+        report.deferred = list(groups)  # never connected: all of it after the restart
+    except SessionNotAuthorized:
+        log.warning("Driver %s has no authorized session, skipping cycle", data["tg_id"])
+    except (ConnectionError, OSError) as e:
+        log.error("Telethon connection for driver %s failed: %s", data["tg_id"], e)
+    except asyncio.CancelledError:
+        # drain deadline: groups without an outcome are posted after the
+        # restart (one that was mid-send may go out twice). A stopped
+        # announcement (no longer scheduled) just ends its cycle.
+        if ann_id in scheduler:
+            done = {outcome[0] for outcome in report.outcomes}
+            report.deferred = [g for g in groups if g not in done]
+        raise
+    finally:
+        journal.record(ann_id, data["tg_id"], report)
+        if report.deferred or resumed:
+            await repository.set_pending_groups(ann_id, report.deferred or None)
+
+    return data["interval"], len(groups)            # what this run attempted
+
+
+async def warm_up(owns=None) -> int:
+    """
+    Connect the clients of the soonest-due drivers, up to the pool size,
+    ahead of their first run. Connections go through the pool's ramp-up.
+    """
+    drivers = [d for d in await repository.warm_drivers() if owns is None or owns(d[0])]
+    drivers = drivers[:client_pool.max_size]
+    connected = 0
+
+    async def connect(tg_id: int, api_id: int, api_hash: str):
+        nonlocal connected
+        if not await session_store.has_session(tg_id):
+            return
+        try:
+            async with client_pool.client(tg_id, tg_id, api_id, api_hash):
+                connected += 1
+        except (SessionNotAuthorized, PoolDraining):
+            pass
+        except (ConnectionError, OSError) as e:
+            log.warning("Warm-up connect for driver %s failed: %s", tg_id, e)
+
+    await asyncio.gather(*(connect(*d) for d in drivers))
+    boot.mark("warm")
+    log.info("Warm-up connected %d of %d drivers", connected, len(drivers))
+    return connected
+
+
+scheduler = AnnouncementScheduler(
+    post_once,
+    slot_seconds=settings.SCHEDULER_SLOT_SECONDS,
+    shift_fraction=settings.SCHEDULER_SHIFT_FRACTION,
+    max_shift=settings.SCHEDULER_MAX_SHIFT,
+    start_spread=settings.SCHEDULER_START_SPREAD,
+    catchup_spread=settings.SCHEDULER_CATCHUP_SPREAD,
+)
+
+
+async def drain(timeout: float, grace: float = 5) -> int:
+    """
+    Graceful stop: no new runs start and cycles in flight keep sending for
+    up to ``timeout`` seconds. Then they stop and checkpoint the groups they
+    have left; whatever still runs ``grace`` seconds later is cancelled.
+    Returns the number of cancelled runs.
+    """
+    def stop_sending():
+        fanout.drain()
+        client_pool.drain()             # runs still waiting to connect give up too
+
+    stopper = asyncio.get_running_loop().call_later(timeout, stop_sending)
+    try:
+        return await scheduler.drain(timeout + grace)
+    finally:
+        stopper.cancel()
+
+
+async def release_driver(driver_id: int, keep_session: bool = False):
+    # the driver logged in again or was deleted: the pooled client's session
+    # is stale and must not be written over the new one. When the driver
+    # only moves to another shard (keep_session) closing the client saves
+    # its session, which stays queued until flushed.
+    peers.forget(driver_id)
+    fanout.forget(driver_id)
+    client = client_pool.get(driver_id)
+    if client is not None and not keep_session:
+        client.session.detach()
+    await client_pool.discard(driver_id)
+    session_store.forget(driver_id, drop_pending=not keep_session)
+
+
+async def mark_steady():
+    # every announcement that was due or cut short at restore has run
+    await scheduler.caught_up.wait()
+    boot.mark("steady")
+
+metrics.callback(
+    "taxi_announcements", "Announcements held by the scheduler.",
+    lambda: {"scheduled": len(scheduler), "inflight": scheduler.inflight}, labels=("state",))
+metrics.callback(
+    "taxi_telethon_connects_total", "Telethon connects (new clients and reconnects).",
+    lambda: {"new": client_pool.misses, "reconnect": client_pool.reconnects},
+    kind="counter", labels=("kind",))
+metrics.callback("taxi_telethon_clients", "Connected Telethon clients in the pool.",
+                 lambda: len(client_pool))
+metrics.callback("taxi_fanout_flood_waits_total", "FloodWaits hit while posting.",
+                 lambda: fanout.flood_waits, kind="counter")
+metrics.callback(
+    "taxi_content_cache_total", "Parsed announcement text lookups.",
+    lambda: {"hit": content_cache.hits, "miss": content_cache.misses},
+    kind="counter", labels=("result",))
+metrics.callback("taxi_boot_seconds", "Seconds from start to each boot milestone.",
+                 lambda: boot.milestones, labels=("milestone",))
+metrics.callback("taxi_journal_buffered", "Delivery outcomes waiting to be written.",
+                 lambda: len(journal))
+
+
+class LocalControl:
+    """Start/stop announcements on the scheduler of this process."""
+
+    async def open(self):
+        fanout.resume()                 # reopened after a drain
+        client_pool.resume()
+        # two bulk queries restore every session and active announcement
+        await session_store.load()
+        await scheduler.load()
+        boot.mark("restored")
+        self._task = asyncio.create_task(scheduler.run())
+        self._journal_task = asyncio.create_task(journal.run())
+        self._warm_task = asyncio.create_task(warm_up()) if settings.TELETHON_WARM_UP else None
+        self._steady_task = asyncio.create_task(mark_steady())
+
+    async def start(self, ann_id: int, driver_id: int):
+        # a no-op if it is already queued
+        if ann_id not in scheduler:
+            await scheduler.schedule(ann_id)
+
+    async def stop(self, ann_id: int, driver_id: int | None = None):
+        scheduler.cancel(ann_id)
+
+    async def release(self, driver_id: int):
+        await release_driver(driver_id)
+
+    async def close(self):
+        if not hasattr(self, "_task"):
+            return                      # open() failed before anything ran
+        if self._warm_task is not None:
+            self._warm_task.cancel()
+        self._steady_task.cancel()
+        await drain(settings.SHUTDOWN_DRAIN_SECONDS)
+        self._task.cancel()
+        await scheduler.close()
+        self._journal_task.cancel()
+        await journal.close()
+        log.info("Telethon pool stats: %s", client_pool.stats())
+        await client_pool.close_all()
@@ -0,0 +1,416 @@
+# taxiapp/repository.py
+#
+# Async data access for the bot. Reads run on a dedicated thread pool so a
+# slow query no longer queues every other user behind it; writes use Django's
+# async ORM, which keeps them on the single thread-sensitive executor
+# (SQLite allows one writer at a time anyway).
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Min, Q
+from django.utils import timezone
+
+from taxiapp.models import (
+    ActiveUser, Announcement, Broadcast, ControlCommand, Delivery, Driver, FsmState, ResolvedPeer,
+)
+from taxiapp.tracing import timed
+
+_read_pool = ThreadPoolExecutor(
+    max_workers=settings.DB_READ_WORKERS,
+    thread_name_prefix="db-read",
+)
+
+
+def read(fn):
+    """Decorator: run a sync ORM read on the read pool."""
+    return timed("db")(sync_to_async(fn, thread_sensitive=False, executor=_read_pool))
+
+
+def write(fn):
+    """Decorator: run a multi-statement sync write on the ORM's own executor."""
+    return timed("db")(sync_to_async(fn, thread_sensitive=True))
+
+
+# --- Driver ---
+
+@read
+def get_driver(tg_id: int) -> Driver | None:
+    return Driver.objects.filter(tg_id=tg_id).first()
+
+
+@timed("db")
+async def upsert_driver(tg_id: int, api_id: int, api_hash: str) -> Driver:
+    # the Telethon session survives a new sign-up; new rows get "" until /login
+    driver, _ = await Driver.objects.aupdate_or_create(
+        tg_id=tg_id,
+        defaults={
+            "api_id":   api_id,
+            "api_hash": api_hash,
+            "active":   True,
+        },
+    )
+    return driver
+
+
+@read
+def driver_sessions() -> dict[int, str]:
+    # one query for every stored session at startup
+    return dict(Driver.objects.filter(active=True).exclude(session__in=("", "-"))
+                .values_list("tg_id", "session"))
+
+
+@read
+def warm_drivers() -> list[tuple[int, int, str]]:
+    """(tg_id, api_id, api_hash) of logged-in drivers with active announcements, soonest due first."""
+    return list(
+        Driver.objects.filter(active=True, announcements__active=True)
+        .exclude(session__in=("", "-"))
+        .annotate(due=Min("announcements__next_run_at"))
+        .order_by(F("due").asc(nulls_first=True))
+        .values_list("tg_id", "api_id", "api_hash")
+    )
+
+
+@read
+def driver_session(tg_id: int) -> str | None:
+    return Driver.objects.filter(tg_id=tg_id).values_list("session", flat=True).first()
+
+
+@write
+def store_sessions(sessions: dict[int, str]) -> int:
+    with transaction.atomic():
+        return sum(Driver.objects.filter(tg_id=tg_id).update(session=data)
+                   for tg_id, data in sessions.items())
+
+
+@timed("db")
+async def delete_driver(tg_id: int) -> int:
+    deleted, _ = await Driver.objects.filter(tg_id=tg_id).adelete()
+    return deleted
+
+
+# --- ActiveUser ---
+
+@read
+def user_status(tg_id: int) -> tuple[bool, datetime.datetime] | None:
+    return ActiveUser.objects.filter(tg_id=tg_id).values_list("active", "expires_at").first()
+
+
+@read
+def get_user(**lookup) -> ActiveUser | None:
+    return ActiveUser.objects.filter(**lookup).first()
+
+
+USER_FILTERS = ("all", "active", "expired", "soon")
+EXPIRING_SOON = datetime.timedelta(days=7)
+
+
+@read
+def users_page(flt: str = "all", after: int | None = None, before: int | None = None,
+               limit: int = 20) -> tuple[list[dict], bool, bool]:
+    """
+    One keyset page of users ordered by id: rows after ``after`` or, when
+    paging back, before ``before``. Returns (rows, has_prev, has_next).
+    """
+    now = timezone.now()
+    qs = ActiveUser.objects.all()
+    if flt == "active":
+        qs = qs.filter(active=True, expires_at__gt=now)
+    elif flt == "expired":
+        qs = qs.filter(Q(active=False) | Q(expires_at__lte=now))
+    elif flt == "soon":
+        qs = qs.filter(active=True, expires_at__gt=now, expires_at__lte=now + EXPIRING_SOON)
+    qs = qs.values("id", "name", "tg_id", "active", "expires_at")
+
+    if before is not None:
+        rows = list(qs.filter(id__lt=before).order_by("-id")[:limit + 1])
+        has_prev = len(rows) > limit
+        return rows[:limit][::-1], has_prev, True
+    if after is not None:
+        qs = qs.filter(id__gt=after)
+    rows = list(qs.order_by("id")[:limit + 1])
+    return rows[:limit], after is not None, len(rows) > limit
+
+
+@timed("db")
+async def activate_user(tg_id: int, name: str, phone: str,
+                        now: datetime.datetime, expires: datetime.datetime) -> ActiveUser:
+    user, _ = await ActiveUser.objects.aupdate_or_create(
+        tg_id=tg_id,
+        defaults={
+            "name":         name,
+            "phone":        phone,
+            "activated_at": now,
+            "expires_at":   expires,
+            "active":       True,
+        },
+    )
+    return user
+
+
+@timed("db")
+async def update_user(user_id: int, **fields) -> int:
+    return await ActiveUser.objects.filter(id=user_id).aupdate(**fields)
+
+
+# --- Announcement ---
+
+@read
+def announcement_data(ann_id: int) -> dict | None:
+    ann = (Announcement.objects
+           .select_related("driver")
+           .filter(id=ann_id)
+           .first())
+    if ann is None:
+        return None
+    driver = ann.driver
+    return {
+        "tg_id":    driver.tg_id,
+        "api_id":   driver.api_id,
+        "api_hash": driver.api_hash,
+        "groups":   ann.groups,
+        "text":     ann.text,
+        "interval": ann.interval_minutes,
+        "active":   ann.active,
+        "updated_at": ann.updated_at,
+        "pending_groups": ann.pending_groups,
+    }
+
+
+@read
+def announcement_interval(ann_id: int) -> int | None:
+    return (Announcement.objects.filter(id=ann_id, active=True)
+            .values_list("interval_minutes", flat=True).first())
+
+
+@read
+def active_schedule() -> list[tuple[int, datetime.datetime | None, int, int, int, bool]]:
+    """
+    (id, next_run_at, driver_id, interval_minutes, groups per run, cut short)
+    of active rows; "cut short" rows have a cycle to finish first.
+    """
+    rows = (Announcement.objects.filter(active=True)
+            .values_list("id", "next_run_at", "driver_id", "interval_minutes", "groups",
+                         "pending_groups"))
+    return [(i, nxt, drv, interval, len(pending or groups), pending is not None)
+            for i, nxt, drv, interval, groups, pending in rows]
+
+
+@write
+def replace_announcement(tg_id: int, groups: list[str], text: str,
+                         interval: int) -> tuple[Announcement, list[int]]:
+    # only one announcement per driver posts at a time
+    with transaction.atomic():
+        old = Announcement.objects.filter(driver__tg_id=tg_id, active=True)
+        old_ids = list(old.values_list("id", flat=True))
+        old.update(active=False, next_run_at=None, pending_groups=None)
+        ann = Announcement.objects.create(
+            driver=Driver.objects.get(tg_id=tg_id),
+            groups=groups,
+            text=text,
+            interval_minutes=interval,
+            active=True,
+        )
+    return ann, old_ids
+
+
+@write
+def stop_announcements(tg_id: int) -> list[int]:
+    with transaction.atomic():
+        qs = Announcement.objects.filter(driver__tg_id=tg_id, active=True)
+        ids = list(qs.values_list("id", flat=True))
+        qs.update(active=False, next_run_at=None, pending_groups=None)
+    return ids
+
+
+@write
+def reactivate_latest(tg_id: int) -> int | None:
+    with transaction.atomic():
+        if Announcement.objects.filter(driver__tg_id=tg_id, active=True).exists():
+            return None
+        ann = (Announcement.objects
+               .filter(driver__tg_id=tg_id, active=False)
+               .order_by("-created_at")
+               .first())
+        if ann is None:
+            return None
+        Announcement.objects.filter(id=ann.id).update(active=True)
+    return ann.id
+
+
+@timed("db")
+async def set_next_run(ann_id: int, run_at: datetime.datetime | None) -> int:
+    return await Announcement.objects.filter(id=ann_id).aupdate(next_run_at=run_at)
+
+
+@timed("db")
+async def set_pending_groups(ann_id: int, groups: list[str] | None) -> int:
+    return await Announcement.objects.filter(id=ann_id).aupdate(pending_groups=groups)
+
+
+# --- ResolvedPeer ---
+
+@read
+def driver_peers(driver_id: int) -> list[ResolvedPeer]:
+    return list(ResolvedPeer.objects.filter(driver_id=driver_id))
+
+
+@timed("db")
+async def store_peers(rows: list[ResolvedPeer]):
+    await ResolvedPeer.objects.abulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=["driver", "username"],
+        update_fields=["peer_type", "peer_id", "access_hash", "resolved_at"],
+    )
+
+
+# --- Delivery journal ---
+
+@write
+def store_deliveries(rows: list[Delivery]) -> int:
+    with transaction.atomic():
+        # announcements deleted while their outcomes sat in the buffer
+        live = set(Announcement.objects.filter(id__in={r.announcement_id for r in rows})
+                   .values_list("id", flat=True))
+        rows = [r for r in rows if r.announcement_id in live]
+        Delivery.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+@read
+def recent_deliveries(driver_id: int, limit: int = 20) -> list[Delivery]:
+    return list(Delivery.objects.filter(driver_id=driver_id).order_by("-sent_at")[:limit])
+
+
+@write
+def prune_deliveries(before: datetime.datetime, batch: int = 5000) -> int:
+    # small batches keep the write lock short
+    total = 0
+    while True:
+        ids = list(Delivery.objects.filter(sent_at__lt=before)
+                   .values_list("id", flat=True)[:batch])
+        if not ids:
+            return total
+        total += Delivery.objects.filter(id__in=ids).delete()[0]
+
+
+# --- Broadcasts ---
+
+def _recipients():
+    return ActiveUser.objects.filter(active=True, expires_at__gt=timezone.now())
+
+
+@read
+def count_recipients() -> int:
+    return _recipients().count()
+
+
+@read
+def broadcast_recipients(after: int, limit: int) -> list[tuple[int, int]]:
+    """(id, tg_id) of the next ``limit`` active users after id ``after``."""
+    return list(_recipients().filter(id__gt=after).order_by("id").values_list("id", "tg_id")[:limit])
+
+
+@timed("db")
+async def create_broadcast(text: str, admin_id: int, total: int,
+                           progress_message_id: int | None = None) -> Broadcast:
+    return await Broadcast.objects.acreate(text=text, admin_id=admin_id, total=total,
+                                           progress_message_id=progress_message_id)
+
+
+@read
+def next_broadcast() -> dict | None:
+    return Broadcast.objects.filter(status="running").order_by("id").values().first()
+
+
+@read
+def broadcast_status(broadcast_id: int) -> str | None:
+    return Broadcast.objects.filter(id=broadcast_id).values_list("status", flat=True).first()
+
+
+@timed("db")
+async def cancel_broadcast(broadcast_id: int) -> int:
+    return await (Broadcast.objects.filter(id=broadcast_id, status="running")
+                  .aupdate(status="cancelled", finished_at=timezone.now()))
+
+
+@timed("db")
+async def update_broadcast(broadcast_id: int, **fields) -> int:
+    return await Broadcast.objects.filter(id=broadcast_id).aupdate(**fields)
+
+
+# --- FSM storage ---
+
+@read
+def fsm_record(key: str) -> tuple[str | None, dict] | None:
+    return FsmState.objects.filter(key=key).values_list("state", "data").first()
+
+
+@write
+def fsm_set(key: str, **fields) -> FsmState | None:
+    """Update a chat's state and/or data; a row left with neither is deleted."""
+    with transaction.atomic():
+        row = FsmState.objects.select_for_update().filter(key=key).first() or FsmState(key=key)
+        for name, value in fields.items():
+            setattr(row, name, value)
+        if row.state is None and not row.data:
+            if row.pk is not None:
+                row.delete()            # conversation over: don't keep a row per chat
+            return None
+        row.save()
+    return row
+
+
+# --- Control commands (webhook workers → leader) ---
+
+@timed("db")
+async def queue_command(op: str, args: dict) -> ControlCommand:
+    return await ControlCommand.objects.acreate(op=op, args=args)
+
+
+@read
+def queued_commands(after: int) -> list[tuple[int, str, dict]]:
+    return list(ControlCommand.objects.filter(id__gt=after).order_by("id")
+                .values_list("id", "op", "args"))
+
+
+@timed("db")
+async def delete_commands(upto: int) -> int:
+    deleted, _ = await ControlCommand.objects.filter(id__lte=upto).adelete()
+    return deleted
+
+
+@write
+def clear_commands() -> int:
+    """Drop every queued command; returns the last id handed out."""
+    with transaction.atomic():
+        last = ControlCommand.objects.order_by("-id").values_list("id", flat=True).first() or 0
+        ControlCommand.objects.filter(id__lte=last).delete()
+    return last
+
+
+# --- Expiry ---
+
+@read
+def next_expiry() -> datetime.datetime | None:
+    return (ActiveUser.objects.filter(active=True).order_by("expires_at")
+            .values_list("expires_at", flat=True).first())
+
+
+@write
+def expire_due(now: datetime.datetime) -> tuple[list[dict], list[int]]:
+    """Deactivate every user past expires_at and their active announcements."""
+    with transaction.atomic():
+        due = ActiveUser.objects.filter(active=True, expires_at__lte=now)
+        users = list(due.values("id", "tg_id", "name", "expires_at"))
+        if not users:
+            return [], []
+        anns = Announcement.objects.filter(active=True, driver_id__in=due.values("tg_id"))
+        ann_ids = list(anns.values_list("id", flat=True))
+        anns.update(active=False, next_run_at=None)
+        due.update(active=False)
+    return users, ann_ids
@@ -0,0 +1,105 @@
+# taxiapp/routing.py
+from aiogram import Bot, Router, types
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.filters import CommandObject
+from aiogram.fsm.state import State
+
+
+class ButtonRouter(Router):
+    """
+    Router that picks handlers with dict lookups instead of trying a filter
+    per handler (aiogram runs every plain-function filter, lambdas and bare
+    States included, through a thread pool executor). Messages go by exact
+    reply-keyboard text, then /command, then FSM state; callback queries by
+    the ``prefix:`` of their data. Anything the tables don't hold falls
+    through to handlers registered with ordinary filters.
+
+    Routed handlers get the usual injected arguments (``state``,
+    ``command`` …), and inner middlewares see them in ``data["handler"]``.
+    """
+
+    def __init__(self, *, name: str | None = None):
+        super().__init__(name=name)
+        self._texts: dict[str, HandlerObject] = {}
+        self._folded: dict[str, HandlerObject] = {}       # case-insensitive texts
+        self._commands: dict[str, HandlerObject] = {}
+        self._states: dict[str, HandlerObject] = {}
+        self._callbacks: dict[str, HandlerObject] = {}
+        # registered first, so the table wins over every filter handler
+        self.message.register(self._route, self._match)
+
+    def button(self, *texts: str, ignore_case: bool = False):
+        def register(callback):
+            handler = HandlerObject(callback)
+            for text in texts:
+                if ignore_case:
+                    self._folded[text.lower()] = handler
+                else:
+                    self._texts[text] = handler
+            return callback
+        return register
+
+    def command(self, *names: str):
+        def register(callback):
+            handler = HandlerObject(callback)
+            for name in names:
+                self._commands[name] = handler
+            return callback
+        return register
+
+    def state(self, *states: State):
+        def register(callback):
+            handler = HandlerObject(callback)
+            for state in states:
+                self._states[state.state] = handler
+            return callback
+        return register
+
+    def callback(self, *prefixes: str):
+        if not self._callbacks:
+            # only routers with callbacks subscribe to callback queries
+            self.callback_query.register(self._route, self._match_callback)
+
+        def register(callback):
+            handler = HandlerObject(callback)
+            for prefix in prefixes:
+                self._callbacks[prefix] = handler
+            return callback
+        return register
+
+    async def _match(self, message: types.Message, bot: Bot,
+                     raw_state: str | None = None) -> dict | bool:
+        text = message.text
+        if text:
+            handler = self._texts.get(text)
+            if handler is None and self._folded:
+                handler = self._folded.get(text.lower())
+            if handler is not None:
+                return {"handler": handler}
+            if text[0] == "/" and self._commands:
+                matched = await self._match_command(text, bot)
+                if matched:
+                    return matched
+        # free text, photos …: the handler of the chat's FSM state, if any
+        handler = self._states.get(raw_state) if raw_state is not None else None
+        return {"handler": handler} if handler is not None else False
+
+    async def _match_command(self, text: str, bot: Bot) -> dict | bool:
+        # same parsing as aiogram's Command filter
+        head, *args = text.split(maxsplit=1)
+        name, _, mention = head[1:].partition("@")
+        handler = self._commands.get(name)
+        if handler is None:
+            return False
+        if mention and mention.lower() != (await bot.me()).username.lower():
+            return False                # /cmd@another_bot in a group
+        command = CommandObject(prefix="/", command=name, mention=mention or None,
+                                args=args[0] if args else None)
+        return {"handler": handler, "command": command}
+
+    async def _match_callback(self, callback: types.CallbackQuery) -> dict | bool:
+        handler = self._callbacks.get((callback.data or "").partition(":")[0])
+        return {"handler": handler} if handler is not None else False
+
+    async def _route(self, event: types.TelegramObject, **data):
+        return await data["handler"].call(event, **data)
@@ -0,0 +1,370 @@
+# taxiapp/scheduler.py
+import asyncio
+import datetime
+import heapq
+import logging
+import random
+import time
+
+from taxiapp import repository
+from taxiapp.metrics import posting_lag_ratio, posting_lag_seconds
+
+log = logging.getLogger(__name__)
+
+
+def _to_dt(ts: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc)
+
+
+class SlotCalendar:
+    """
+    Expected sends per time slot of ``slot_seconds``. Runs are placed in the
+    least-loaded slot of a window, nearest to their target on ties. Wide
+    windows are sampled at ``max_candidates`` evenly spaced slots.
+    """
+
+    max_candidates = 48
+
+    def __init__(self, slot_seconds: float = 5, seed: int | None = None):
+        self.slot_seconds = slot_seconds
+        self._load: dict[int, float] = {}
+        self._held: dict[object, tuple[int, float]] = {}    # key → (slot, weight)
+        self._random = random.Random(seed)
+
+    def slot(self, ts: float) -> int:
+        return int(ts // self.slot_seconds)
+
+    def hold(self, key, ts: float, weight: float):
+        self.release(key)
+        s = self.slot(ts)
+        self._load[s] = self._load.get(s, 0.0) + weight
+        self._held[key] = (s, weight)
+
+    def release(self, key):
+        held = self._held.pop(key, None)
+        if held is None:
+            return
+        s, weight = held
+        left = self._load[s] - weight
+        if left > 1e-9:
+            self._load[s] = left
+        else:
+            del self._load[s]
+
+    def place(self, key, target: float, before: float, after: float, weight: float,
+              now: float) -> float:
+        """Hold and return a time in [target - before, target + after], never before ``now``."""
+        earliest = max(now, target - before)
+        latest = max(earliest, target + after)
+        aim = self.slot(min(max(target, earliest), latest))
+        first, last = self.slot(earliest), self.slot(latest)
+        candidates = range(first, last + 1)
+        if len(candidates) > self.max_candidates:
+            step = len(candidates) / self.max_candidates
+            offset = self._random.random() * step
+            candidates = [aim] + [first + int(i * step + offset) for i in range(self.max_candidates)]
+        best = min(candidates, key=lambda s: (self._load.get(s, 0.0), abs(s - aim)))
+        # bounded jitter: anywhere inside the chosen slot
+        start = best * self.slot_seconds
+        ts = min(max(start + self._random.random() * self.slot_seconds, earliest), latest)
+        self.hold(key, ts, weight)
+        return ts
+
+    def curve(self, start: float, end: float) -> list[float]:
+        return [self._load.get(s, 0.0) for s in range(self.slot(start), self.slot(end) + 1)]
+
+
+class AnnouncementScheduler:
+    """
+    Single timer for every active announcement.
+
+    Entries live in a min-heap ordered by next run time; ``cancel`` and
+    re-``schedule`` only bump a generation number so stale heap entries are
+    skipped lazily; ``cancel`` also stops the announcement's run in flight.
+    One announcement never has more than one run in flight.
+    ``runner(ann_id)`` performs a cycle and returns ``(interval minutes,
+    sends)``, or ``None`` when the announcement should no longer be scheduled.
+
+    Runs are load-leveled: each announcement keeps a nominal cadence
+    (previous nominal + interval) and the actual run is moved to the
+    least-loaded slot within ``max_shift`` of it, so bursts of equal
+    intervals spread out without changing anyone's average rate. New
+    announcements start within ``start_spread``; overdue ones found by
+    ``load`` are spread over their interval, at most ``catchup_spread``.
+
+    ``drain`` stops starting runs and waits for the ones in flight, so a
+    restart resumes from the persisted next run times. ``caught_up`` is set
+    once every announcement that was overdue or cut short at ``load`` ran.
+    """
+
+    def __init__(self, runner, slot_seconds: float = 5, shift_fraction: float = 0.1,
+                 max_shift: float = 300, start_spread: float = 60, catchup_spread: float = 300,
+                 leveling: bool = True, lag_observer=None, seed: int | None = None):
+        self._runner = runner
+        self._heap: list[tuple[float, int, int]] = []   # (run_at, gen, ann_id)
+        self._gen: dict[int, int] = {}                  # ann_id → live generation
+        self._seq = 0
+        self._inflight: set[int] = set()
+        self._deferred: set[int] = set()                # came due while running
+        self._tasks: dict[int, asyncio.Task] = {}      # ann_id → run in flight
+        self._leaving: set[int] = set()                 # handed over once their run ends
+        self._wakeup = asyncio.Event()
+        self.calendar = SlotCalendar(slot_seconds, seed)
+        self._nominal: dict[int, float] = {}            # ann_id → unshifted next run
+        self._weight: dict[int, float] = {}             # ann_id → sends per run
+        self._weight_sum = 0.0
+        self._shift_fraction = shift_fraction if leveling else 0.0
+        self._max_shift = max_shift
+        self._start_spread = start_spread if leveling else 0.0
+        self._catchup_spread = catchup_spread if leveling else 0.0
+        self._lag_observer = lag_observer               # (ann_id, lag seconds)
+        self._draining = False
+        self._catching_up: set[int] = set()
+        self.caught_up = asyncio.Event()
+
+    def __len__(self):
+        return len(self._gen)
+
+    def __contains__(self, ann_id):
+        return ann_id in self._gen
+
+    @property
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+    def next_run(self, ann_id: int) -> float | None:
+        gen = self._gen.get(ann_id)
+        if gen is None:
+            return None
+        return next((ts for ts, g, a in self._heap if a == ann_id and g == gen), None)
+
+    def _set_weight(self, ann_id: int, sends: float):
+        self._weight_sum += sends - self._weight.get(ann_id, 0.0)
+        self._weight[ann_id] = sends
+
+    def _typical_weight(self) -> float:
+        return self._weight_sum / len(self._weight) if self._weight else 1.0
+
+    def _push(self, ann_id: int, run_at: float):
+        self._seq += 1
+        self._gen[ann_id] = self._seq
+        heapq.heappush(self._heap, (run_at, self._seq, ann_id))
+        if self._heap[0][2] == ann_id:
+            self._wakeup.set()
+        # cancelled entries pile up under churn – rebuild once they dominate
+        if len(self._heap) > 2 * len(self._gen) + 64:
+            self._heap = [e for e in self._heap if self._gen.get(e[2]) == e[1]]
+            heapq.heapify(self._heap)
+
+    def _place(self, ann_id: int, target: float, before: float, after: float,
+               now: float | None = None) -> float:
+        weight = self._weight.get(ann_id) or self._typical_weight()
+        return self.calendar.place(ann_id, target, before, after, weight,
+                                   time.time() if now is None else now)
+
+    def place_restored(self, ann_id: int, next_run: float | None, interval: float,
+                       sends: float, cut_short: bool, now: float) -> float:
+        """Hold and return the first run of a row ``load`` finds in the database."""
+        self._set_weight(ann_id, sends)
+        run_at = next_run if next_run is not None else now
+        if run_at > now and not cut_short:
+            self.calendar.hold(ann_id, run_at, sends)
+        else:
+            spread = self._start_spread if cut_short else min(interval * 60, self._catchup_spread)
+            run_at = self._place(ann_id, now, 0, spread, now)
+            self._catching_up.add(ann_id)
+        self._nominal[ann_id] = run_at
+        return run_at
+
+    def place_next(self, ann_id: int, interval: float, now: float) -> float:
+        """Hold and return the run after one that ended at ``now``."""
+        period = interval * 60
+        nominal = self._nominal.get(ann_id, now) + period
+        if nominal < now:
+            nominal = now           # fell behind: don't replay the missed cycles
+        self._nominal[ann_id] = nominal
+        shift = min(period * self._shift_fraction, self._max_shift)
+        return self._place(ann_id, nominal, shift, shift, now)
+
+    async def load(self, owns=None) -> int:
+        """
+        Bulk-load every active announcement (only drivers for which
+        ``owns(driver_id)`` is true, if given) and drop the ones that are no
+        longer active or owned. Cycles cut short by a shutdown resume first,
+        then overdue ones are spread over the catch-up window.
+        """
+        rows = await repository.active_schedule()
+        now = time.time()
+        live = set()
+        for ann_id, next_run_at, driver_id, interval, sends, cut_short in rows:
+            if owns is not None and not owns(driver_id):
+                continue
+            live.add(ann_id)
+            if ann_id in self._gen:
+                continue
+            run_at = self.place_restored(ann_id, next_run_at.timestamp() if next_run_at else None,
+                                         interval, sends, cut_short, now)
+            self._push(ann_id, run_at)
+        for ann_id in [a for a in self._gen if a not in live]:
+            self.cancel(ann_id)
+        if self._catching_up:
+            self.caught_up.clear()
+        else:
+            self.caught_up.set()
+        log.info("Scheduler holds %d active announcements, %d to catch up",
+                 len(live), len(self._catching_up))
+        return len(live)
+
+    async def hand_over(self, owns, timeout: float) -> int:
+        """
+        Drop the announcements of drivers ``owns(driver_id)`` rejects. Their
+        runs in flight get ``timeout`` seconds to finish and persist the next
+        run, so the new owner keeps the cadence instead of repeating the
+        cycle; returns how many were cut off (those resume their pending
+        groups).
+        """
+        rows = await repository.active_schedule()
+        leaving = [row[0] for row in rows if row[0] in self._gen and not owns(row[2])]
+        running = [self._tasks[a] for a in leaving if a in self._tasks]
+        self._leaving.update(leaving)
+        pending = set()
+        try:
+            if running:
+                _, pending = await asyncio.wait(running, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            for ann_id in leaving:
+                self.cancel(ann_id)
+            self._leaving.difference_update(leaving)
+        if leaving:
+            log.info("Handed over %d announcements, %d cut off", len(leaving), len(pending))
+        return len(pending)
+
+    async def schedule(self, ann_id: int, run_at: float | None = None):
+        """Queue a run at ``run_at``, or soon (within ``start_spread``) if not given."""
+        if run_at is None:
+            run_at = self._place(ann_id, time.time(), 0, self._start_spread)
+        else:
+            self.calendar.hold(ann_id, run_at, self._weight.get(ann_id) or self._typical_weight())
+        self._nominal[ann_id] = run_at
+        self._push(ann_id, run_at)
+        await self._persist(ann_id, run_at)
+
+    async def _reschedule(self, ann_id: int, interval: float):
+        run_at = self.place_next(ann_id, interval, time.time())
+        self._push(ann_id, run_at)
+        await self._persist(ann_id, run_at)
+
+    def _ran(self, ann_id: int):
+        self._catching_up.discard(ann_id)
+        if not self._catching_up:
+            self.caught_up.set()
+
+    def cancel(self, ann_id: int):
+        self._ran(ann_id)
+        self._gen.pop(ann_id, None)
+        self._deferred.discard(ann_id)
+        self._nominal.pop(ann_id, None)
+        self._weight_sum -= self._weight.pop(ann_id, 0.0)
+        self.calendar.release(ann_id)
+        task = self._tasks.get(ann_id)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()               # a stopped announcement doesn't finish its cycle
+
+    async def _persist(self, ann_id: int, run_at: float | None):
+        await repository.set_next_run(ann_id, _to_dt(run_at) if run_at is not None else None)
+
+    async def run(self):
+        self._draining = False          # started again after a drain
+        while not self._draining:
+            while self._heap and self._gen.get(self._heap[0][2]) != self._heap[0][1]:
+                heapq.heappop(self._heap)
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            run_at, gen, ann_id = heapq.heappop(self._heap)
+            self.calendar.release(ann_id)
+            if ann_id in self._inflight:
+                self._deferred.add(ann_id)
+                continue
+            task = asyncio.create_task(self._run(ann_id, gen, run_at))
+            self._tasks[ann_id] = task
+            task.add_done_callback(lambda _, ann_id=ann_id: self._tasks.pop(ann_id, None))
+
+    async def _run(self, ann_id: int, gen: int, run_at: float):
+        lag = max(0.0, time.time() - run_at)
+        posting_lag_seconds.observe(lag)
+        if self._lag_observer is not None:
+            self._lag_observer(ann_id, lag)
+        self._inflight.add(ann_id)
+        result = None
+        try:
+            result = await self._runner(ann_id)
+        except Exception:
+            log.exception("Announcement %s run failed", ann_id)
+            result = await self._retry_interval(ann_id)
+        finally:
+            self._inflight.discard(ann_id)
+            self._ran(ann_id)
+
+        interval, sends = result if result is not None else (None, None)
+        if interval:
+            posting_lag_ratio.observe(lag / (interval * 60))
+        if ann_id not in self._gen:
+            return                                      # stopped meanwhile
+        if interval is None:
+            self.cancel(ann_id)
+            await self._persist(ann_id, None)
+        elif ann_id in self._deferred:
+            self._deferred.discard(ann_id)
+            await self.schedule(ann_id)
+        elif self._gen[ann_id] == gen:
+            self._set_weight(ann_id, sends)
+            await self._reschedule(ann_id, interval)
+        if ann_id in self._leaving:
+            self.cancel(ann_id)                         # persisted; the new owner runs it
+
+    async def _retry_interval(self, ann_id: int) -> tuple[int, float] | None:
+        # keep the cadence after a crashed cycle as long as the row is active
+        try:
+            interval = await repository.announcement_interval(ann_id)
+        except Exception:
+            log.exception("Could not reload announcement %s", ann_id)
+            return None
+        if interval is None:
+            return None
+        return interval, self._weight.get(ann_id) or self._typical_weight()
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Stop starting runs and give the ones in flight ``timeout`` seconds
+        to finish and persist their next run; returns how many were cut off.
+        """
+        self._draining = True
+        self._wakeup.set()
+        if not self._tasks:
+            return 0
+        _, pending = await asyncio.wait(list(self._tasks.values()), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            log.warning("Cancelled %d runs still going after %.0fs", len(pending), timeout)
+        return len(pending)
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,170 @@
+# taxiapp/sessions.py
+#
+# Telethon sessions stored in Driver.session instead of one SQLite file per
+# driver under sessions/.
+import asyncio
+import json
+import logging
+
+from telethon.sessions import MemorySession, StringSession
+
+from taxiapp import repository
+
+log = logging.getLogger(__name__)
+
+
+def has_auth(data: str) -> bool:
+    return data not in ("", "-")                # "-": placeholder until /login
+
+
+def decode(data: str) -> tuple[str, list]:
+    """Driver.session → (StringSession string, entity rows)."""
+    if not has_auth(data):
+        return "", []
+    if data.startswith("{"):
+        doc = json.loads(data)
+        return doc.get("auth", ""), doc.get("entities", [])
+    return data, []                             # a bare StringSession string
+
+
+class DbSession(MemorySession):
+    """
+    Telethon session kept in ``Driver.session`` as JSON: the StringSession
+    auth data (DC + auth key) plus the entity cache, capped at
+    ``max_entities`` rows. Telethon calls ``save`` after auth key and DC
+    changes and on disconnect; the session is only queued for writing when
+    its serialized form differs from what was loaded.
+    """
+
+    max_entities = 500
+
+    def __init__(self, store: "SessionStore", tg_id: int, data: str = ""):
+        super().__init__()
+        self._store = store
+        self.tg_id = tg_id
+        self._stored = data
+        auth, entities = decode(data)
+        if auth:
+            loaded = StringSession(auth)
+            self._dc_id, self._server_address = loaded.dc_id, loaded.server_address
+            self._port, self._auth_key = loaded.port, loaded.auth_key
+        self._entities = {tuple(row) for row in entities}
+
+    def dump(self) -> str:
+        auth = StringSession.save(self)
+        if not auth:
+            return ""
+        entities = sorted(self._entities, key=lambda row: row[0])
+        return json.dumps({"auth": auth, "entities": entities[:self.max_entities]},
+                          separators=(",", ":"))
+
+    def detach(self):
+        # a new login replaced this session: later saves must not write it back
+        self._store = None
+
+    def save(self):
+        if self._store is None:
+            return
+        data = self.dump()
+        if data != self._stored:
+            self._stored = data
+            self._store.mark(self.tg_id, data)
+
+    def close(self):
+        self.save()
+
+    def delete(self):
+        # log_out(): forget the auth key so the row goes back to "no session"
+        self._auth_key = None
+        self._entities = set()
+        self.save()
+
+
+class SessionStore:
+    """
+    Serialized sessions of the drivers this process posts for. ``load``
+    fetches them all in one query at startup; sessions changed by Telethon
+    are written back in one batch by ``flush``, which ``run`` calls shortly
+    after a change.
+    """
+
+    def __init__(self, flush_interval: float = 5):
+        self._flush_interval = flush_interval
+        self._data: dict[int, str] = {}
+        self._dirty: dict[int, str] = {}
+        self._lock = asyncio.Lock()
+        self._kick = asyncio.Event()
+        self.fetched = 0
+        self.written = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    async def load(self, owns=None) -> int:
+        sessions = await repository.driver_sessions()
+        self._data = {tg_id: data for tg_id, data in sessions.items() if owns is None or owns(tg_id)}
+        self._data.update(self._dirty)
+        log.info("Loaded %d Telethon sessions", len(self._data))
+        return len(self._data)
+
+    async def has_session(self, tg_id: int) -> bool:
+        """True if the driver has auth data; re-reads the row if we hold none."""
+        if not has_auth(self._data.get(tg_id, "")):
+            self.fetched += 1
+            self._data[tg_id] = await repository.driver_session(tg_id) or ""
+        return has_auth(self._data[tg_id])
+
+    def session(self, tg_id: int) -> DbSession:
+        return DbSession(self, tg_id, self._data.get(tg_id, ""))
+
+    async def fresh_session(self, tg_id: int) -> DbSession:
+        self.forget(tg_id)
+        await self.has_session(tg_id)
+        return self.session(tg_id)
+
+    def forget(self, tg_id: int, drop_pending: bool = False):
+        # a pending write is kept unless the caller knows it is stale
+        if drop_pending:
+            self._dirty.pop(tg_id, None)
+        if tg_id not in self._dirty:
+            self._data.pop(tg_id, None)
+
+    def mark(self, tg_id: int, data: str):
+        self._data[tg_id] = self._dirty[tg_id] = data
+        self._kick.set()
+
+    async def flush(self) -> int:
+        async with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return 0
+            try:
+                written = await repository.store_sessions(dirty)
+            except Exception:
+                log.exception("Writing %d Telethon sessions failed", len(dirty))
+                self._dirty = dirty | self._dirty       # retry on the next flush
+                return 0
+            self.written += written
+            return written
+
+    async def run(self):
+        while True:
+            await self._kick.wait()
+            self._kick.clear()
+            # coalesce the saves of a burst of disconnects into one write
+            await asyncio.sleep(self._flush_interval)
+            await asyncio.shield(self.flush())
+
+    async def close(self):
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._data),
+            "pending":  len(self._dirty),
+            "fetched":  self.fetched,
+            "written":  self.written,
+        }
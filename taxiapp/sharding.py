@@ -0,0 +1,187 @@
+# taxiapp/sharding.py
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import sys
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of driver ids onto worker ids."""
+
+    def __init__(self, nodes=(), replicas: int = 64):
+        self._replicas = replicas
+        self._points: list[int] = []
+        self._owners: list[int] = []
+        self.nodes: set[int] = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: int):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for r in range(self._replicas):
+            point = _hash(f"{node}:{r}")
+            i = bisect.bisect(self._points, point)
+            self._points.insert(i, point)
+            self._owners.insert(i, node)
+
+    def remove(self, node: int):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        keep = [(p, o) for p, o in zip(self._points, self._owners) if o != node]
+        self._points = [p for p, _ in keep]
+        self._owners = [o for _, o in keep]
+
+    def owner(self, key: int) -> int | None:
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, _hash(str(key))) % len(self._points)
+        return self._owners[i]
+
+
+class ShardCoordinator:
+    """
+    Runs ``workers`` posting_worker processes and routes start/stop commands
+    to the worker that owns the driver. On every membership change the
+    workers hand over the drivers that moved, then reconcile their own shard
+    from the database; a dead worker's drivers move to the survivors until
+    it is respawned. Commands are JSON lines on the worker's stdin, hand-over
+    acknowledgements JSON lines on its stdout.
+    """
+
+    def __init__(self, workers: int, respawn_delay: float = 5):
+        self._workers = workers
+        self._respawn_delay = respawn_delay
+        self._procs: dict[int, asyncio.subprocess.Process] = {}
+        self._watchers: set[asyncio.Task] = set()
+        self._closing = False
+        self._rebalancing = asyncio.Lock()
+        self._version = 0
+        self._acked: dict[int, int] = {}                # worker id → last released ring
+        self._acks = asyncio.Event()
+        self.ring = HashRing()
+        self.respawns = 0
+
+    async def open(self):
+        self._closing = False           # reopened after a failed start
+        for worker_id in range(self._workers):
+            await self._spawn(worker_id)
+        # one ring once all are up, not one per spawned worker
+        await self._rebalance()
+
+    async def _spawn(self, worker_id: int):
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, str(settings.BASE_DIR / "manage.py"),
+            "posting_worker", "--worker-id", str(worker_id),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        self._procs[worker_id] = proc
+        self.ring.add(worker_id)
+        log.info("Posting worker %d started (pid %d)", worker_id, proc.pid)
+        task = asyncio.create_task(self._watch(worker_id, proc))
+        self._watchers.add(task)
+        task.add_done_callback(self._watchers.discard)
+
+    async def _watch(self, worker_id: int, proc):
+        async for line in proc.stdout:
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if msg.get("op") == "released":
+                self._acked[worker_id] = msg["version"]
+                self._acks.set()
+        code = await proc.wait()
+        if self._procs.get(worker_id) is proc:
+            del self._procs[worker_id]
+        self.ring.remove(worker_id)
+        self._acks.set()                # a rebalance stops waiting for it
+        if self._closing:
+            return
+        log.error("Posting worker %d exited with %s, rebalancing", worker_id, code)
+        await self._rebalance()
+        await asyncio.sleep(self._respawn_delay)
+        if not self._closing:
+            self.respawns += 1
+            await self._spawn(worker_id)
+            await self._rebalance()
+
+    def _send(self, worker_id: int, message: dict) -> bool:
+        proc = self._procs.get(worker_id)
+        if proc is None or proc.stdin is None or proc.stdin.is_closing():
+            return False
+        proc.stdin.write(json.dumps(message).encode() + b"\n")
+        return True
+
+    async def _rebalance(self, timeout: float | None = None):
+        # two phases, so no driver is posted by two workers at once: each
+        # worker hands over the drivers it lost (runs in flight finish and
+        # persist their next run) and acknowledges; then all load their
+        # shard. A worker that doesn't answer in time is not waited for.
+        if timeout is None:
+            timeout = settings.SHUTDOWN_DRAIN_SECONDS + 15
+        async with self._rebalancing:
+            self._version += 1
+            ring = {"op": "ring", "nodes": sorted(self.ring.nodes), "version": self._version}
+            sent = [w for w in list(self._procs) if self._send(w, ring)]
+            try:
+                await asyncio.wait_for(self._released(sent, self._version), timeout)
+            except asyncio.TimeoutError:
+                log.warning("Posting workers did not hand over ring %d in %.0fs",
+                            self._version, timeout)
+            for worker_id in list(self._procs):
+                self._send(worker_id, {"op": "load"})
+
+    async def _released(self, workers: list[int], version: int):
+        while any(w in self._procs and self._acked.get(w, 0) < version for w in workers):
+            self._acks.clear()
+            await self._acks.wait()
+
+    def _to_owner(self, driver_id: int, message: dict):
+        owner = self.ring.owner(driver_id)
+        if owner is None or not self._send(owner, message):
+            # the next ring reconcile picks it up from the database
+            log.warning("No live posting worker for driver %s", driver_id)
+
+    async def start(self, ann_id: int, driver_id: int):
+        self._to_owner(driver_id, {"op": "start", "ann": ann_id})
+
+    async def stop(self, ann_id: int, driver_id: int | None = None):
+        if driver_id is None:
+            for worker_id in list(self._procs):
+                self._send(worker_id, {"op": "stop", "ann": ann_id})
+        else:
+            self._to_owner(driver_id, {"op": "stop", "ann": ann_id})
+
+    async def release(self, driver_id: int):
+        self._to_owner(driver_id, {"op": "release", "driver": driver_id})
+
+    async def close(self, timeout: float | None = None):
+        # workers drain their in-flight cycles first, then flush
+        if timeout is None:
+            timeout = settings.SHUTDOWN_DRAIN_SECONDS + 15
+        self._closing = True
+        for proc in self._procs.values():
+            if proc.stdin is not None:
+                proc.stdin.close()          # EOF → worker shuts down cleanly
+        procs = list(self._procs.values())
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.wait() for p in procs)), timeout)
+        except asyncio.TimeoutError:
+            for proc in procs:
+                if proc.returncode is None:
+                    proc.kill()
+        for task in list(self._watchers):
+            task.cancel()
@@ -1,3 +1,809 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import os
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramUnauthorizedError
+from aiogram.filters import CommandObject
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import GetMe, SendMessage, SetWebhook
+from aiogram.types import Chat, Message, Update, User
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from telethon.errors import ChannelInvalidError, FloodWaitError
+from telethon.sessions import MemorySession
+from telethon.tl import types
+
+import onboarding_bot
+from taxiapp import botpool, posting, repository
+from taxiapp.broadcast import Broadcaster
+from taxiapp.content import ContentCache
+from taxiapp.clientpool import ClientPool, PoolDraining
+from taxiapp.faketelegram import FakeTelegram, fake_session
+from taxiapp.fanout import CycleReport, FanOut
+from taxiapp.fsmstorage import DbStorage
+from taxiapp.ingest import UpdateQueue
+from taxiapp.journal import DeliveryJournal
+from taxiapp.leader import LeaderLock, RelayedControl
+from taxiapp.logins import LoginManager, TooManyLogins
+from taxiapp.management.commands.bench_queries import hot_queries, seed
+from taxiapp.models import (
+    ActiveUser, Announcement, Broadcast, ControlCommand, Delivery, Driver, DriverBot, FsmState,
+)
+from taxiapp.peercache import PeerCache
+from taxiapp.routing import ButtonRouter
+from taxiapp.scheduler import AnnouncementScheduler, SlotCalendar
+from taxiapp.sessions import SessionStore
+from taxiapp.sharding import HashRing
+from taxiapp.tokens import registry
+from taxiapp.usercache import ActiveUserCache, user_cache
+
+
+class HotQueryPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seed(drivers=2000, users=5000)
+
+    def test_hot_queries_use_an_index(self):
+        for name, qs in hot_queries().items():
+            with self.subTest(query=name):
+                plan = qs.explain()
+                self.assertRegex(plan, r"USING (COVERING )?INDEX", plan)
+                # a SCAN is only fine when it walks a (partial) index
+                self.assertNotRegex(plan, r"(?m)SCAN taxiapp_\w+\s*$", plan)
+
+
+class MetricsEndpointTests(TestCase):
+    def test_metrics_need_the_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+        with override_settings(METRICS_TOKEN="t0ken"):
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer x"}).status_code, 401)
+
+    @override_settings(METRICS_TOKEN="t0ken")
+    def test_metrics_are_prometheus_text(self):
+        Driver.objects.count()      # at least one timed query
+        response = self.client.get("/metrics", headers={"Authorization": "Bearer t0ken"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        body = response.content.decode()
+        self.assertIn("# TYPE taxi_db_query_seconds histogram", body)
+        self.assertRegex(body, r'taxi_db_query_seconds_bucket\{alias="default",le="\+Inf"\} [1-9]')
+        self.assertIn("taxi_webhook_queue_depth 0", body)
+
+
+class DeliveryJournalTests(TestCase):
+    async def test_flush_skips_outcomes_of_deleted_announcements(self):
+        driver = await Driver.objects.acreate(tg_id=1, api_id=1, api_hash="x", session="-")
+        kept = await Announcement.objects.acreate(driver=driver, groups=["@a"], text="t", interval_minutes=5)
+        gone = await Announcement.objects.acreate(driver=driver, groups=["@b"], text="t", interval_minutes=5)
+        journal = DeliveryJournal(flush_size=10)
+        report = CycleReport(outcomes=[("@a", "sent", 0.25, ""), ("@b", "failed", None, "ValueError")])
+        journal.record(kept.id, driver.tg_id, report)
+        journal.record(gone.id, driver.tg_id, report)
+        await gone.adelete()
+
+        await journal.flush()
+
+        self.assertEqual(len(journal), 0)
+        rows = [r async for r in Delivery.objects.order_by("id")]
+        self.assertEqual([(r.announcement_id, r.status, r.latency_ms) for r in rows],
+                         [(kept.id, "sent", 250), (kept.id, "failed", None)])
+
+
+class ContentCacheTests(SimpleTestCase):
+    def test_parsed_once_per_edit(self):
+        cache = ContentCache()
+        first = cache.get(1, "t1", "**Taxi** daily")
+        self.assertEqual(first.text, "Taxi daily")
+        self.assertEqual([(e.offset, e.length) for e in first.entities], [(0, 4)])
+        self.assertIs(cache.get(1, "t1", "**Taxi** daily"), first)
+        self.assertEqual(cache.get(1, "t2", "edited").text, "edited")
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+
+class SlotCalendarTests(SimpleTestCase):
+    def test_equal_targets_spread_within_window(self):
+        calendar = SlotCalendar(slot_seconds=5, seed=1)
+        placed = [calendar.place(i, 1000, 30, 30, 10, now=0) for i in range(13)]
+        self.assertTrue(all(970 <= ts <= 1030 for ts in placed))
+        self.assertEqual(max(calendar.curve(970, 1030)), 10)
+        calendar.release(0)
+        self.assertEqual(sum(calendar.curve(970, 1030)), 120)
+
+
+class SessionStoreTests(TransactionTestCase):
+    # the store reads on the repository read pool, outside the test transaction
+    async def test_sessions_written_back_only_when_changed(self):
+        await Driver.objects.acreate(tg_id=1, api_id=1, api_hash="x", session=fake_session())
+        await Driver.objects.acreate(tg_id=2, api_id=2, api_hash="x", session="-")
+        store = SessionStore()
+        self.assertEqual(await store.load(), 1)
+        self.assertFalse(await store.has_session(2))
+
+        session = store.session(1)
+        session.save()                          # Telethon saves on every disconnect
+        self.assertEqual(await store.flush(), 1)
+        session = store.session(1)
+        session.save()
+        self.assertEqual(await store.flush(), 0)
+
+        session.process_entities([types.User(id=42, access_hash=7, username="rider")])
+        session.close()
+        self.assertEqual(await store.flush(), 1)
+        stored = store.session(1)
+        self.assertEqual(stored.get_input_entity("rider"), types.InputPeerUser(42, 7))
+        self.assertEqual((await Driver.objects.aget(tg_id=1)).session, stored.dump())
+
+
+class UpdateQueueTests(SimpleTestCase):
+    async def test_close_handles_queued_updates_and_lag_ages_out(self):
+        handled = []
+
+        async def handler(bot, update):
+            await asyncio.sleep(0.02)
+            handled.append(update.update_id)
+
+        queue = UpdateQueue(handler, workers=2, lag_window=0.05)
+        for i in range(4):
+            self.assertTrue(queue.put(None, Update(update_id=i, message=Message(
+                message_id=i, date=0, text="hi", chat=Chat(id=i, type="private")))))
+        await queue.close(timeout=5)
+        self.assertEqual(sorted(handled), [0, 1, 2, 3])
+        self.assertGreater(queue.max_lag, 0)
+        await asyncio.sleep(0.12)               # two quiet windows
+        self.assertEqual(queue.max_lag, 0)
+
+
+class HashRingTests(SimpleTestCase):
+    def test_membership_change_moves_about_one_nth_of_keys(self):
+        keys = range(2000)
+        ring = HashRing([0, 1, 2, 3])
+        before = {k: ring.owner(k) for k in keys}
+        self.assertEqual(before, {k: HashRing([3, 2, 1, 0]).owner(k) for k in keys})   # stable
+
+        ring.add(4)
+        moved = [k for k in keys if ring.owner(k) != before[k]]
+        self.assertEqual({ring.owner(k) for k in moved}, {4})       # only to the new worker
+        self.assertAlmostEqual(len(moved) / len(keys), 1 / 5, delta=0.08)
+
+        ring.remove(4)
+        self.assertEqual({k: ring.owner(k) for k in keys}, before)
+        ring.remove(2)
+        moved = [k for k in keys if ring.owner(k) != before[k]]
+        self.assertEqual({before[k] for k in moved}, {2})            # only the removed one's
+        self.assertAlmostEqual(len(moved) / len(keys), 1 / 4, delta=0.08)
+
+
+class SchedulerTests(TransactionTestCase):
+    async def announcements(self, count: int = 1, **fields) -> list[Announcement]:
+        driver = await Driver.objects.acreate(tg_id=1, api_id=1, api_hash="x", session="-")
+        return [await Announcement.objects.acreate(driver=driver, groups=["@a"], text="t",
+                                                   interval_minutes=10, **fields)
+                for _ in range(count)]
+
+    async def run_for(self, scheduler: AnnouncementScheduler, seconds: float):
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(seconds)
+        task.cancel()
+
+    async def test_one_run_in_flight_per_announcement(self):
+        [ann] = await self.announcements()
+        release, running, peaks = asyncio.Event(), [], []
+
+        async def runner(ann_id):
+            running.append(ann_id)
+            peaks.append(len(running))
+            await release.wait()
+            running.remove(ann_id)
+            return 10, 1
+
+        scheduler = AnnouncementScheduler(runner, leveling=False)
+        await scheduler.schedule(ann.id)
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.05)
+        await scheduler.schedule(ann.id)            # due again while the first run is going
+        await asyncio.sleep(0.05)
+        self.assertEqual(peaks, [1])
+        release.set()                               # the deferred run follows right after
+        await asyncio.sleep(0.05)
+        task.cancel()
+        self.assertEqual(peaks, [1, 1])
+
+    async def test_replaced_and_cancelled_entries_do_not_run(self):
+        kept, cancelled = await self.announcements(2)
+        runs = []
+
+        async def runner(ann_id):
+            runs.append(ann_id)
+            return 10, 1
+
+        scheduler = AnnouncementScheduler(runner, leveling=False)
+        now = time.time()
+        await scheduler.schedule(kept.id, now + 0.05)
+        await scheduler.schedule(kept.id, now + 0.1)        # new generation replaces it
+        await scheduler.schedule(cancelled.id, now + 0.05)
+        scheduler.cancel(cancelled.id)
+        await self.run_for(scheduler, 0.3)
+        self.assertEqual(runs, [kept.id])
+        self.assertNotIn(cancelled.id, scheduler)
+
+    async def test_next_run_is_one_interval_after_the_last(self):
+        [ann] = await self.announcements()
+
+        async def runner(ann_id):
+            return 10, 1
+
+        scheduler = AnnouncementScheduler(runner, leveling=False)
+        run_at = time.time()
+        await scheduler.schedule(ann.id, run_at)
+        await self.run_for(scheduler, 0.05)
+        self.assertAlmostEqual(scheduler.next_run(ann.id), run_at + 600, delta=0.01)
+        await ann.arefresh_from_db()
+        self.assertAlmostEqual(ann.next_run_at.timestamp(), run_at + 600, delta=0.01)
+
+    async def test_load_restores_next_run_at(self):
+        later = timezone.now() + datetime.timedelta(hours=1)
+        due, overdue = await self.announcements(2)
+        await Announcement.objects.filter(id=due.id).aupdate(next_run_at=later)
+        await Announcement.objects.filter(id=overdue.id).aupdate(
+            next_run_at=later - datetime.timedelta(days=1))
+
+        scheduler = AnnouncementScheduler(None, catchup_spread=60)
+        self.assertEqual(await scheduler.load(), 2)
+        self.assertAlmostEqual(scheduler.next_run(due.id), later.timestamp(), delta=0.001)
+        self.assertLess(scheduler.next_run(overdue.id), time.time() + 60)   # caught up soon
+        self.assertFalse(scheduler.caught_up.is_set())
+
+    async def test_cancel_stops_the_run_in_flight(self):
+        [ann] = await self.announcements()
+        stopped = asyncio.Event()
+
+        async def runner(ann_id):
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                stopped.set()
+                raise
+
+        scheduler = AnnouncementScheduler(runner, leveling=False)
+        await scheduler.schedule(ann.id)
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.05)
+        scheduler.cancel(ann.id)
+        await asyncio.wait_for(stopped.wait(), 1)
+        await asyncio.sleep(0)
+        task.cancel()
+        self.assertEqual((scheduler.inflight, scheduler.next_run(ann.id)), (0, None))
+
+
+class SchedulerHandOverTests(TransactionTestCase):
+    async def test_run_in_flight_persists_its_next_run_before_hand_over(self):
+        driver = await Driver.objects.acreate(tg_id=1, api_id=1, api_hash="x", session="-")
+        ann = await Announcement.objects.acreate(driver=driver, groups=["@a"], text="t",
+                                                 interval_minutes=10)
+        release = asyncio.Event()
+
+        async def runner(ann_id):
+            await release.wait()
+            return 10, 1
+
+        scheduler = AnnouncementScheduler(runner, leveling=False)
+        await scheduler.schedule(ann.id)           # no leveling: due right away
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.05)
+        self.assertEqual(scheduler.inflight, 1)
+
+        handing_over = asyncio.create_task(scheduler.hand_over(lambda driver_id: False, timeout=5))
+        await asyncio.sleep(0.05)
+        release.set()
+        self.assertEqual(await handing_over, 0)
+        task.cancel()
+
+        self.assertNotIn(ann.id, scheduler)
+        await ann.arefresh_from_db()
+        self.assertGreater(ann.next_run_at, timezone.now() + datetime.timedelta(minutes=9))
+
+
+class ClientPoolTests(SimpleTestCase):
+    def pool(self, **kwargs) -> ClientPool:
+        telegram = FakeTelegram(latency=0)
+        return ClientPool(lambda key: telegram.client(MemorySession(), 0, ""), **kwargs)
+
+    async def test_least_recently_used_client_is_evicted(self):
+        pool = self.pool(max_size=2)
+        for key in (1, 2, 1, 3):                # 1 is used again, so 2 is the oldest
+            async with pool.client(key, key):
+                pass
+        self.assertEqual(sorted(pool), [1, 3])
+        self.assertEqual((pool.hits, pool.misses, pool.evictions), (1, 3, 1))
+
+    async def test_idle_clients_are_dropped(self):
+        pool = self.pool(idle_timeout=0.05)
+        async with pool.client(1, 1):
+            pass
+        await pool.evict_idle()
+        self.assertEqual(len(pool), 1)
+        await asyncio.sleep(0.1)
+        await pool.evict_idle()
+        self.assertEqual(len(pool), 0)
+
+    async def test_client_is_handed_back_whatever_ends_its_use(self):
+        pool = self.pool(max_size=1)
+        for error in (asyncio.CancelledError(), FloodWaitError(request=None, capture=5), RuntimeError("db")):
+            with self.assertRaises(type(error)):
+                async with pool.client(1, 1):
+                    raise error
+        self.assertEqual((len(pool), pool.stats()["in_use"]), (1, 0))
+        async with pool.client(2, 2):           # 1 is not in use, so it can make room
+            pass
+        self.assertEqual(list(pool), [2])
+        with self.assertRaises(ConnectionError):
+            async with pool.client(2, 2):
+                raise ConnectionError("reset")
+        self.assertEqual(len(pool), 0)          # a broken transport is dropped
+
+    async def test_drain_stops_waiting_connects(self):
+        # the first handshake takes the only token and slot; the rest queue
+        # on the ramp-up (1/s) and the slot until the pool drains
+        telegram = FakeTelegram(latency=0.5, jitter=0)
+        pool = ClientPool(lambda key: telegram.client(MemorySession(), 0, ""),
+                          connect_rate=1, connect_concurrency=1)
+        pool_sem = ClientPool(lambda key: telegram.client(MemorySession(), 0, ""),
+                              connect_concurrency=1)
+
+        async def use(pool, key):
+            async with pool.client(key, key):
+                pass
+
+        tasks = [asyncio.create_task(use(p, key)) for p in (pool, pool_sem) for key in range(4)]
+        await asyncio.sleep(0.1)
+        started = time.monotonic()
+        pool.drain()
+        pool_sem.drain()
+        results = await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), 1)
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual([type(r) for r in results], [type(None)] + [PoolDraining] * 3
+                                                     + [type(None)] + [PoolDraining] * 3)
+        pool.resume()
+        await use(pool, 9)                      # reopened: connects again
+        self.assertIn(9, pool)
+
+
+class LoginReleaseTests(TransactionTestCase):
+    async def test_pooled_client_does_not_overwrite_a_new_login(self):
+        old, new = fake_session(1), fake_session(2)
+        await Driver.objects.acreate(tg_id=1, api_id=1, api_hash="x", session=old)
+        store = SessionStore()
+        telegram = FakeTelegram(latency=0)
+        pool = ClientPool(lambda tg_id: telegram.client(store.session(tg_id), 1, "x"))
+        with mock.patch.object(posting, "session_store", store), mock.patch.object(posting, "client_pool", pool):
+            await store.load()
+            async with pool.client(1, 1) as client:
+                # a cycle learns an entity, so its session differs from the stored one
+                client.session.process_entities([types.User(id=42, access_hash=7, username="rider")])
+            store.mark(1, new)                  # finish_login: the new session is saved ...
+            await store.flush()                 # ... and written
+            await posting.release_driver(1)
+            await store.flush()
+
+        self.assertEqual(len(pool), 0)
+        self.assertEqual((await Driver.objects.aget(tg_id=1)).session, new)
+
+
+class FanOutTests(SimpleTestCase):
+    async def test_flood_wait_parks_only_that_account(self):
+        fanout = FanOut(concurrency=1, rate=1000, burst=1000)
+        started = time.monotonic()
+        sent = {}
+
+        async def send(group):
+            if group == "@a" and group not in sent:
+                sent[group] = None
+                raise FloodWaitError(request=None, capture=1)
+            sent[group] = time.monotonic() - started
+
+        flooded, other = await asyncio.gather(
+            fanout.send_all(1, ["@a", "@b", "@c"], send),
+            fanout.send_all(2, ["@x", "@y"], send),
+        )
+        self.assertLess(max(sent["@x"], sent["@y"]), 0.5)           # not held up
+        self.assertGreaterEqual(min(sent["@a"], sent["@b"], sent["@c"]), 1)
+        self.assertEqual((flooded.sent, other.sent, fanout.flood_waits), (3, 2, 1))
+        self.assertEqual((flooded.throttled, other.throttled), (1, 0))   # @a's retry waited
+
+    async def test_sends_parked_past_max_wait_are_skipped_or_deferred(self):
+        fanout = FanOut(concurrency=1, rate=1000, burst=1000)
+
+        async def send(group):
+            raise FloodWaitError(request=None, capture=60)
+
+        report = await asyncio.wait_for(fanout.send_all(1, ["@a", "@b"], send, max_wait=30), 1)
+        self.assertEqual([o[:2] for o in report.outcomes], [("@a", "skipped"), ("@b", "skipped")])
+        self.assertEqual((report.sent, report.failed), (0, 2))
+
+        # within max_wait the sends wait out the park, unless a drain comes first
+        task = asyncio.create_task(fanout.send_all(1, ["@c", "@d"], send, max_wait=300))
+        await asyncio.sleep(0.05)
+        fanout.drain()
+        report = await asyncio.wait_for(task, 1)
+        self.assertEqual((report.sent, report.deferred), (0, ["@c", "@d"]))
+
+    async def test_concurrency_is_capped_per_account(self):
+        fanout = FanOut(concurrency=2, rate=1000, burst=1000)
+        running, peaks = {1: 0, 2: 0}, {1: 0, 2: 0}
+
+        def sender(key):
+            async def send(group):
+                running[key] += 1
+                peaks[key] = max(peaks[key], running[key])
+                await asyncio.sleep(0.02)
+                running[key] -= 1
+            return send
+
+        await asyncio.gather(*(fanout.send_all(key, [f"@g{i}" for i in range(6)], sender(key))
+                               for key in (1, 2)))
+        self.assertEqual(peaks, {1: 2, 2: 2})
+
+
+class FanOutDrainTests(SimpleTestCase):
+    async def test_drain_defers_groups_not_yet_sent(self):
+        fanout = FanOut(concurrency=1, rate=1000, burst=1000)
+        sent = []
+
+        async def send(group):
+            sent.append(group)
+            if group == "@b":
+                fanout.drain()              # shutdown starts mid-cycle
+
+        report = await fanout.send_all(1, ["@a", "@b", "@c", "@d"], send)
+        self.assertEqual(sent, ["@a", "@b"])
+        self.assertEqual((report.sent, report.deferred), (2, ["@c", "@d"]))
+
+        fanout.resume()                     # reopened: sends go out again
+        report = await fanout.send_all(1, ["@c", "@d"], send)
+        self.assertEqual((report.sent, report.deferred), (2, []))
+
+    async def test_drain_does_not_wait_for_the_rate_limit(self):
+        fanout = FanOut(concurrency=10, rate=1, burst=1)       # one send per second
+
+        async def send(group):
+            pass
+
+        task = asyncio.create_task(fanout.send_all(1, [f"@g{i}" for i in range(10)], send))
+        await asyncio.sleep(0.1)
+        started = time.monotonic()
+        fanout.drain()
+        report = await asyncio.wait_for(task, 1)
+        self.assertLess(time.monotonic() - started, 0.2)
+        self.assertEqual((report.sent, len(report.deferred)), (1, 9))
+
+
+class RelayedControlTests(TransactionTestCase):
+    async def test_follower_commands_reach_the_leader(self):
+        applied = []
+
+        class Control:
+            async def open(self):
+                pass
+
+            async def start(self, ann_id, driver_id):
+                applied.append(("start", ann_id))
+
+            async def release(self, driver_id):
+                applied.append(("release", driver_id))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            leader_lock = LeaderLock(os.path.join(tmp, "leader"))
+            follower_lock = LeaderLock(os.path.join(tmp, "leader"))
+            self.assertTrue(leader_lock.try_acquire())
+            self.assertFalse(follower_lock.try_acquire())
+            leader = RelayedControl(Control(), leader_lock, poll_interval=0.01)
+            follower = RelayedControl(Control(), follower_lock)
+
+            await follower.start(1, 10)         # the leader loads this one from the database
+            await leader.open()
+            await follower.start(2, 10)
+            await follower.release(10)
+            task = asyncio.create_task(leader.run())
+            for _ in range(100):
+                if len(applied) == 2:
+                    break
+                await asyncio.sleep(0.01)
+            task.cancel()
+
+            self.assertEqual(applied, [("start", 2), ("release", 10)])
+            self.assertEqual(await ControlCommand.objects.acount(), 0)
+            leader_lock.release()
+            self.assertTrue(follower_lock.try_acquire())
+            follower_lock.release()
+
+
+class PeerCacheTests(TransactionTestCase):
+    async def test_only_peer_errors_re_resolve(self):
+        await Driver.objects.acreate(tg_id=1, api_id=1, api_hash="x", session="")
+        client = mock.AsyncMock()
+        client.get_input_entity.side_effect = lambda name: types.InputPeerChannel(
+            5, client.get_input_entity.await_count)   # a new access hash per resolve
+        peers = PeerCache()
+        self.assertEqual(await peers.resolve(client, 1, ["@g"]), {})
+        cached = await peers.get(client, 1, "@g")
+
+        send = mock.AsyncMock(side_effect=ValueError("message too long"))
+        with self.assertRaises(ValueError):
+            await peers.call(client, 1, "@g", send)
+        self.assertEqual(peers.resolves, 1)
+        self.assertIs(await peers.get(client, 1, "@g"), cached)     # kept
+
+        for error in (ChannelInvalidError(request=None),
+                      ValueError("Could not find the input entity for PeerChannel(channel_id=5)")):
+            with self.subTest(error=type(error).__name__):
+                resolves = peers.resolves
+                send = mock.AsyncMock(side_effect=[error, "sent"])
+                self.assertEqual(await peers.call(client, 1, "@g", send), "sent")
+                self.assertEqual(peers.resolves, resolves + 1)          # once
+                fresh = await peers.get(client, 1, "@g")
+                self.assertEqual(send.await_args.args[0], fresh)
+                self.assertNotEqual(fresh.access_hash, cached.access_hash)
+
+
+class DbStorageTests(TransactionTestCase):
+    async def test_cleared_conversation_leaves_no_row(self):
+        context = FSMContext(DbStorage(), StorageKey(bot_id=1, chat_id=2, user_id=2))
+        await context.set_data({})                      # nothing to store
+        self.assertEqual(await FsmState.objects.acount(), 0)
+
+        await context.set_state("Setup:groups")
+        await context.update_data(groups=["@a"])
+        self.assertEqual((await context.get_state(), await context.get_data()),
+                         ("Setup:groups", {"groups": ["@a"]}))
+        await context.set_state(None)                   # data still there: row kept
+        self.assertEqual(await FsmState.objects.acount(), 1)
+        await context.clear()
+        self.assertEqual(await FsmState.objects.acount(), 0)
+        self.assertEqual((await context.get_state(), await context.get_data()), (None, {}))
+
+
+class ActiveUserCacheTests(TransactionTestCase):
+    async def test_cached_status_expires_and_is_dropped_on_save(self):
+        now = timezone.now()
+        cache = ActiveUserCache(ttl=60)
+        cache.set(1, True, now + datetime.timedelta(milliseconds=50))
+        self.assertTrue(await cache.is_active(1))
+        await asyncio.sleep(0.1)
+        self.assertFalse(await cache.is_active(1))          # ran out while cached
+        self.assertEqual((cache.hits, cache.misses), (2, 0))
+
+        user_cache.invalidate()
+        user = await ActiveUser.objects.acreate(name="u", phone="", tg_id=2, activated_at=now,
+                                                expires_at=now + datetime.timedelta(days=1))
+        self.assertTrue(await user_cache.is_active(2))
+        user.active = False
+        await user.asave()
+        self.assertFalse(await user_cache.is_active(2))
+        await user.adelete()
+        self.assertFalse(await user_cache.is_active(2))     # negative entry after delete
+        self.assertEqual(user_cache.misses, 3)
+
+
+class LoginManagerTests(SimpleTestCase):
+    async def test_pending_logins_expire_and_are_capped(self):
+        logins = LoginManager(ttl=0.05, max_pending=2)
+        clients = [mock.AsyncMock() for _ in range(4)]
+        await logins.put(1, clients[0])
+        await logins.put(1, clients[1])                 # a new login replaces the old one
+        clients[0].disconnect.assert_awaited_once()
+        await logins.put(2, clients[2])
+        with self.assertRaises(TooManyLogins):
+            await logins.put(3, clients[3])
+        self.assertIs(logins.get(1), clients[1])
+
+        await asyncio.sleep(0.1)
+        self.assertIsNone(logins.get(1))                # past the TTL
+        await logins.put(3, clients[3])                 # expired entries make room
+        self.assertEqual((len(logins), 3 in logins), (1, True))
+        clients[1].disconnect.assert_awaited_once()
+        clients[2].disconnect.assert_awaited_once()
+        self.assertEqual((logins.expired, logins.rejected), (2, 1))
+
+
+class UsersPageTests(TransactionTestCase):
+    async def test_every_user_listed_once_across_pages(self):
+        now, day = timezone.now(), datetime.timedelta(days=1)
+
+        async def add(count: int):
+            for _ in range(count):
+                tg_id = await ActiveUser.objects.acount() + 1
+                await ActiveUser.objects.acreate(name="u", phone="", tg_id=tg_id, activated_at=now,
+                                                 expires_at=now + day)
+
+        await add(25)
+        seen, after = [], None
+        while True:
+            rows, has_prev, has_next = await repository.users_page(after=after, limit=10)
+            self.assertEqual(has_prev, after is not None)
+            seen += [r["tg_id"] for r in rows]
+            after = rows[-1]["id"]
+            if not has_next:
+                break
+            await add(2)                                # new sign-ups between pages
+        total = await ActiveUser.objects.acount()
+        self.assertEqual(sorted(seen), list(range(1, total + 1)))
+
+        rows, has_prev, has_next = await repository.users_page(before=after, limit=10)
+        self.assertEqual([r["tg_id"] for r in rows], list(range(total - 10, total)))
+        self.assertTrue(has_prev and has_next)
+
+
+class ExpiredUserTests(TransactionTestCase):
+    async def test_expired_user_cannot_start_or_finish_setup(self):
+        now = timezone.now()
+        await ActiveUser.objects.acreate(name="u", phone="", tg_id=7, activated_at=now,
+                                         expires_at=now + datetime.timedelta(days=1))
+        driver = await Driver.objects.acreate(tg_id=7, api_id=1, api_hash="x", session="")
+        await Announcement.objects.acreate(driver=driver, groups=["@g"], text="hi",
+                                           interval_minutes=5, active=False)
+        self.assertTrue(await onboarding_bot.is_active_user(7))     # cached as active
+
+        users, ann_ids = await repository.expire_due(now + datetime.timedelta(days=2))
+        control = mock.AsyncMock()
+        with mock.patch.object(onboarding_bot, "posting", control), \
+                mock.patch.object(onboarding_bot, "bot", mock.AsyncMock()):
+            await onboarding_bot.on_users_expired(users, ann_ids)
+            msg = mock.AsyncMock(text="10", from_user=mock.Mock(id=7))
+            state = mock.AsyncMock()
+            state.get_data.return_value = {"groups": ["@g"], "text": "hi"}
+            await onboarding_bot.cmd_start_announce(msg)
+            await onboarding_bot.process_interval(msg, state)
+
+        self.assertEqual([c.args[0] for c in msg.answer.await_args_list], ["❌ Not active."] * 2)
+        state.clear.assert_awaited()
+        control.start.assert_not_awaited()
+        self.assertFalse(await Announcement.objects.filter(active=True).aexists())
+
+
+class BroadcasterTests(TransactionTestCase):
+    async def test_interrupted_broadcast_resumes_after_the_last_recipient(self):
+        now, day = timezone.now(), datetime.timedelta(days=1)
+        users = [await ActiveUser.objects.acreate(name="u", phone="", tg_id=100 + i, activated_at=now,
+                                                  expires_at=now + day) for i in range(5)]
+        await ActiveUser.objects.acreate(name="gone", phone="", tg_id=999, activated_at=now,
+                                         expires_at=now - day)
+        broadcast = await repository.create_broadcast("hi", admin_id=1, total=5)
+        sent, reports, stopper = [], [], []
+
+        async def send(tg_id, text):
+            sent.append(tg_id)
+            if tg_id == 102 and not stopper:
+                stopper.append(asyncio.create_task(first.stop(task, 5)))     # shutdown
+                await asyncio.sleep(0)
+            if tg_id == 103 and sent.count(103) == 1:
+                raise TelegramRetryAfter(SendMessage(chat_id=tg_id, text=text), "Too Many Requests", 0)
+            if tg_id == 104:
+                raise TelegramForbiddenError(SendMessage(chat_id=tg_id, text=text), "bot was blocked")
+
+        async def report(row, final):
+            reports.append((row["status"], final))
+
+        first = Broadcaster(send, report, rate=1000, concurrency=1, chunk_size=2, backoff=0)
+        task = asyncio.create_task(first.run())
+        await asyncio.wait_for(task, 5)
+        row = await Broadcast.objects.aget(id=broadcast.id)
+        self.assertEqual((row.status, row.cursor, row.delivered), ("running", users[2].id, 3))
+
+        second = Broadcaster(send, report, rate=1000, concurrency=1, chunk_size=2, backoff=0)
+        self.assertEqual(await second.deliver(await repository.next_broadcast()), "done")
+        self.assertEqual(sent, [100, 101, 102, 103, 103, 104])
+        row = await Broadcast.objects.aget(id=broadcast.id)
+        self.assertEqual((row.delivered, row.failed, second.throttled), (4, 1, 1))
+        self.assertEqual(reports, [("done", True)])
+
+
+class ButtonRouterTests(SimpleTestCase):
+    async def test_table_first_then_state_handlers(self):
+        class Ask(StatesGroup):
+            name = State()
+
+        router, seen = ButtonRouter(), []
+
+        class Names(BaseMiddleware):
+            async def __call__(self, handler, event, data):
+                seen.append(data["handler"].callback.__name__)
+                return await handler(event, data)
+
+        router.message.middleware(Names())
+
+        @router.button("🔒 Login")
+        async def login(msg: Message, state: FSMContext):
+            await state.set_state(Ask.name)
+
+        @router.button("⏹ Stop", ignore_case=True)
+        async def stop(msg: Message):
+            pass
+
+        @router.command("history")
+        async def history(msg: Message, command: CommandObject):
+            seen.append(command.args)
+
+        @router.state(Ask.name)
+        async def name(msg: Message):
+            pass
+
+        dp = Dispatcher(storage=MemoryStorage())
+        dp.include_router(router)
+        bot = Bot("123456:" + "A" * 35)
+        user = User(id=7, is_bot=False, first_name="u")
+        for i, text in enumerate(["🔒 Login", "Ann", "⏹ STOP", "/history 42", "/help", "Bob"]):
+            await dp.feed_update(bot, Update(update_id=i, message=Message(
+                message_id=i, date=0, text=text, chat=Chat(id=7, type="private"), from_user=user)))
+        await bot.session.close()
+
+        # "/help" has no route, so like "Bob" it goes to the state handler
+        self.assertEqual(seen, ["login", "name", "stop", "history", "42", "name", "name"])
+
+
+class OnboardingWebhookTests(SimpleTestCase):
+    async def test_updates_without_the_secret_are_refused(self):
+        from city_taxi_project.urls import onboarding_webhook
+
+        factory = RequestFactory()
+        for secret, sent in (("", ""), ("s3cret", ""), ("s3cret", "guess")):
+            with self.subTest(secret=secret, sent=sent), override_settings(ONBOARDING_WEBHOOK_SECRET=secret):
+                request = factory.post("/onboarding/webhook/", b"{}", content_type="application/json",
+                                       headers={"X-Telegram-Bot-Api-Secret-Token": sent})
+                self.assertEqual((await onboarding_webhook(request)).status_code, 403)
+
+
+class BotPoolTests(SimpleTestCase):
+    @override_settings(BOTPOOL_MAX_BOTS=1)
+    async def test_busy_bots_stay_and_revoked_ones_close_from_any_thread(self):
+        busy_token, token = "111:" + "A" * 35, "222:" + "B" * 35
+        busy_bot = botpool.get_bot(busy_token)
+        bot = botpool.get_bot(token, busy=lambda b: b is busy_bot)
+        self.assertEqual(list(botpool.bots), [busy_token, token])     # over the cap, not closed
+
+        for b in (busy_bot, bot):
+            b.session.close = mock.AsyncMock()
+        # registry loads run in a worker thread, model signals have no loop
+        await asyncio.to_thread(botpool.drop_bot, token)
+        await asyncio.to_thread(botpool.drop_bot, busy_token)
+        for _ in range(5):
+            await asyncio.sleep(0)
+        self.assertEqual(list(botpool.bots), [])
+        bot.session.close.assert_awaited_once()
+        busy_bot.session.close.assert_awaited_once()
+
+
+class RegisterBotTests(TestCase):
+    def test_token_is_checked_and_webhook_set_before_it_is_stored(self):
+        Driver.objects.create(tg_id=5, api_id=1, api_hash="x", session="-")
+        good, bad = "123456:" + "A" * 35, "654321:" + "B" * 35
+        calls = []
+
+        async def make_request(session, bot, method, timeout=None):
+            calls.append(method)
+            if bot.token == bad:
+                raise TelegramUnauthorizedError(method=method, message="Unauthorized")
+            if isinstance(method, GetMe):
+                return User(id=123456, is_bot=True, first_name="Taxi", username="taxi_bot")
+            return True
+
+        with mock.patch.object(AiohttpSession, "make_request", make_request), \
+                override_settings(WEBHOOK_BASE_URL="https://taxi.example"):
+            with self.assertRaisesMessage(CommandError, "Token rejected"):
+                call_command("register_bot", "5", bad, stdout=StringIO())
+            call_command("register_bot", "5", good, stdout=StringIO())
+
+        hook = next(m for m in calls if isinstance(m, SetWebhook))
+        self.assertEqual(hook.url, f"https://taxi.example/webhook/{good}/")
+        self.assertEqual(list(DriverBot.objects.values_list("driver_id", "token")), [(5, good)])
+        self.assertIn(good, registry)
@@ -0,0 +1,77 @@
+# taxiapp/timingmiddleware.py
+import logging
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from django.conf import settings
+
+from taxiapp.metrics import handler_errors, handler_seconds, update_seconds, update_stage_seconds
+from taxiapp.tracing import UpdateTrace, _current, profiler, record
+
+log = logging.getLogger(__name__)
+
+
+class UpdateTimingMiddleware(BaseMiddleware):
+    # outer middleware on dp.update: wraps the whole update, filters included
+    def __init__(self, bot_name: str, slow: float | None = None):
+        self._bot = bot_name
+        self._slow = settings.SLOW_UPDATE_SECONDS if slow is None else slow
+
+    async def __call__(self, handler, event, data):
+        trace = UpdateTrace(event.update_id, self._bot)
+        token = _current.set(trace)
+        if profiler is not None:
+            profiler.watch(trace)
+        try:
+            return await handler(event, data)
+        finally:
+            _current.reset(token)
+            if profiler is not None:
+                profiler.unwatch(trace)
+            self._finish(trace, time.perf_counter() - trace.started)
+
+    def _finish(self, trace: UpdateTrace, wall: float):
+        update_seconds.observe(wall, bot=trace.bot, handler=trace.handler, state=trace.state or "-")
+        for name, (_, seconds) in trace.stages.items():
+            update_stage_seconds.inc(seconds, bot=trace.bot, stage=name)
+        if wall < self._slow:
+            return
+        log.warning(
+            "Slow update %s: %s in state %s took %.3fs (%s)",
+            trace.update_id, trace.handler, trace.state, wall, trace.breakdown(wall),
+        )
+        if profiler is not None and trace.samples:
+            profiler.dump(trace)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    # inner middleware: only runs once a handler matched, so it can be named
+    def __init__(self, bot_name: str):
+        self._bot = bot_name
+
+    async def __call__(self, handler, event, data):
+        obj = data.get("handler")
+        name = getattr(getattr(obj, "callback", None), "__name__", "unknown")
+        trace = _current.get()
+        if trace is not None:
+            trace.handler = name
+            trace.state = data.get("raw_state")
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(bot=self._bot, handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - t0, bot=self._bot, handler=name)
+
+
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    # Bot API calls (answer, edit_text, ...) made while handling an update
+    async def __call__(self, make_request, bot, method):
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            record("telegram", time.perf_counter() - t0)
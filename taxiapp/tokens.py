@@ -0,0 +1,92 @@
+# taxiapp/tokens.py
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from taxiapp.models import Driver, DriverBot
+
+log = logging.getLogger(__name__)
+
+
+class TokenRegistry:
+    """
+    In-memory set of bot tokens the webhook may serve.
+
+    Loaded once with a single query, kept current through model signals
+    and re-read every ``refresh`` seconds to pick up changes made by other
+    processes or by ``QuerySet.update()`` (which sends no signals).
+    Listeners registered with ``subscribe`` get ``(token, valid)`` when a
+    token appears or goes away.
+    """
+
+    def __init__(self, refresh: float = 300):
+        self._refresh = refresh
+        self._tokens: set[str] = set()
+        self._loaded_at: float | None = None
+        self._listeners = []
+
+    def __contains__(self, token):
+        return token in self._tokens
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+
+    def _notify(self, token: str, valid: bool):
+        for callback in self._listeners:
+            try:
+                callback(token, valid)
+            except Exception:
+                log.exception("Token listener failed")
+
+    def load(self):
+        fresh = set(
+            DriverBot.objects.filter(active=True, driver__active=True)
+            .values_list("token", flat=True)
+        )
+        for token in self._tokens - fresh:
+            self._notify(token, False)
+        self._tokens = fresh
+        self._loaded_at = time.monotonic()
+        log.info("Token registry loaded %d tokens", len(fresh))
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    async def is_valid(self, token: str) -> bool:
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self._refresh:
+            await sync_to_async(self.load, thread_sensitive=True)()
+        return token in self._tokens
+
+    def set(self, token: str, valid: bool):
+        if valid:
+            self._tokens.add(token)
+        elif token in self._tokens:
+            self._tokens.discard(token)
+            self._notify(token, False)
+
+
+registry = TokenRegistry(refresh=settings.TOKEN_REGISTRY_REFRESH)
+
+
+@receiver(post_save, sender=DriverBot)
+def _bot_saved(sender, instance, **kwargs):
+    registry.set(instance.token, instance.active and instance.driver.active)
+
+
+@receiver(post_delete, sender=DriverBot)
+def _bot_deleted(sender, instance, **kwargs):
+    registry.set(instance.token, False)
+
+
+@receiver(post_save, sender=Driver)
+@receiver(post_delete, sender=Driver)
+def _driver_changed(sender, instance, **kwargs):
+    # a driver toggle can flip several tokens – reload lazily on next request
+    registry.invalidate()
@@ -0,0 +1,153 @@
+# taxiapp/tracing.py
+#
+# Per-update timing for the aiogram bots: which handler ran in which FSM
+# state, and where the time went – waiting on the DB threads, SQL, Bot API,
+# Telethon. The aiogram middlewares that start and finish a trace are in
+# taxiapp/timingmiddleware.py, so importing this (every repository call is
+# timed) doesn't pull in aiogram.
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from taxiapp.metrics import db_query_seconds
+
+log = logging.getLogger(__name__)
+
+_current: contextvars.ContextVar["UpdateTrace | None"] = contextvars.ContextVar(
+    "update_trace", default=None)
+
+
+class UpdateTrace:
+    __slots__ = ("update_id", "bot", "handler", "state", "started", "stages", "samples")
+
+    def __init__(self, update_id: int, bot: str):
+        self.update_id = update_id
+        self.bot = bot
+        self.handler = "unhandled"
+        self.state = None
+        self.started = time.perf_counter()
+        self.stages: dict[str, list] = {}       # stage → [calls, seconds]
+        self.samples: Counter | None = None
+
+    def add(self, stage: str, seconds: float):
+        entry = self.stages.setdefault(stage, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def breakdown(self, wall: float) -> str:
+        parts = [f"{stage} {n}× {s:.3f}s" for stage, (n, s) in sorted(self.stages.items())]
+        # sql runs inside the db hand-off, so it is not subtracted again
+        other = wall - sum(s for stage, (_, s) in self.stages.items() if stage != "sql")
+        parts.append(f"other {max(other, 0.0):.3f}s")
+        return ", ".join(parts)
+
+
+def record(stage: str, seconds: float):
+    trace = _current.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Charge the enclosed block (awaits included) to stage ``name``."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t0)
+
+
+def timed(stage: str):
+    """Decorator: charge the await of an async callable to ``stage`` of the current update."""
+    def wrap(afn):
+        @functools.wraps(afn)
+        async def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await afn(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter() - t0)
+        return wrapper
+    return wrap
+
+
+def _await_stack(task: asyncio.Task) -> str:
+    # where the update's coroutine chain is suspended, outermost first
+    frames = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return ";".join(frames)
+
+
+class StackSampler:
+    """
+    Opt-in profiler: every ``interval`` seconds records where each update in
+    progress is awaiting. Stacks of slow updates are appended to ``path`` in
+    collapsed format (one ``frame;frame;... count`` line per stack), ready
+    for flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, path, interval: float = 0.01):
+        self.path = path
+        self.interval = interval
+        self._active: dict[UpdateTrace, asyncio.Task] = {}
+        self._task: asyncio.Task | None = None
+
+    def watch(self, trace: UpdateTrace):
+        trace.samples = Counter()
+        self._active[trace] = asyncio.current_task()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def unwatch(self, trace: UpdateTrace):
+        self._active.pop(trace, None)
+
+    async def _run(self):
+        while self._active:
+            await asyncio.sleep(self.interval)
+            for trace, task in list(self._active.items()):
+                stack = _await_stack(task)
+                if stack:
+                    trace.samples[stack] += 1
+
+    def dump(self, trace: UpdateTrace):
+        root = f"{trace.bot}:{trace.handler}[{trace.state or '-'}]"
+        with open(self.path, "a") as f:
+            for stack, n in trace.samples.items():
+                f.write(f"{root};{stack} {n}\n")
+
+
+profiler = (
+    StackSampler(settings.UPDATE_PROFILE_FILE, settings.UPDATE_PROFILE_INTERVAL)
+    if settings.UPDATE_PROFILE_FILE else None
+)
+
+
+def _time_query(execute, sql, params, many, context):
+    t0 = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - t0
+        db_query_seconds.observe(elapsed, alias=context["connection"].alias)
+        record("sql", elapsed)        # sync_to_async copies the update's context
+
+
+def install_db_timing(sender, connection, **kwargs):
+    """``connection_created`` receiver: time every query on the new connection."""
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
@@ -0,0 +1,83 @@
+# taxiapp/usercache.py
+import datetime
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from taxiapp import repository
+from taxiapp.models import ActiveUser
+
+
+class ActiveUserCache:
+    """
+    Bounded TTL cache of ActiveUser status keyed by Telegram id.
+
+    Unknown users are cached too (negative entries). Each entry keeps the
+    row's ``expires_at`` so a subscription that runs out while cached is
+    reported inactive without going back to the database. Saving or
+    deleting an ActiveUser drops its entry; changes made by other processes
+    or by ``QuerySet.update()`` show up after ``ttl``.
+    """
+
+    def __init__(self, ttl: float = 60, max_size: int = 10_000):
+        self._ttl = ttl
+        self._max_size = max_size
+        # tg_id → (active, expires_at, cached_at)
+        self._entries: OrderedDict[int, tuple[bool, datetime.datetime | None, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def is_active(self, tg_id: int) -> bool:
+        entry = self._entries.get(tg_id)
+        if entry is not None and time.monotonic() - entry[2] < self._ttl:
+            self.hits += 1
+            self._entries.move_to_end(tg_id)
+        else:
+            self.misses += 1
+            row = await repository.user_status(tg_id)
+            entry = self.set(tg_id, *(row or (False, None)))
+        active, expires_at, _ = entry
+        return active and (expires_at is None or expires_at > timezone.now())
+
+    def set(self, tg_id: int, active: bool, expires_at: datetime.datetime | None):
+        entry = (active, expires_at, time.monotonic())
+        self._entries[tg_id] = entry
+        self._entries.move_to_end(tg_id)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, tg_id: int | None = None):
+        if tg_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(tg_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size":      len(self._entries),
+            "hits":      self.hits,
+            "misses":    self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+
+# Activation status per Telegram id, shared by every access check
+user_cache = ActiveUserCache(
+    ttl=settings.ACTIVE_USER_CACHE_TTL,
+    max_size=settings.ACTIVE_USER_CACHE_SIZE,
+)
+
+
+@receiver(post_save, sender=ActiveUser)
+@receiver(post_delete, sender=ActiveUser)
+def _user_changed(sender, instance, **kwargs):
+    user_cache.invalidate(instance.tg_id)